@@ -30,7 +30,7 @@ setup(name='snipar',
       license='MIT',
       include_package_data=True,
       package_data={'': ['*.pxd', '*.pyx']},
-      scripts=['snipar/scripts/gwas.py', 'snipar/scripts/pgs.py', 'snipar/scripts/impute.py', 'snipar/scripts/ibd.py','snipar/scripts/correlate.py','snipar/example/snipar_example_data.py'],
+      scripts=['snipar/scripts/gwas.py', 'snipar/scripts/pgs.py', 'snipar/scripts/impute.py', 'snipar/scripts/ibd.py','snipar/scripts/correlate.py','snipar/scripts/rechunk.py','snipar/scripts/build_store.py','snipar/scripts/merge_shards.py','snipar/example/snipar_example_data.py'],
       classifiers=[
             # How mature is this project? Common values are
             #   3 - Alpha
@@ -2,7 +2,7 @@ import numpy.ma as ma
 from numba import njit, prange
 import gzip
 from snipar.ld import ldscores_from_bed
-from snipar.utilities import make_id_dict
+from snipar.utilities import id_index
 import numpy as np
 
 class sumstats(object):
@@ -14,7 +14,7 @@ class sumstats(object):
         self.chrom = np.zeros(sid.shape,dtype=int)
         self.chrom[:] = int(chrom)
         self.sid = np.array(sid,dtype=str)
-        self.sid_dict = make_id_dict(self.sid)
+        self.sid_dict = id_index(self.sid)
         self.pos = np.array(pos,dtype=int)
         self.A1 = np.array(A1,dtype=str)
         self.A2 = np.array(A2,dtype=str)
@@ -53,7 +53,7 @@ class sumstats(object):
     def concatenate(self,s2):
         self.chrom = np.hstack((self.chrom,s2.chrom))
         self.sid = np.hstack((self.sid, s2.sid))
-        self.sid_dict = make_id_dict(self.sid)
+        self.sid_dict = id_index(self.sid)
         self.pos = np.hstack((self.pos, s2.pos))
         self.A1 = np.hstack((self.A1, s2.A1))
         self.A2 = np.hstack((self.A2, s2.A2))
@@ -73,7 +73,7 @@ class sumstats(object):
     def filter(self,filter_pass):
         self.chrom = self.chrom[filter_pass]
         self.sid = self.sid[filter_pass]
-        self.sid_dict = make_id_dict(self.sid)
+        self.sid_dict = id_index(self.sid)
         self.pos = self.pos[filter_pass]
         self.A1 = self.A1[filter_pass]
         self.A2 = self.A2[filter_pass]
@@ -112,10 +112,11 @@ class sumstats(object):
         for i in range(ld_files.shape[0]):
             print('Reading LD scores from '+ld_files[i])
             ld_chr = np.loadtxt(ld_files[i],dtype=str,usecols=(1,3))
-            in_sid_dict = np.array([x in self.sid_dict for x in ld_chr[:,0]])
+            ld_indices = self.sid_dict.get_indexer(ld_chr[:,0])
+            in_sid_dict = ld_indices >= 0
             if np.sum(in_sid_dict) > 0:
                 ld_chr = ld_chr[in_sid_dict,:]
-                ld_indices = np.array([self.sid_dict[x] for x in ld_chr[:,0]])
+                ld_indices = ld_indices[in_sid_dict]
                 self.ldscores[ld_indices] = np.array(ld_chr[:,1],dtype=float)
                 self.ldscores.mask[ld_indices] = False
             else:
@@ -130,14 +131,15 @@ class sumstats(object):
         r_dir_avg_NTC, r_dir_avg_NTC_SE, r_dir_avg_NTC_delete = jacknife_est(self.direct,self.avg_NTC,np.power(self.direct_SE,2),
                                                                                 np.power(self.avg_NTC_SE,2),self.r_direct_avg_NTC,self.ldscores, n_blocks)
         return r_dir_avg_NTC, r_dir_avg_NTC_SE, r_dir_avg_NTC_delete
-    def compute_ld_scores(self, bedfiles, chroms, ld_wind, ld_out=None):
+    def compute_ld_scores(self, bedfiles, chroms, ld_wind, ld_out=None, native_bed=False):
         self.ldscores = ma.array(np.zeros(self.sid.shape[0]), mask=np.ones(self.sid.shape[0]))
         for i in range(bedfiles.shape[0]):
             print('Computing LD scores for chromosome '+str(chroms[i]))
-            ld_chr, ld_snps_chr = ldscores_from_bed(bedfiles[i], chroms[i], ld_wind, ld_out)
-            in_sid_dict = np.array([x in self.sid_dict for x in ld_snps_chr])
+            ld_chr, ld_snps_chr = ldscores_from_bed(bedfiles[i], chroms[i], ld_wind, ld_out, native_bed=native_bed)
+            ld_indices = self.sid_dict.get_indexer(ld_snps_chr)
+            in_sid_dict = ld_indices >= 0
             if np.sum(in_sid_dict) > 0:
-                ld_indices = np.array([self.sid_dict[x] for x in ld_snps_chr[in_sid_dict]])
+                ld_indices = ld_indices[in_sid_dict]
                 self.ldscores[ld_indices] = np.array(ld_chr[in_sid_dict],dtype=float)
                 self.ldscores.mask[ld_indices] = False
             else:
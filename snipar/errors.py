@@ -11,17 +11,17 @@ class g_error(object):
             self.ME = ME
             self.sum_het = sum_het
             self.sid = sid
-            self.sid_dict = make_id_dict(self.sid)
+            self.sid_dict = id_index(self.sid)
     def bayes_shrink(self, alpha, beta):
         self.error_ests = (self.ME+alpha)/(self.sum_het+beta)
 
-def estimate_genotyping_error_rate(ped, bedfiles=None, bgenfiles=None, min_maf=0.01):
+def estimate_genotyping_error_rate(ped, bedfiles=None, bgenfiles=None, min_maf=0.01, native_bed=False):
     genome_errors = []
     # Estimate per-SNP errors for each chromosome
     if bedfiles is not None:
         nsnp = np.zeros((bedfiles.shape[0]), dtype=int)
         for i in range(bedfiles.shape[0]):
-            ME_chr = mendelian_errors(ped, bedfile=bedfiles[i], min_maf=min_maf)
+            ME_chr = mendelian_errors(ped, bedfile=bedfiles[i], min_maf=min_maf, native_bed=native_bed)
             genome_errors.append(ME_chr)
             nsnp[i] = ME_chr.sid.shape[0]
     elif bgenfiles is not None:
@@ -58,23 +58,18 @@ def estimate_genotyping_error_rate(ped, bedfiles=None, bgenfiles=None, min_maf=0
     else:
         return mean_error, None
 
-def mendelian_errors(ped, bedfile=None, bgenfile=None, min_maf=0.01):
+def mendelian_errors(ped, bedfile=None, bgenfile=None, min_maf=0.01, native_bed=False):
     if bedfile is not None:
-        gts, opg_ped, npair = read_PO_pairs_from_bed(ped, bedfile=bedfile)
+        gts, opg_ped, npair = read_PO_pairs_from_bed(ped, bedfile=bedfile, native_bed=native_bed)
     elif bgenfile is not None:
         gts, opg_ped, npair = read_PO_pairs_from_bgen(ped, bgenfile=bgenfile)
     #print('Finding indices of parent-offspring pairs')
     ## Get indices
-    pair_indices = np.zeros((npair,2),dtype=int)
-    pair_count = 0
-    for i in range(opg_ped.shape[0]):
-        o_index = gts.id_dict[opg_ped[i,1]]
-        if opg_ped[i, 2] in gts.id_dict:
-            pair_indices[pair_count,:] = np.array([o_index,gts.id_dict[opg_ped[i,2]]])
-            pair_count += 1
-        if opg_ped[i, 3] in gts.id_dict:
-            pair_indices[pair_count,:] = np.array([o_index,gts.id_dict[opg_ped[i,3]]])
-            pair_count += 1
+    o_indices = gts.id_dict.get_indexer(opg_ped[:, 1])
+    par_indices = np.column_stack((gts.id_dict.get_indexer(opg_ped[:, 2]), gts.id_dict.get_indexer(opg_ped[:, 3])))
+    # Pairs in order of offspring, then father before mother
+    pair_indices = np.column_stack((np.repeat(o_indices, 2), par_indices.flatten()))
+    pair_indices = pair_indices[np.min(pair_indices, axis=1) >= 0, :]
     # Filter on MAF
     #print('Filtering on MAF')
     gts.filter_maf(min_maf)
@@ -83,8 +78,8 @@ def mendelian_errors(ped, bedfile=None, bgenfile=None, min_maf=0.01):
     ME = count_ME(np.array(gts.gts,dtype=np.float_), pair_indices)
     #print('Counted mendelain errors')
     # Estimate error probability
-    N_pair = np.sum(np.logical_not(gts.gts[pair_indices[:, 0], :].mask) * np.logical_not(gts.gts[pair_indices[:, 1], :].mask),
-                    axis=0)
+    observed = np.logical_not(gts.mask)
+    N_pair = np.sum(observed[pair_indices[:, 0], :] * observed[pair_indices[:, 1], :], axis=0)
     sum_het = N_pair * gts.freqs * (1 - gts.freqs)
     error_mle = ME/sum_het
     return g_error(error_mle, ME, sum_het, gts.sid)
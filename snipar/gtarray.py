@@ -1,6 +1,158 @@
 import numpy as np
 import numpy.ma as ma
-from snipar.utilities import make_id_dict
+from numba import njit
+from snipar.utilities import id_index
+
+def get_fam_indices(fams):
+    """
+    Make a dictionary that maps from each family label to the indices of the members of that family
+    """
+    order = np.argsort(fams, kind='stable')
+    unique_fams, fam_starts = np.unique(fams[order], return_index=True)
+    return dict(zip(unique_fams, np.split(order, fam_starts[1:])))
+
+def get_famsize_indices(fams):
+    """
+    Group families by size. Returns a dictionary that maps from each family size, k, to a [n_fams x k] array of the indices of the members
+    of the families of that size. The families are given either by a vector of family labels or by a dictionary made by get_fam_indices
+    """
+    if isinstance(fams, dict):
+        famsize_indices = {}
+        for indices in fams.values():
+            famsize_indices.setdefault(indices.shape[0], []).append(indices)
+        return {famsize: np.vstack(famsize_indices[famsize]) for famsize in famsize_indices}
+    order = np.argsort(fams, kind='stable')
+    unique_fams, fam_starts, fam_sizes = np.unique(fams[order], return_index=True, return_counts=True)
+    famsize_indices = {}
+    for famsize in np.unique(fam_sizes):
+        starts = fam_starts[fam_sizes == famsize]
+        famsize_indices[int(famsize)] = order[starts[:, np.newaxis] + np.arange(famsize)]
+    return famsize_indices
+
+def transform_families(inv_root, x, famsize_indices):
+    """
+    Multiply the rows of each family in x by the inverse square root of the phenotypic covariance matrix of a family of that size (see lmm.model.sigma_inv_root).
+    The families of each size are transformed together, and x is modified in place.
+
+    Args:
+        inv_root : :class:`dict`
+            inverse square root matrices by family size
+        x : :class:`~numpy:numpy.array`
+            array with individuals in the first dimension
+        famsize_indices : :class:`dict`
+            indices of the families of each size (see get_famsize_indices)
+
+    Returns:
+        x : :class:`~numpy:numpy.array`
+    """
+    for famsize, indices in famsize_indices.items():
+        if famsize == 1:
+            x[indices[:, 0]] = inv_root[1]*x[indices[:, 0]]
+        else:
+            block = x[indices].reshape((indices.shape[0], famsize, -1))
+            x[indices] = np.matmul(inv_root[famsize], block).reshape(indices.shape+x.shape[1:])
+    return x
+
+def as_3d(x):
+    """
+    View a 2 dimensional [N x L] array as a 3 dimensional [N x 1 x L] array, so that the same kernels can be used for 2 and 3 dimensional genotype arrays
+    """
+    if x.ndim == 2:
+        return x[:, np.newaxis, :]
+    return x
+
+def is_snp_major(x):
+    """
+    Whether the values for each SNP are stored together in memory (as made by the readers), which sets the order in which the kernels loop over x
+    """
+    return x.strides[0] < x.strides[x.ndim-1]
+
+@njit(nogil=True)
+def nan_sums(x, snp_major):
+    """
+    Sums, sums of squares, and counts of the non-missing (not NaN) values of a [N x k x L] array over individuals (first dimension).
+
+    Returns:
+        sums : :class:`~numpy:numpy.array`
+            [k x L] array of sums
+        sumsq : :class:`~numpy:numpy.array`
+            [k x L] array of sums of squares
+        counts : :class:`~numpy:numpy.array`
+            [k x L] array of counts of non-missing values
+    """
+    N, k, L = x.shape
+    sums = np.zeros((k, L))
+    sumsq = np.zeros((k, L))
+    counts = np.zeros((k, L), dtype=np.int64)
+    if snp_major:
+        for l in range(L):
+            for i in range(N):
+                for j in range(k):
+                    v = x[i, j, l]
+                    if not np.isnan(v):
+                        sums[j, l] += v
+                        sumsq[j, l] += v*v
+                        counts[j, l] += 1
+    else:
+        for i in range(N):
+            for j in range(k):
+                for l in range(L):
+                    v = x[i, j, l]
+                    if not np.isnan(v):
+                        sums[j, l] += v
+                        sumsq[j, l] += v*v
+                        counts[j, l] += 1
+    return sums, sumsq, counts
+
+@njit(nogil=True)
+def has_nan(x, snp_major):
+    """
+    Whether a [N x k x L] array has any missing (NaN) values
+    """
+    N, k, L = x.shape
+    if snp_major:
+        for l in range(L):
+            for i in range(N):
+                for j in range(k):
+                    if np.isnan(x[i, j, l]):
+                        return True
+    else:
+        for i in range(N):
+            for j in range(k):
+                for l in range(L):
+                    if np.isnan(x[i, j, l]):
+                        return True
+    return False
+
+@njit(nogil=True)
+def fill_nans(x, missing, snp_major):
+    """
+    Set the missing (NaN) values of a [N x k x L] array to zero, in place, and record them in a bit-packed missingness mask,
+    missing, of shape [ceil(N/8) x k x L], with the same bit order as np.packbits(np.isnan(x), axis=0).
+
+    Returns:
+        counts : :class:`~numpy:numpy.array`
+            [k x L] array of counts of missing values
+    """
+    N, k, L = x.shape
+    counts = np.zeros((k, L), dtype=np.int64)
+    if snp_major:
+        for l in range(L):
+            for i in range(N):
+                for j in range(k):
+                    if np.isnan(x[i, j, l]):
+                        x[i, j, l] = 0
+                        missing[i // 8, j, l] |= np.uint8(128 >> (i % 8))
+                        counts[j, l] += 1
+    else:
+        for i in range(N):
+            for j in range(k):
+                for l in range(L):
+                    if np.isnan(x[i, j, l]):
+                        x[i, j, l] = 0
+                        missing[i // 8, j, l] |= np.uint8(128 >> (i % 8))
+                        counts[j, l] += 1
+    return counts
 
 class gtarray(object):
     """Define a genotype or PGS array that stores individual IDs, family IDs, and SNP information.
@@ -29,16 +181,22 @@ class gtarray(object):
              The first column is for the father of that individual; the second column is for the mother of that individual.
              If the parent is neither observed nor imputed, the value is -1; if observed, 0; and if imputed, 1.
 
+    The genotypes are stored in gts as a dense floating point array, with missing values set to NaN. Arrays that are not floating point are
+    converted to float32, and masked arrays have their masked values set to NaN. When missing values are filled in (see fill_NAs), they are
+    recorded in a bit-packed missingness mask, stored in missing; the mask attribute gives the missingness as a boolean array.
+
     Returns:
         G : :class:`snipar.gtarray`
 
     """
     def __init__(self, garray, ids, sid=None, alleles=None, pos=None, chrom=None, map=None, error_probs=None, fams=None, par_status=None):
         if type(garray) == np.ndarray or type(garray) == np.ma.core.MaskedArray:
-            if type(garray) == np.ndarray:
-                self.gts = ma.array(garray,mask=np.isnan(garray))
-            else:
-                self.gts = garray
+            if not np.issubdtype(garray.dtype, np.floating):
+                garray = garray.astype(np.float32)
+            if type(garray) == np.ma.core.MaskedArray:
+                garray = ma.filled(garray, np.nan)
+            self.gts = garray
+            self.missing = None
             self.shape = garray.shape
             self.ndim = garray.ndim
             self.dtype = garray.dtype
@@ -47,18 +205,18 @@ class gtarray(object):
             raise ValueError('Genotypes must be a numpy ndarray')
         if garray.shape[0] == ids.shape[0]:
             self.ids = ids
-            self.id_dict = make_id_dict(ids)
+            self.id_dict = id_index(ids)
         else:
             raise ValueError('Shape of genotypes and ids does not match')
         if sid is not None:
             if sid.shape[0] == garray.shape[1]:
                 self.snp_index = 1
                 self.sid = sid
-                self.sid_dict = make_id_dict(sid)
+                self.sid_dict = id_index(sid)
             elif sid.shape[0] == garray.shape[2]:
                 self.snp_index = 2
                 self.sid = sid
-                self.sid_dict = make_id_dict(sid)
+                self.sid_dict = id_index(sid)
             else:
                 raise ValueError('Shape of SNP ids (sid) does not match shape of genotype array')
         if alleles is not None:
@@ -129,21 +287,42 @@ class gtarray(object):
 
         self.mean_normalised = False
 
-        if np.sum(self.gts.mask)>0:
-            self.has_NAs = True
-        else:
-            self.has_NAs = False
+        self.has_NAs = has_nan(as_3d(self.gts), is_snp_major(self.gts))
 
         self.info = None
 
+    @property
+    def mask(self):
+        """
+        Boolean array marking the missing values: those recorded in the bit-packed missingness mask if missing values have been filled in,
+        otherwise the NaN values of gts.
+        """
+        if self.missing is not None:
+            return np.unpackbits(self.missing, axis=0, count=self.gts.shape[0]).astype(bool)
+        return np.isnan(self.gts)
+
+    def nan_stats(self, index=None):
+        """
+        Means and variances over individuals of the non-missing values, and the counts of non-missing values.
+        For a 3 dimensional array, index selects the second dimension (for example, 0 for proband genotypes); by default, all are returned.
+        """
+        x = as_3d(self.gts)
+        if index is not None:
+            x = x[:, index:index+1, :]
+        sums, sumsq, counts = nan_sums(x, is_snp_major(x))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums/counts
+            variances = sumsq/counts-means**2
+        if self.ndim == 2 or index is not None:
+            return means[0], variances[0], counts[0]
+        return means, variances, counts
+
     def compute_freqs(self):
         """
         Computes the frequencies of the SNPs. Stored in self.freqs.
         """
-        if self.ndim == 2:
-            self.freqs = ma.mean(self.gts,axis=0)/2.0
-        elif self.ndim == 3:
-            self.freqs = ma.mean(self.gts[:,0,:], axis=0) / 2.0
+        means = self.nan_stats(index=0)[0]
+        self.freqs = (means/2.0).astype(self.dtype)
 
     def filter(self, filter_pass):
         if self.freqs is not None:
@@ -152,10 +331,12 @@ class gtarray(object):
             self.gts = self.gts[:,filter_pass]
         elif self.ndim == 3:
             self.gts = self.gts[:,:,filter_pass]
+        if self.missing is not None:
+            self.missing = self.missing[..., filter_pass]
         self.shape = self.gts.shape
         if self.sid is not None:
             self.sid = self.sid[filter_pass]
-            self.sid_dict = make_id_dict(self.sid)
+            self.sid_dict = id_index(self.sid)
         if self.pos is not None:
             self.pos = self.pos[filter_pass]
         if self.alleles is not None:
@@ -179,10 +360,11 @@ class gtarray(object):
         self.filter(freqs_pass)
 
     def filter_missingness(self, max_missing = 5, verbose=False):
+        counts = self.nan_stats()[2]
         if self.ndim == 2:
-            missingness = ma.mean(self.gts.mask,axis=0)
+            missingness = 1-counts/self.shape[0]
         elif self.ndim == 3:
-            missingness = ma.mean(self.gts.mask,axis = (0,1))
+            missingness = 1-np.sum(counts, axis=0)/(self.shape[0]*self.shape[1])
         missingness_pass = 100 * missingness < max_missing
         if verbose:
             print(str(self.freqs.shape[0] - np.sum(missingness_pass)) + ' SNPs with missingness >' + str(max_missing) + '%')
@@ -191,10 +373,7 @@ class gtarray(object):
     def compute_info(self):
         if self.freqs is None:
             self.compute_freqs()
-        if self.ndim == 2:
-            self.variances = np.var(self.gts, axis=0)
-        elif self.ndim==3:
-            self.variances = np.var(self.gts[:,0,:], axis=0)
+        self.variances = self.nan_stats(index=0)[1]
         self.info = self.variances/(2.0*self.freqs*(1-self.freqs))
 
     def filter_info(self, min_info = 0.99, verbose=False):
@@ -209,20 +388,24 @@ class gtarray(object):
         """
         Keep only individuals with ids given by keep_ids
         """
-        in_ids = np.array([x in self.id_dict for x in keep_ids])
+        indices = self.id_dict.get_indexer(keep_ids)
+        in_ids = indices >= 0
         n_filtered = np.sum(in_ids)
         if n_filtered==0:
             raise(ValueError('No individuals would be left after filtering'))
         else:
             if verbose:
                 print('After filtering, '+str(n_filtered)+' individuals remain')
-            indices = np.array([self.id_dict[x] for x in keep_ids[in_ids]])
+            indices = indices[in_ids]
             if self.ndim == 2:
                 self.gts = self.gts[indices, :]
             elif self.ndim == 3:
                 self.gts = self.gts[indices, :, :]
+            if self.missing is not None:
+                missing = np.unpackbits(self.missing, axis=0, count=self.ids.shape[0])[indices]
+                self.missing = np.packbits(missing, axis=0)
             self.ids = self.ids[indices]
-            self.id_dict = make_id_dict(self.ids)
+            self.id_dict = id_index(self.ids)
             self.shape = self.gts.shape
             if self.fams is not None:
                 self.fams = self.fams[indices]
@@ -232,32 +415,34 @@ class gtarray(object):
         This normalises the SNPs/PGS columns to have mean-zero.
         """
         if not self.mean_normalised:
-            if self.gts.ndim == 2:
-                self.gts = self.gts - ma.mean(self.gts,axis=0)
-            elif self.gts.ndim==3:
-                for i in range(0, self.gts.shape[1]):
-                    self.gts[:, i, :] = self.gts[:, i, :] - ma.mean(self.gts[:, i, :], axis=0)
+            means = self.nan_stats()[0]
+            self.gts -= means.astype(self.dtype)
             self.mean_normalised = True
 
     def scale(self):
         """
         This normalises the SNPs/PGS columns to have variance 1.
         """
-        if self.gts.ndim == 2:
-            self.gts = self.gts/ma.std(self.gts, axis=0)
-        elif self.gts.ndim == 3:
-            for i in range(0, self.gts.shape[1]):
-                self.gts[:, i, :] = self.gts[:, i, :]/ma.std(self.gts[:, i, :], axis=0)
+        variances = self.nan_stats()[1]
+        self.gts /= np.sqrt(variances).astype(self.dtype)
 
     def fill_NAs(self):
         """
-        This normalises the SNP columns to have mean-zero, then fills in NA values with zero.
+        This normalises the SNP columns to have mean-zero, then fills in NA values with zero. The filled in values are recorded
+        in the bit-packed missingness mask (see mask).
         """
         if not self.mean_normalised:
             self.mean_normalise()
-        NAs = np.sum(self.gts.mask, axis=0)
-        self.gts[self.gts.mask] = 0
-        self.gts.mask = False
+        x = as_3d(self.gts)
+        missing = np.zeros(((x.shape[0]+7)//8,)+x.shape[1:], dtype=np.uint8)
+        NAs = fill_nans(x, missing, is_snp_major(x))
+        if self.ndim == 2:
+            NAs = NAs[0]
+            missing = missing[:, 0, :]
+        if self.missing is None:
+            self.missing = missing
+        else:
+            self.missing |= missing
         self.has_NAs = False
         return NAs
 
@@ -283,11 +468,13 @@ class gtarray(object):
                 raise ValueError('Arrays must have same dimensions (apart from first)')
 
         # Match IDs
-        common_ids = list(self.id_dict.keys() & garray.id_dict.keys())
-        if len(common_ids) == 0:
+        self_ids = self.id_dict.keys()
+        other_index = garray.id_dict.get_indexer(self_ids)
+        in_other = other_index >= 0
+        if np.sum(in_other) == 0:
             raise ValueError('No IDs in common')
-        self_index = np.array([self.id_dict[x] for x in common_ids])
-        other_index = np.array([garray.id_dict[x] for x in common_ids])
+        self_index = self.id_dict.get_indexer(self_ids[in_other])
+        other_index = other_index[in_other]
 
         # Out
         if self.ids.ndim == 1:
@@ -302,30 +489,21 @@ class gtarray(object):
 
         return gtarray(add_gts, ids_out, self.sid, alleles=self.alleles, fams=self.fams[self_index])
 
-    def diagonalise(self,inv_root):
+    def diagonalise(self,inv_root,fam_indices=None,famsize_indices=None):
         """
         This will transform the genotype array based on the inverse square root of the phenotypic covariance matrix
-        from the family based linear mixed model.
+        from the family based linear mixed model. The families can be given by the indices of their members, either
+        in fam_indices (see get_fam_indices) or grouped by family size in famsize_indices (see get_famsize_indices),
+        if they have already been computed.
         """
         if self.fams is None:
             raise(ValueError('Family labels needed for diagonalization'))
         if not self.mean_normalised:
             self.mean_normalise()
-        unique_fams, famsizes = np.unique(self.fams, return_counts = True)
-        fam_indices = dict()
+        if famsize_indices is None:
+            if fam_indices is None:
+                famsize_indices = get_famsize_indices(self.fams)
+            else:
+                famsize_indices = get_famsize_indices(fam_indices)
         # Transform
-        for fam in unique_fams:
-            fam_indices[fam] = np.where(self.fams == fam)[0]
-            famsize = fam_indices[fam].shape[0]
-            if self.ndim == 2:
-                if famsize == 1:
-                    self.gts[fam_indices[fam], :] = inv_root[1]*self.gts[fam_indices[fam],:]
-                else:
-                    self.gts[fam_indices[fam],:] = inv_root[famsize].dot(self.gts[fam_indices[fam],:])
-            elif self.ndim == 3:
-                if famsize == 1:
-                    self.gts[fam_indices[fam], : , :] = inv_root[1]*self.gts[fam_indices[fam], : , :]
-                else:
-                    for j in range(self.shape[1]):
-                        self.gts[fam_indices[fam],j, :] = inv_root[famsize].dot(self.gts[fam_indices[fam],j, :])
-        self.fam_indices = fam_indices
+        transform_families(inv_root, self.gts, famsize_indices)
@@ -1,14 +1,23 @@
 import h5py
+import gzip
+import copy
+import re
+import glob
+import shutil
+import os
 import numpy as np
-from bgen_reader import open_bgen
-from pysnptools.snpreader import Bed
+import queue
+import threading
+import multiprocessing
+from os import path
 from scipy.stats import chi2
 from math import log10
 import snipar.read as read
 import snipar.lmm as lmm
 from snipar.utilities import *
-from numba import njit, prange
-from snipar.preprocess import find_par_gts
+from numba import njit, prange, set_num_threads
+from numba import config as numba_config
+from snipar.gtarray import gtarray, get_famsize_indices, transform_families
 
 def transform_phenotype(inv_root, y, fam_indices, null_mean = None):
     """
@@ -21,16 +30,12 @@ def transform_phenotype(inv_root, y, fam_indices, null_mean = None):
     else:
         y = y - null_mean
     # Transform by family
-    for fam in fam_indices.keys():
-        famsize = fam_indices[fam].shape[0]
-        if famsize == 1:
-            y[fam_indices[fam]] = inv_root[1] * y[fam_indices[fam]]
-        else:
-            y[fam_indices[fam]] = inv_root[famsize].dot(y[fam_indices[fam]])
+    transform_families(inv_root, y, get_famsize_indices(fam_indices))
     return y
 
-@njit(parallel=True)
-def fit_models(y,G):
+@njit(parallel=True, nogil=True)
+def fit_models_missing(y,G):
+    """Fit the model for each SNP separately, using only the individuals without missing values for that SNP"""
     alpha = np.zeros((G.shape[2],G.shape[1]),dtype=np.float_)
     alpha_cov = np.zeros((G.shape[2],G.shape[1],G.shape[1]),dtype=np.float_)
     for i in prange(G.shape[2]):
@@ -41,46 +46,401 @@ def fit_models(y,G):
         alpha_cov[i,:,:] = np.linalg.inv(xtx)
     return alpha, alpha_cov
 
-@njit(parallel=True)
+@njit(parallel=True, nogil=True)
+def invert_small(A):
+    """Invert each matrix in a stack of small symmetric positive definite matrices, [L x k x k], by Gauss-Jordan elimination.
+    Singular matrices give NaN inverses"""
+    k = A.shape[1]
+    A_inv = np.zeros(A.shape,dtype=np.float_)
+    for i in prange(A.shape[0]):
+        M = A[i].copy()
+        inv = np.eye(k)
+        for j in range(k):
+            pivot = M[j,j]
+            if not pivot > 0:
+                inv[:] = np.nan
+                break
+            for c in range(k):
+                M[j,c] /= pivot
+                inv[j,c] /= pivot
+            for r in range(k):
+                if r != j:
+                    factor = M[r,j]
+                    for c in range(k):
+                        M[r,c] -= factor*M[j,c]
+                        inv[r,c] -= factor*inv[j,c]
+        A_inv[i] = inv
+    return A_inv
+
+# Size (bytes) of the chunks of genotypes cast to float64 by fit_models
+fit_chunk_bytes = 2**26
+
+def fit_models(y,G):
+    """Fit the regression of y on the family genotypes of each SNP.
+
+    The cross products for all SNPs are computed together, in a batched matrix product or a single einsum depending on the memory layout of G,
+    and the [k x k] matrices are inverted by invert_small, the same inverse giving the estimate and its covariance. SNPs with missing values are fitted separately using only the individuals without missing values.
+    Several phenotypes can be fitted at once, sharing X'X and its inverse.
+
+    Args:
+        y : :class:`~numpy:numpy.array`
+            transformed phenotype vector of length N, or [N x P] matrix of P transformed phenotypes
+        G : :class:`~numpy:numpy.array`
+            [N x k x L] transformed family genotype array, with NaN for missing values
+
+    Returns:
+        alpha : :class:`~numpy:numpy.array`
+            [L x k] estimates, or [L x k x P] if y is a matrix
+        alpha_cov : :class:`~numpy:numpy.array`
+            [L x k x k] sampling covariance matrices of the estimates, up to the residual variance of each phenotype
+    """
+    Y = y.reshape((y.shape[0],-1))
+    if G.strides[2] > G.strides[0]:
+        # Genotypes of each SNP are contiguous (as read from bed/bgen): one [k x N] by [N x k] product per SNP.
+        # The genotypes are cast to float64 a chunk of SNPs at a time, so that the products accumulate in float64 without a float64 copy of G
+        G_snps = G.transpose(2,0,1)
+        xtx = np.zeros((G.shape[2],G.shape[1],G.shape[1]),dtype=np.float_)
+        xty = np.zeros((G.shape[2],G.shape[1],Y.shape[1]),dtype=np.float_)
+        chunk = max(1,fit_chunk_bytes//(G.shape[0]*G.shape[1]*np.dtype(np.float_).itemsize))
+        for start in range(0,G.shape[2],chunk):
+            G_chunk = G_snps[start:(start+chunk)].astype(np.float_)
+            xtx[start:(start+chunk)] = np.matmul(G_chunk.transpose(0,2,1),G_chunk)
+            xty[start:(start+chunk)] = np.matmul(G_chunk.transpose(0,2,1),Y)
+    else:
+        xtx = np.einsum('ijl,ikl->ljk',G,G,dtype=np.float_)
+        xty = np.einsum('ijl,ip->ljp',G,Y,dtype=np.float_)
+    # NaNs in G propagate to the diagonal of X'X
+    has_na = np.any(np.isnan(np.diagonal(xtx,axis1=1,axis2=2)),axis=1)
+    alpha_cov = invert_small(xtx)
+    alpha = np.matmul(alpha_cov,xty)
+    if np.any(has_na):
+        G_na = G[:,:,has_na]
+        for p in range(Y.shape[1]):
+            alpha_na, alpha_cov[has_na] = fit_models_missing(Y[:,p],G_na)
+            alpha[has_na,:,p] = alpha_na
+    if y.ndim == 1:
+        alpha = alpha[:,:,0]
+    return alpha, alpha_cov
+
+@njit(parallel=True, nogil=True)
 def compute_ses(alpha_cov):
     alpha_ses = np.zeros((alpha_cov.shape[0],alpha_cov.shape[1]),dtype=np.float_)
     for i in prange(alpha_cov.shape[0]):
         alpha_ses[i,:] = np.sqrt(np.diag(alpha_cov[i,:,:]))
     return alpha_ses
 
+class hdf5_sumstats_writer(object):
+    """Write summary statistics to an HDF5 file, one batch of SNPs at a time. Each batch is committed to the file as soon as it is written,
+    and the file records which batches have been completed, so that an interrupted analysis can be resumed. The file also stores the
+    null model parameters.
+
+    Args:
+        outfile : :class:`str`
+            path to output file
+        chrom, snp_ids, pos : :class:`~numpy:numpy.array`
+            chromosomes, IDs, and positions of the SNPs
+        alleles : :class:`~numpy:numpy.array`
+            [L x 2] matrix of ref and alt alleles for the SNPs
+        parsum : :class:`bool`
+            whether the sum of paternal and maternal genotypes was fitted
+        sib : :class:`bool`
+            whether the sibling effect was fitted
+        sigma2 : :class:`float`
+            residual variance in the null model
+        tau : :class:`float`
+            ratio of residual variance to family variance in the null model
+        batch_bounds : :class:`~numpy:numpy.array`
+            [start, end) indices of the batches of SNPs (see :func:`compute_batch_boundaries`)
+        null_alpha : :class:`~numpy:numpy.array`
+            fixed effects (intercept and covariates) of the null model, if covariates were fitted
+        resume : :class:`bool`
+            if the output file already exists, keep the batches already completed rather than overwriting it
+        snp_range : :class:`tuple`
+            for a shard of the SNPs of a chromosome, the [start, end) indices of the shard and the number of SNPs in the chromosome,
+            recorded as the attributes snp_start, snp_end, and chrom_nsnp (see :func:`merge_shards`)
+
+    Returns:
+        writer : :class:`snipar.gwas.hdf5_sumstats_writer`
+
+    """
+    def __init__(self, outfile, chrom, snp_ids, pos, alleles, parsum, sib, sigma2, tau, batch_bounds, null_alpha=None,
+                 resume=False, snp_range=None):
+        outbim = encode_str_array(np.column_stack((chrom,snp_ids,pos,alleles)))
+        outcols = ['direct']
+        if sib:
+            outcols.append('sib')
+        if parsum:
+            outcols.append('avg_NTC')
+        else:
+            outcols = outcols + ['paternal','maternal']
+        outcols = encode_str_array(np.array(outcols))
+        if resume and path.exists(outfile):
+            self.outfile = h5py.File(outfile, 'r+')
+            if 'completed_batches' not in self.outfile or not np.array_equal(np.array(self.outfile['batch_bounds']), batch_bounds) or \
+                    not np.array_equal(np.array(self.outfile['bim']), outbim) or not np.array_equal(np.array(self.outfile['estimate_cols']), outcols):
+                self.outfile.close()
+                raise(ValueError(outfile+' does not match this analysis and cannot be resumed. Remove it or run without --resume'))
+            print('Resuming from '+outfile+': '+str(np.sum(self.completed))+' of '+str(batch_bounds.shape[0])+' batches completed')
+            return
+        print('Writing output to ' + outfile)
+        self.outfile = h5py.File(outfile, 'w')
+        self.outfile['bim'] = outbim
+        X_length = len(outcols)
+        self.outfile.create_dataset('estimate_covariance', (snp_ids.shape[0], X_length, X_length), dtype='f', chunks=True,
+                                    compression='gzip', compression_opts=9, fillvalue=np.nan)
+        self.outfile.create_dataset('estimate', (snp_ids.shape[0], X_length), dtype='f', chunks=True, compression='gzip',
+                                    compression_opts=9, fillvalue=np.nan)
+        self.outfile.create_dataset('estimate_ses', (snp_ids.shape[0], X_length), dtype='f', chunks=True, compression='gzip',
+                                    compression_opts=9, fillvalue=np.nan)
+        self.outfile.create_dataset('freqs', (snp_ids.shape[0],), dtype='f', fillvalue=np.nan)
+        self.outfile['estimate_cols'] = outcols
+        self.outfile['sigma2'] = sigma2
+        self.outfile['tau'] = tau
+        if null_alpha is not None:
+            self.outfile['null_alpha'] = null_alpha
+        self.outfile['batch_bounds'] = batch_bounds
+        self.outfile['completed_batches'] = np.zeros(batch_bounds.shape[0], dtype=bool)
+        if snp_range is not None:
+            self.outfile.attrs['snp_start'], self.outfile.attrs['snp_end'], self.outfile.attrs['chrom_nsnp'] = snp_range
+        self.outfile.flush()
+
+    @property
+    def completed(self):
+        return np.array(self.outfile['completed_batches'])
+
+    def read_batch(self, batch):
+        """Read the summary statistics of a completed batch, given as a slice of the SNPs"""
+        return np.array(self.outfile['estimate'][batch]), np.array(self.outfile['estimate_ses'][batch]), \
+               np.array(self.outfile['estimate_covariance'][batch]), np.array(self.outfile['freqs'][batch])
+
+    def write_batch(self, i, batch, alpha, alpha_ses, alpha_cov, freqs):
+        """Write the summary statistics of batch i, given as a slice of the SNPs, and mark the batch as completed"""
+        self.outfile['estimate'][batch] = alpha
+        self.outfile['estimate_ses'][batch] = alpha_ses
+        self.outfile['estimate_covariance'][batch] = alpha_cov
+        self.outfile['freqs'][batch] = freqs
+        self.outfile.flush()
+        self.outfile['completed_batches'][i] = True
+        self.outfile.flush()
+
+    def close(self, complete=False):
+        """Close the file. If complete, record that all outputs for the chromosome have been written"""
+        if complete:
+            self.outfile.attrs['complete'] = True
+        self.outfile.close()
+
+def sumstats_complete(outfile):
+    """Check whether an HDF5 summary statistics file records that all outputs for the chromosome have been written"""
+    if not path.exists(outfile):
+        return False
+    with h5py.File(outfile, 'r') as f:
+        return bool(f.attrs.get('complete', False))
+
+def read_null_model(outfile):
+    """Read the null model parameters (sigma2, tau, and null_alpha, which is None if no covariates were fitted) stored in an HDF5 summary statistics file"""
+    with h5py.File(outfile, 'r') as f:
+        null_alpha = np.array(f['null_alpha']) if 'null_alpha' in f else None
+        return float(np.array(f['sigma2'])), float(np.array(f['tau'])), null_alpha
+
+def null_model_file(prefix, phen_label=None):
+    """Path of the file storing the null model of a phenotype (see :func:`write_null_model`)"""
+    if phen_label is not None:
+        return prefix+'.'+phen_label+'.null.hdf5'
+    return prefix+'.null.hdf5'
+
+def write_null_model(filename, y, sigma2, tau, null_alpha, checksums):
+    """Write the null model of a phenotype to an HDF5 file: the variance components, the fixed effects of the covariates, and the residualised
+    and transformed phenotype with its IDs and family labels. The checksums of the inputs (a dictionary of strings) are stored as attributes,
+    and must match when the null model is loaded (see :func:`load_null_model`).
+    """
+    with h5py.File(filename, 'w') as f:
+        f['y'] = np.array(y.gts[:,0])
+        f['ids'] = encode_str_array(y.ids)
+        f['fams'] = encode_str_array(y.fams)
+        f['sigma2'] = sigma2
+        f['tau'] = tau
+        if null_alpha is not None:
+            f['null_alpha'] = null_alpha
+        for key in checksums:
+            f.attrs[key] = checksums[key]
+
+def load_null_model(filename, checksums):
+    """Load a null model written by :func:`write_null_model`, checking that it was fitted to inputs with the given checksums.
+
+    Returns:
+        y : :class:`snipar.gtarray`
+            transformed phenotype, adjusted for covariates, with family labels (y.fams)
+        tau : :class:`float`
+        sigma2 : :class:`float`
+        null_alpha : :class:`~numpy:numpy.array`
+            fixed effects of the null model (None if no covariates)
+    """
+    with h5py.File(filename, 'r') as f:
+        for key in checksums:
+            if f.attrs.get(key) != checksums[key]:
+                raise(ValueError('The '+key+' does not match that used to fit the null model in '+filename))
+        y = gtarray(np.array(f['y']).reshape((-1, 1)), convert_str_array(f['ids']), fams=convert_str_array(f['fams']))
+        y.mean_normalised = True
+        null_alpha = np.array(f['null_alpha']) if 'null_alpha' in f else None
+        return y, float(np.array(f['tau'])), float(np.array(f['sigma2'])), null_alpha
+
 def write_output(chrom, snp_ids, pos, alleles, outfile, parsum, sib, alpha, alpha_ses, alpha_cov, sigma2, tau, freqs):
     """
     Write fitted SNP effects and other parameters to output HDF5 file.
     """
-    print('Writing output to ' + outfile)
-    outfile = h5py.File(outfile, 'w')
-    outbim = np.column_stack((chrom,snp_ids,pos,alleles))
-    outfile['bim'] = encode_str_array(outbim)
-    X_length = 1
-    outcols = ['direct']
-    if sib:
-        X_length += 1
-        outcols.append('sib')
-    if parsum:
-        X_length += 1
-        outcols.append('avg_NTC')
+    batch_bounds = compute_batch_boundaries(snp_ids, snp_ids.shape[0])
+    writer = hdf5_sumstats_writer(outfile, chrom, snp_ids, pos, alleles, parsum, sib, sigma2, tau, batch_bounds)
+    writer.write_batch(0, slice(0, snp_ids.shape[0]), alpha, alpha_ses, alpha_cov, freqs)
+    writer.close(complete=True)
+
+def sumstats_outfile(outprefix, chrom_out, suffix, phen_label=None, shard=None):
+    if shard is not None:
+        suffix = '.'+shard+suffix
+    if phen_label is not None:
+        suffix = '.'+phen_label+suffix
+    if chrom_out==0:
+        return outfile_name(outprefix, suffix)
     else:
-        X_length += 2
-        outcols = outcols + ['paternal','maternal']
-    outfile.create_dataset('estimate_covariance', (snp_ids.shape[0], X_length, X_length), dtype='f', chunks=True,
-                           compression='gzip', compression_opts=9)
-    outfile.create_dataset('estimate', (snp_ids.shape[0], X_length), dtype='f', chunks=True, compression='gzip',
-                           compression_opts=9)
-    outfile.create_dataset('estimate_ses', (snp_ids.shape[0], X_length), dtype='f', chunks=True, compression='gzip',
-                           compression_opts=9)
-    outfile['estimate'][:] = alpha
-    outfile['estimate_cols'] = encode_str_array(np.array(outcols))
-    outfile['estimate_ses'][:] = alpha_ses
-    outfile['estimate_covariance'][:] = alpha_cov
-    outfile['sigma2'] = sigma2
-    outfile['tau'] = tau
-    outfile['freqs'] = freqs
-    outfile.close()
+        return outfile_name(outprefix, suffix, chrom=chrom_out)
+
+def shard_label(shard=None, snp_start=None, snp_end=None):
+    """Label of the output files of a shard of the SNPs of a chromosome: 'shard<k>of<n>' for the k'th of n shards, or 'snps<start>-<end>'
+    for a range of SNP indices. None if the SNPs are not sharded."""
+    if shard is not None:
+        return 'shard'+str(shard[0])+'of'+str(shard[1])
+    if snp_start is not None or snp_end is not None:
+        start = 0 if snp_start is None else snp_start
+        end = 'end' if snp_end is None else str(snp_end)
+        return 'snps'+str(start)+'-'+end
+    return None
+
+def shard_bounds(nsnp, shard=None, snp_start=None, snp_end=None):
+    """[start, end) indices of the SNPs of a shard of a chromosome with nsnp SNPs (after removing duplicates). If shard=(k, n),
+    the SNPs are split into n contiguous shards of (nearly) equal size, and the bounds of the k'th (counting from 1) are returned.
+    Otherwise, the bounds are given by snp_start (default 0) and snp_end (default nsnp)."""
+    if shard is not None:
+        k, n = shard
+        if n < 1 or not 1 <= k <= n:
+            raise(ValueError('Invalid shard '+str(k)+'/'+str(n)+': must be k/n with 1<=k<=n'))
+        return (k-1)*nsnp//n, k*nsnp//n
+    start = 0 if snp_start is None else snp_start
+    end = nsnp if snp_end is None else min(snp_end, nsnp)
+    if start < 0 or (snp_end is not None and snp_end < start):
+        raise(ValueError('Invalid SNP range: '+str(snp_start)+' to '+str(snp_end)))
+    start = min(start, nsnp)
+    return start, max(start, end)
+
+# Labels of shards, as given by shard_label
+shard_pattern = re.compile(r'shard\d+of\d+|snps\d+-(?:\d+|end)')
+
+def find_shards(outprefix, chrom_out, phen_label=None):
+    """Find the HDF5 summary statistics files of the shards of a chromosome (see :func:`shard_label`). Returns a dictionary
+    mapping the labels of the shards to the files."""
+    stem = sumstats_outfile(outprefix, chrom_out, '', phen_label=phen_label)
+    shards = {}
+    for filename in glob.glob(glob.escape(stem)+'.*.sumstats.hdf5'):
+        label = filename[(len(stem)+1):-len('.sumstats.hdf5')]
+        if shard_pattern.fullmatch(label) is not None:
+            shards[label] = filename
+    return shards
+
+def find_shard_phenotypes(outprefix, chrom_out):
+    """Phenotype labels of the shards of a chromosome (see :func:`find_shards`), with None for shards of a single phenotype"""
+    stem = sumstats_outfile(outprefix, chrom_out, '')
+    pattern = re.compile(r'(?:(.+)\.)?(?:'+shard_pattern.pattern+')')
+    phen_labels = set()
+    for filename in glob.glob(glob.escape(stem)+'.*.sumstats.hdf5'):
+        match = pattern.fullmatch(filename[(len(stem)+1):-len('.sumstats.hdf5')])
+        if match is not None:
+            phen_labels.add(match.group(1))
+    return sorted(phen_labels, key=lambda x: '' if x is None else x)
+
+def merge_shards(outprefix, chrom_out, phen_label=None, remove=False):
+    """Merge the summary statistics of the shards of a chromosome (written by :func:`process_chromosome` with shard or snp_start/snp_end)
+    into the HDF5 and gzipped text summary statistics files of the whole chromosome. All shards must be complete, and together cover
+    the SNPs of the chromosome without gaps or overlaps. The text output is merged if every shard has text output.
+
+    Args:
+        outprefix, chrom_out, phen_label :
+            as given to :func:`process_chromosome`
+        remove : :class:`bool`
+            remove the files of the shards after merging them. Default False.
+
+    Returns:
+        outfiles : :class:`list`
+            the merged files
+    """
+    shards = find_shards(outprefix, chrom_out, phen_label=phen_label)
+    if len(shards) == 0:
+        raise(ValueError('No shards found for chromosome '+str(chrom_out)))
+    ranges = {}
+    for label in shards:
+        with h5py.File(shards[label], 'r') as f:
+            if not f.attrs.get('complete', False):
+                raise(ValueError(shards[label]+' is not complete'))
+            ranges[label] = (int(f.attrs['snp_start']), int(f.attrs['snp_end']), int(f.attrs['chrom_nsnp']))
+    labels = sorted(shards.keys(), key=lambda x: ranges[x][0:2])
+    # Check the shards tile the chromosome
+    nsnp = ranges[labels[0]][2]
+    end = 0
+    for label in labels:
+        if ranges[label][2] != nsnp:
+            raise(ValueError('Shards of chromosome '+str(chrom_out)+' were run on different SNPs: '+shards[labels[0]]+' has '+
+                             str(nsnp)+' SNPs but '+shards[label]+' has '+str(ranges[label][2])))
+        if ranges[label][0] > end:
+            raise(ValueError('Gap in shards of chromosome '+str(chrom_out)+': no shard has SNPs '+str(end)+' to '+str(ranges[label][0])))
+        if ranges[label][0] < end:
+            raise(ValueError('Overlapping shards of chromosome '+str(chrom_out)+': '+shards[label]+' starts at SNP '+
+                             str(ranges[label][0])+' before the end of the previous shard at SNP '+str(end)))
+        end = ranges[label][1]
+    if end < nsnp:
+        raise(ValueError('Gap in shards of chromosome '+str(chrom_out)+': no shard has SNPs '+str(end)+' to '+str(nsnp)))
+    # Merge HDF5 output
+    hdf5_outfile = sumstats_outfile(outprefix, chrom_out, '.sumstats.hdf5', phen_label=phen_label)
+    shard_files = [h5py.File(shards[label], 'r') for label in labels]
+    try:
+        bim = convert_str_array(np.vstack([np.array(f['bim']) for f in shard_files]))
+        estimate_cols = np.array(shard_files[0]['estimate_cols'])
+        sigma2, tau = np.array(shard_files[0]['sigma2']), np.array(shard_files[0]['tau'])
+        for f in shard_files[1:]:
+            if not np.array_equal(np.array(f['estimate_cols']), estimate_cols) or np.array(f['sigma2']) != sigma2 or np.array(f['tau']) != tau:
+                raise(ValueError('Shards of chromosome '+str(chrom_out)+' were run with different models: '+f.filename))
+        estimate_cols = convert_str_array(estimate_cols)
+        null_alpha = np.array(shard_files[0]['null_alpha']) if 'null_alpha' in shard_files[0] else None
+        batch_bounds = np.array([ranges[label][0:2] for label in labels], dtype=int)
+        writer = hdf5_sumstats_writer(hdf5_outfile, bim[:, 0], bim[:, 1], bim[:, 2], bim[:, 3:5], 'avg_NTC' in estimate_cols,
+                                      'sib' in estimate_cols, sigma2, tau, batch_bounds, null_alpha=null_alpha)
+        for i in range(len(shard_files)):
+            writer.write_batch(i, slice(batch_bounds[i, 0], batch_bounds[i, 1]), np.array(shard_files[i]['estimate']),
+                               np.array(shard_files[i]['estimate_ses']), np.array(shard_files[i]['estimate_covariance']),
+                               np.array(shard_files[i]['freqs']))
+        writer.close(complete=True)
+    finally:
+        for f in shard_files:
+            f.close()
+    outfiles = [hdf5_outfile]
+    merged = [shards[label] for label in labels]
+    # Merge text output, keeping the header of the first shard
+    txt_shards = [sumstats_outfile(outprefix, chrom_out, '.sumstats.gz', phen_label=phen_label, shard=label) for label in labels]
+    has_txt = [path.exists(x) for x in txt_shards]
+    if all(has_txt):
+        txt_outfile = sumstats_outfile(outprefix, chrom_out, '.sumstats.gz', phen_label=phen_label)
+        print('Writing text output to '+txt_outfile)
+        with gzip.open(txt_outfile, 'wb') as out_f:
+            for i in range(len(txt_shards)):
+                with gzip.open(txt_shards[i], 'rb') as shard_f:
+                    header = shard_f.readline()
+                    if i == 0:
+                        out_f.write(header)
+                    shutil.copyfileobj(shard_f, out_f)
+        outfiles.append(txt_outfile)
+        merged += txt_shards
+    elif any(has_txt):
+        print('Warning: not all shards of chromosome '+str(chrom_out)+' have text output. Text output not merged')
+    if remove:
+        for filename in merged:
+            os.remove(filename)
+    return outfiles
 
 def outarray_effect(est, ses, freqs, vy):
     N_effective = vy/(2*freqs*(1-freqs)*np.power(ses,2))
@@ -91,66 +451,108 @@ def outarray_effect(est, ses, freqs, vy):
     array_out[:,0] = np.round(array_out[:,0], 0)
     return array_out
 
-def write_txt_output(chrom, snp_ids, pos, alleles, outfile, parsum, sib, alpha, alpha_cov, sigma2, tau, freqs):
-    outbim = np.column_stack((chrom, snp_ids, pos, alleles,np.round(freqs,3)))
-    header = ['chromosome','SNP','pos','A1','A2','freq']
-    # Which effects to estimate
-    effects = ['direct']
-    if sib:
-        effects.append('sib')
-    if not parsum:
-        effects += ['paternal','maternal']
-    effects += ['avg_NTC','population']
-    effects = np.array(effects)
-    if not parsum:
-        paternal_index = np.where(effects=='paternal')[0][0]
-        maternal_index = np.where(effects=='maternal')[0][0]
-    avg_NTC_index = np.where(effects=='avg_NTC')[0][0]
-    population_index = avg_NTC_index+1
-    # Get transform matrix
-    A = np.zeros((len(effects),alpha.shape[1]))
-    A[0:alpha.shape[1],0:alpha.shape[1]] = np.identity(alpha.shape[1])
-    if not parsum:
-        A[alpha.shape[1]:(alpha.shape[1]+2), :] = 0.5
-        A[alpha.shape[1], 0] = 0
-        A[alpha.shape[1]+1, 0] = 1
-    else:
-        A[alpha.shape[1], :] = 1
-    # Transform effects
-    alpha = alpha.dot(A.T)
-    alpha_ses_out = np.zeros((alpha.shape[0],A.shape[0]))
-    corrs = ['r_direct_avg_NTC','r_direct_population']
-    if sib:
-        corrs.append('r_direct_sib')
-    if not parsum:
-        corrs.append('r_paternal_maternal')
-    ncor = len(corrs)
-    alpha_corr_out = np.zeros((alpha.shape[0],ncor))
-    for i in range(alpha_cov.shape[0]):
-        alpha_cov_i = A.dot(alpha_cov[i,:,:].dot(A.T))
-        alpha_ses_out[i,:] = np.sqrt(np.diag(alpha_cov_i))
+class txt_sumstats_writer(object):
+    """Write summary statistics to a gzipped text file, one batch of SNPs at a time. Besides the fitted effects, the text output has
+    the average NTC and population effects, which are linear transforms of the fitted effects, and correlations between the effects.
+
+    Args:
+        outfile : :class:`str`
+            path to output file
+        parsum : :class:`bool`
+            whether the sum of paternal and maternal genotypes was fitted
+        sib : :class:`bool`
+            whether the sibling effect was fitted
+        sigma2 : :class:`float`
+            residual variance in the null model
+        tau : :class:`float`
+            ratio of residual variance to family variance in the null model
+
+    Returns:
+        writer : :class:`snipar.gwas.txt_sumstats_writer`
+
+    """
+    def __init__(self, outfile, parsum, sib, sigma2, tau):
+        self.sib = sib
+        self.parsum = parsum
+        self.vy = (1+1/tau)*sigma2
+        # Which effects to estimate
+        effects = ['direct']
+        if sib:
+            effects.append('sib')
+        if not parsum:
+            effects += ['paternal','maternal']
+        effects += ['avg_NTC','population']
+        self.effects = np.array(effects)
+        if not parsum:
+            self.paternal_index = np.where(self.effects=='paternal')[0][0]
+            self.maternal_index = np.where(self.effects=='maternal')[0][0]
+        self.avg_NTC_index = np.where(self.effects=='avg_NTC')[0][0]
+        self.population_index = self.avg_NTC_index+1
+        # Get transform matrix
+        alpha_dim = 2+int(sib)
+        if not parsum:
+            alpha_dim += 1
+        A = np.zeros((len(effects),alpha_dim))
+        A[0:alpha_dim,0:alpha_dim] = np.identity(alpha_dim)
+        if not parsum:
+            A[alpha_dim:(alpha_dim+2), :] = 0.5
+            A[alpha_dim, 0] = 0
+            A[alpha_dim+1, 0] = 1
+        else:
+            A[alpha_dim, :] = 1
+        self.A = A
+        self.corrs = ['r_direct_avg_NTC','r_direct_population']
+        if sib:
+            self.corrs.append('r_direct_sib')
+        if not parsum:
+            self.corrs.append('r_paternal_maternal')
+        header = ['chromosome','SNP','pos','A1','A2','freq']
+        for effect in effects:
+            header += [effect+'_N',effect+'_Beta',effect+'_SE',effect+'_Z',effect+'_log10_P']
+        header += self.corrs
+        print('Writing text output to '+outfile)
+        self.outfile = gzip.open(outfile, 'wt', compresslevel=6)
+        self.outfile.write(' '.join(header)+'\n')
+
+    def write(self, chrom, snp_ids, pos, alleles, alpha, alpha_cov, freqs):
+        """Transform the fitted effects of a batch of SNPs and append them to the output file"""
+        # Transform effects
+        A = self.A
+        alpha = alpha.dot(A.T)
+        alpha_cov = np.matmul(A, np.matmul(np.asarray(alpha_cov, dtype=np.float_), A.T))
+        alpha_ses_out = np.sqrt(np.diagonal(alpha_cov, axis1=1, axis2=2))
+        alpha_corr_out = np.zeros((alpha.shape[0],len(self.corrs)))
         # Direct to average NTC
-        alpha_corr_out[i,0] = alpha_cov_i[0,avg_NTC_index]/(alpha_ses_out[i,0]*alpha_ses_out[i,avg_NTC_index])
+        alpha_corr_out[:,0] = alpha_cov[:,0,self.avg_NTC_index]/(alpha_ses_out[:,0]*alpha_ses_out[:,self.avg_NTC_index])
         # Direct to population
-        alpha_corr_out[i,1] = alpha_cov_i[0,population_index]/(alpha_ses_out[i,0]*alpha_ses_out[i,population_index])
+        alpha_corr_out[:,1] = alpha_cov[:,0,self.population_index]/(alpha_ses_out[:,0]*alpha_ses_out[:,self.population_index])
         # Direct to sib
-        if sib:
-            alpha_corr_out[i,2] = alpha_cov_i[0,1]/(alpha_ses_out[i,0]*alpha_ses_out[i,1])
+        if self.sib:
+            alpha_corr_out[:,2] = alpha_cov[:,0,1]/(alpha_ses_out[:,0]*alpha_ses_out[:,1])
         # Paternal to maternal
-        if not parsum:
-            alpha_corr_out[i,ncor-1] = alpha_cov_i[paternal_index,maternal_index]/(alpha_ses_out[i,maternal_index]*alpha_ses_out[i,paternal_index])
-    # Create output array
-    vy = (1+1/tau)*sigma2
-    outstack = [outbim]
-    for i in range(len(effects)):
-        outstack.append(outarray_effect(alpha[:,i],alpha_ses_out[:,i],freqs,vy))
-        header += [effects[i]+'_N',effects[i]+'_Beta',effects[i]+'_SE',effects[i]+'_Z',effects[i]+'_log10_P']
-    outstack.append(np.round(alpha_corr_out,6))
-    header += corrs
-    # Output array
-    outarray = np.row_stack((np.array(header),np.column_stack(outstack)))
-    print('Writing text output to '+outfile)
-    np.savetxt(outfile, outarray, fmt='%s')
+        if not self.parsum:
+            alpha_corr_out[:,-1] = alpha_cov[:,self.paternal_index,self.maternal_index]/(alpha_ses_out[:,self.maternal_index]*alpha_ses_out[:,self.paternal_index])
+        # Format output
+        outstack = [np.column_stack((chrom, snp_ids, pos, alleles)).astype(str), np.round(freqs,3).astype(str)[:,np.newaxis]]
+        numeric = [outarray_effect(alpha[:,i],alpha_ses_out[:,i],freqs,self.vy) for i in range(len(self.effects))]
+        numeric.append(np.round(alpha_corr_out,6))
+        outstack.append(np.column_stack(numeric).astype(str))
+        lines = np.column_stack(outstack).tolist()
+        if len(lines) > 0:
+            self.outfile.write('\n'.join([' '.join(line) for line in lines])+'\n')
+
+    def close(self):
+        self.outfile.close()
+
+def write_txt_output(chrom, snp_ids, pos, alleles, outfile, parsum, sib, alpha, alpha_cov, sigma2, tau, freqs):
+    writer = txt_sumstats_writer(outfile, parsum, sib, sigma2, tau)
+    writer.write(chrom, snp_ids, pos, alleles, alpha, alpha_cov, freqs)
+    writer.close()
+
+def format_memory(nbytes):
+    if nbytes < 1024**3:
+        return str(round(nbytes/1024**2, 1))+'MB'
+    return str(round(nbytes/1024**3, 2))+'GB'
 
 def compute_batch_boundaries(snp_ids,batch_size):
     nsnp = snp_ids.shape[0]
@@ -164,11 +566,194 @@ def compute_batch_boundaries(snp_ids,batch_size):
     block_bounds[n_blocks-1,:] = np.array([start,nsnp])
     return block_bounds
 
-def process_batch(y, pedigree, tau, sigma2, snp_ids=None, bedfile=None, bgenfile=None, par_gts_f=None, parsum=False,
-                  fit_sib=False, max_missing=5, min_maf=0.01, verbose=False, print_sample_info=False):
-    ####### Construct family based genotype matrix #######
-    G = read.get_gts_matrix(ped=pedigree, bedfile=bedfile, bgenfile=bgenfile, par_gts_f=par_gts_f, snp_ids=snp_ids, 
-                                ids=y.ids, parsum=parsum, sib=fit_sib, verbose=verbose, print_sample_info=print_sample_info)
+class phenotype_group(object):
+    """Phenotypes that are analysed on the same individuals with the same transform (see :class:`batch_plan`).
+
+    Args:
+        rows : :class:`~numpy:numpy.array`
+            indices of the individuals in the family design (see :class:`snipar.preprocess.family_design`); None if all individuals
+        fams : :class:`~numpy:numpy.array`
+            family labels of the individuals
+        Y : :class:`~numpy:numpy.array`
+            [N x P] matrix of the transformed phenotypes, all scaled to the transform of the first phenotype
+        tau : :class:`float`
+            ratio of residual variance to family variance in the null model of the first phenotype, used for the transform of the group
+        sigma2 : :class:`float`
+            residual variance in the null model of the first phenotype
+        phenotypes : :class:`list`
+            indices of the phenotypes
+        cov_scale : :class:`~numpy:numpy.array`
+            ratio of the residual variance of each phenotype to sigma2
+        taus : :class:`list`
+            tau of each phenotype, if not all equal to tau. The phenotypes are mapped from their own transforms to the transform of the group
+            (see :meth:`snipar.lmm.model.change_tau`).
+
+    """
+    def __init__(self, rows, fams, Y, tau, sigma2, phenotypes, cov_scale, taus=None):
+        self.rows = rows
+        self.Y = Y
+        self.phenotypes = phenotypes
+        self.cov_scale = cov_scale
+        null_model = lmm.model(Y[:,0], np.ones((Y.shape[0], 1)), fams)
+        self.inv_root = null_model.sigma_inv_root(tau, sigma2)
+        self.famsize_indices = get_famsize_indices(fams)
+        if taus is not None:
+            for j in range(len(phenotypes)):
+                if taus[j] != tau:
+                    transform_families(null_model.change_tau(taus[j], tau), self.Y[:,j], self.famsize_indices)
+
+class batch_plan(object):
+    """Define the parts of the analysis of a chromosome that are the same for every batch of SNPs: the individuals analysed,
+    the indices of their observed genotypes and of their observed/imputed parental genotypes (see :class:`snipar.preprocess.family_design`),
+    their families, their phenotype values, and the inverse square roots of the phenotypic covariance matrices of their families.
+
+    Several phenotypes can be analysed together. The family genotype matrix is then constructed for all individuals with any of the phenotypes,
+    and phenotypes are grouped (see :class:`phenotype_group`) by the individuals with phenotype observations and by tau. Within a group, the
+    transform only differs between phenotypes by a scale factor, so the transformed genotypes and X'X are shared.
+
+    Phenotypes are only grouped if their tau are equal, unless tau_rtol is given, in which case a phenotype joins the first group whose tau
+    (that of the first phenotype in the group) is within a relative tolerance of tau_rtol of its own. Its SNP effects are then estimated
+    with the transform for the tau of the group: the estimates remain unbiased, but their standard errors assume the tau of the group,
+    so they are approximate for phenotypes whose tau differ from it.
+
+    Args:
+        y : :class:`snipar.gtarray` or :class:`list`
+            transformed phenotype with family labels (y.fams), or list of transformed phenotypes. These are filtered to the individuals analysed.
+        pedigree : :class:`~numpy:numpy.array`
+            pedigree array. Not used if par_gts_f is provided, in which case the pedigree is read from par_gts_f.
+        tau : :class:`float` or :class:`list`
+            ratio of residual variance to family variance in the null model (of each phenotype)
+        sigma2 : :class:`float` or :class:`list`
+            residual variance in the null model (of each phenotype)
+        bedfile : :class:`str`
+            path to bed file with observed genotypes
+        bgenfile : :class:`str`
+            path to bgen file with observed genotypes
+        par_gts_f : :class:`str`
+            path to HDF5 file with imputed parental genotypes
+        fit_sib : :class:`bool`
+            include the mean of siblings' genotypes in the design
+        native_bed : :class:`bool`
+            read the bed file with the memory-mapped :class:`snipar.read.bed.bed_reader` rather than pysnptools
+        storefile : :class:`str`
+            path to a family genotype store (see :func:`snipar.read.store.build_store`) to read the genotypes from, in place of the genotype files
+        tau_rtol : :class:`float`
+            relative tolerance for grouping phenotypes by tau. Default 0: only phenotypes with equal tau are grouped.
+
+    Returns:
+        plan : :class:`snipar.gwas.batch_plan`
+
+    """
+    def __init__(self, y, pedigree, tau, sigma2, bedfile=None, bgenfile=None, par_gts_f=None, fit_sib=False, verbose=False, native_bed=False,
+                 storefile=None, tau_rtol=0):
+        ys, taus, sigma2s = (y, tau, sigma2) if isinstance(y, list) else ([y], [tau], [sigma2])
+        self.n_phen = len(ys)
+        ####### Find individuals with observed/imputed parental genotypes #######
+        if self.n_phen == 1:
+            ids = ys[0].ids
+        else:
+            ids = np.concatenate([x.ids for x in ys])
+            ids = ids[np.sort(np.unique(ids, return_index=True)[1])]
+        self.design = read.get_family_design(ped=pedigree, bedfile=bedfile, bgenfile=bgenfile, par_gts_f=par_gts_f,
+                                             ids=ids, sib=fit_sib, verbose=verbose, native_bed=native_bed, storefile=storefile)
+        #### Match phenotypes ####
+        for x in ys:
+            x.filter_ids(self.design.ids)
+        phen_ids = set()
+        for x in ys:
+            phen_ids.update(x.ids)
+        if self.design.ids.shape[0] > len(phen_ids):
+            self.design.filter_ids(np.array(list(phen_ids)))
+        ##### Group phenotypes with the same individuals and tau (within tau_rtol) ######
+        design_dict = id_index(self.design.ids)
+        groups = {}
+        for i in range(self.n_phen):
+            rows = design_dict.get_indexer(ys[i].ids)
+            key = (rows.tobytes(), taus[i])
+            for group_key in groups:
+                if group_key[0] == key[0] and abs(taus[i]-group_key[1]) <= tau_rtol*abs(group_key[1]):
+                    key = group_key
+                    break
+            groups.setdefault(key, []).append((i, rows))
+        self.groups = []
+        for key in groups:
+            phenotypes = [x[0] for x in groups[key]]
+            rows = groups[key][0][1]
+            sigma2 = sigma2s[phenotypes[0]]
+            cov_scale = np.array([sigma2s[i]/sigma2 for i in phenotypes])
+            Y = np.column_stack([np.array(ys[i].gts[:,0])*np.sqrt(cov_scale[j]) for j, i in enumerate(phenotypes)]).astype(np.float32)
+            fams = self.design.fam_labels[rows]
+            if rows.shape[0] == self.design.ids.shape[0]:
+                rows = None
+            group_taus = [taus[i] for i in phenotypes]
+            if all([x == key[1] for x in group_taus]):
+                group_taus = None
+            self.groups.append(phenotype_group(rows, fams, Y, key[1], sigma2, phenotypes, cov_scale, taus=group_taus))
+        # SNPs can be filtered when read if all phenotypes are analysed on the same individuals
+        self.filter_on_read = all([group.rows is None for group in self.groups])
+        if self.n_phen == 1:
+            self.y = self.groups[0].Y[:,0]
+            self.inv_root = self.groups[0].inv_root
+            self.famsize_indices = self.groups[0].famsize_indices
+
+    def fixed_memory(self):
+        """Projected memory, in bytes, of the genotype readers that does not depend on the number of SNPs in a batch: the chunk of
+        probabilities read from .bgen files (see :func:`read.bgen.read_bgen_dosages`), and the cache and decoded column block of the
+        reader of imputed parental genotypes (see :class:`read.imputed.imputed_reader`).
+
+        Returns:
+            fixed_memory : :class:`int`
+        """
+        fixed_memory = 0
+        if self.design.bgenfile is not None:
+            fixed_memory += read.bgen.bgen_chunk_bytes
+        if self.design.par_gts_f is not None:
+            fixed_memory += self.design.imp_reader.fixed_bytes()
+        return fixed_memory
+
+    def snp_memory(self, alpha_dim, prefetch=1):
+        """Projected peak memory, in bytes, for each SNP in a batch: the reader's buffers, the family based genotype matrix of the batch being
+        read and its copy when filtering, the matrices of the batches read ahead, the matrix being fitted and its copies for further phenotype groups,
+        the temporaries of transforming it, and the estimates for each phenotype (see :func:`prefetch_batches` and :func:`fit_batch`).
+
+        Args:
+            alpha_dim : :class:`int`
+                number of columns of the family based genotype matrix
+            prefetch : :class:`int`
+                number of batches read ahead of the batch being fitted
+
+        Returns:
+            snp_memory : :class:`int`
+        """
+        itemsize = np.dtype(np.float32).itemsize
+        G_bytes = self.design.ids.shape[0]*alpha_dim*itemsize
+        if isinstance(self.design, read.store.store_design):
+            # The columns of the family based genotype matrix are read from the store before being copied into the matrix
+            read_bytes = self.design.ids.shape[0]*self.design.columns.shape[0]*self.design.itemsize
+        # Observed genotypes are read as float64 from .bed files by pysnptools, and as float32 by the native reader
+        # and from .bgen files (whose probabilities are read in chunks of fixed size: see read.bgen.read_bgen_dosages)
+        elif self.design.bgenfile is not None:
+            read_bytes = self.design.observed_indices.shape[0]*itemsize
+        elif isinstance(self.design.gts_f, read.bed.bed_reader):
+            read_bytes = self.design.observed_indices.shape[0]*itemsize
+        else:
+            read_bytes = self.design.observed_indices.shape[0]*8
+        if self.design.par_gts_f is not None:
+            read_bytes += self.design.imp_indices.shape[0]*itemsize
+        if self.design.sib and not isinstance(self.design, read.store.store_design):
+            read_bytes += G_bytes
+        read_bytes += 2*G_bytes
+        # Transforming the families (see gtarray.transform_families) gathers the genotypes of the families of each size, which are cast to
+        # float64 when multiplied by the inverse square roots, giving temporaries of up to 5 times the matrix (the gathered copy and the float64
+        # copy and product). These are freed before the fit, whose copy of SNPs with missing values (see fit_models) is at most the size of the matrix.
+        transform_bytes = 5*G_bytes
+        fit_bytes = len(self.groups)*G_bytes+transform_bytes+2*self.n_phen*(2*alpha_dim+2*alpha_dim**2+1)*itemsize
+        if prefetch == 0:
+            return max(read_bytes, fit_bytes)
+        return read_bytes+prefetch*G_bytes+fit_bytes
+
+def filter_batch(G, max_missing=5, min_maf=0.01, verbose=False):
+    """Compute allele frequencies of the SNPs in a family based genotype matrix, and filter the SNPs on MAF and missingness."""
     G.compute_freqs()
     #### Filter SNPs ####
     if verbose:
@@ -179,54 +764,195 @@ def process_batch(y, pedigree, tau, sigma2, snp_ids=None, bedfile=None, bgenfile
     G.filter_missingness(max_missing)
     if verbose:
         print(str(G.shape[2])+' SNPs that pass filters')
-    #### Match phenotype ####
-    y.filter_ids(G.ids)
-    if G.ids.shape[0] > y.ids.shape[0]:
-        G.filter_ids(y.ids)
-    ##### Transform genotypes ######
-    if verbose:
-        print('Transforming genotypes')
-    null_model = lmm.model(y.gts[:,0], np.ones((y.shape[0], 1)), y.fams)
-    L = null_model.sigma_inv_root(tau, sigma2)
-    G.diagonalise(L)
-    ### Fit models for SNPs ###
-    if verbose:
-        print('Estimating SNP effects')
-    alpha, alpha_cov = fit_models(np.array(y.gts[:,0],dtype=np.float32),G.gts)
-    alpha_ses = compute_ses(alpha_cov)
-    return G.freqs, G.sid, alpha, alpha_cov, alpha_ses
+    return G
+
+def read_batch(snp_ids, plan, parsum=False, max_missing=5, min_maf=0.01, verbose=False):
+    """Read the observed and imputed parental genotypes of a batch of SNPs, construct the family based genotype matrix,
+    and, if all phenotypes are analysed on the same individuals, filter the SNPs on MAF and missingness.
+
+    Args:
+        snp_ids : :class:`~numpy:numpy.array`
+            IDs of the SNPs in the batch
+        plan : :class:`snipar.gwas.batch_plan`
+            individuals and transforms used by all batches of the chromosome
+
+    Returns:
+        G : :class:`snipar.gtarray`
+            family based genotype matrix
+    """
+    ####### Construct family based genotype matrix #######
+    G = read.get_gts_matrix(snp_ids=snp_ids, parsum=parsum, verbose=verbose, design=plan.design)
+    if plan.filter_on_read:
+        filter_batch(G, max_missing=max_missing, min_maf=min_maf, verbose=verbose)
+    return G
+
+def fit_batch(G, plan, max_missing=5, min_maf=0.01, verbose=False):
+    """Transform the family based genotype matrix of a batch of SNPs and fit the SNP effects for each group of phenotypes.
+
+    Returns:
+        results : :class:`list`
+            for each phenotype, the frequencies and IDs of the SNPs that pass filters, and the estimates, their covariance matrices,
+            and their standard errors
+    """
+    results = [None for i in range(plan.n_phen)]
+    for j, group in enumerate(plan.groups):
+        if group.rows is None:
+            G_group = G if j == len(plan.groups)-1 else copy.deepcopy(G)
+        else:
+            G_group = copy.copy(G)
+            G_group.filter_ids(G.ids[group.rows])
+        if not plan.filter_on_read:
+            filter_batch(G_group, max_missing=max_missing, min_maf=min_maf, verbose=verbose)
+        ##### Transform genotypes ######
+        if verbose:
+            print('Transforming genotypes')
+        G_group.diagonalise(group.inv_root, famsize_indices=group.famsize_indices)
+        ### Fit models for SNPs ###
+        if verbose:
+            print('Estimating SNP effects')
+        alpha, alpha_cov = fit_models(group.Y,G_group.gts)
+        alpha_ses = compute_ses(alpha_cov)
+        for k, i in enumerate(group.phenotypes):
+            results[i] = (G_group.freqs, G_group.sid, alpha[:,:,k], group.cov_scale[k]*alpha_cov,
+                          np.sqrt(group.cov_scale[k])*alpha_ses)
+    return results
+
+def process_batch(y, pedigree, tau, sigma2, snp_ids=None, bedfile=None, bgenfile=None, par_gts_f=None, parsum=False,
+                  fit_sib=False, max_missing=5, min_maf=0.01, verbose=False, print_sample_info=False, plan=None, native_bed=False,
+                  storefile=None):
+    ####### Find individuals and transforms, if not already done for this chromosome #######
+    if plan is None:
+        plan = batch_plan(y, pedigree, tau, sigma2, bedfile=bedfile, bgenfile=bgenfile, par_gts_f=par_gts_f,
+                          fit_sib=fit_sib, verbose=print_sample_info, native_bed=native_bed, storefile=storefile)
+    G = read_batch(snp_ids, plan, parsum=parsum, max_missing=max_missing, min_maf=min_maf, verbose=verbose)
+    results = fit_batch(G, plan, max_missing=max_missing, min_maf=min_maf, verbose=verbose)
+    if plan.n_phen == 1:
+        return results[0]
+    return results
+
+def prefetch_batches(snp_ids, batch_bounds, plan, parsum=False, max_missing=5, min_maf=0.01, prefetch=1):
+    """Generator yielding the genotype matrix (see :func:`read_batch`) of each batch of SNPs in turn. A background thread
+    reads and assembles the following batches while the current batch is being fitted.
+
+    Args:
+        snp_ids : :class:`~numpy:numpy.array`
+            IDs of the SNPs on the chromosome
+        batch_bounds : :class:`~numpy:numpy.array`
+            [start, end) indices of the batches in snp_ids (see :func:`compute_batch_boundaries`)
+        plan : :class:`snipar.gwas.batch_plan`
+            individuals and transforms used by all batches of the chromosome
+        prefetch : :class:`int`
+            maximum number of batches waiting to be fitted. With prefetch=0, batches are read in the main thread.
+            At most prefetch+2 batches (waiting, being read, being fitted) are held in memory at once.
+
+    Returns:
+        generator of :class:`snipar.gtarray`
+    """
+    nbatch = batch_bounds.shape[0]
+    if prefetch < 1:
+        for i in range(nbatch):
+            yield read_batch(snp_ids[batch_bounds[i, 0]:batch_bounds[i, 1]], plan, parsum=parsum,
+                             max_missing=max_missing, min_maf=min_maf, verbose=i==0)
+        return
+    batches = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    def reader():
+        for i in range(nbatch):
+            try:
+                G = read_batch(snp_ids[batch_bounds[i, 0]:batch_bounds[i, 1]], plan, parsum=parsum,
+                               max_missing=max_missing, min_maf=min_maf, verbose=i==0)
+            except Exception as e:
+                G = e
+            # Wait for a free slot, giving up if the consumer has stopped
+            while not stop.is_set():
+                try:
+                    batches.put(G, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set() or isinstance(G, Exception):
+                return
+    reader_thread = threading.Thread(target=reader, daemon=True)
+    reader_thread.start()
+    try:
+        for i in range(nbatch):
+            G = batches.get()
+            if isinstance(G, Exception):
+                raise G
+            yield G
+    finally:
+        stop.set()
+        reader_thread.join()
 
 def process_chromosome(chrom_out, y, pedigree, tau, sigma2, outprefix, bedfile=None, bgenfile=None, par_gts_f=None,
                         fit_sib=False, parsum=False, max_missing=5, min_maf=0.01, batch_size=10000, 
-                        no_hdf5_out=False, no_txt_out=False):
+                        no_hdf5_out=False, no_txt_out=False, prefetch=1, resume=False, null_alpha=None, phen_labels=None, max_memory=None,
+                        native_bed=False, storefile=None, shard=None, snp_start=None, snp_end=None, tau_rtol=0):
+    """Estimate SNP effects for a chromosome, in batches of SNPs, and write summary statistics.
+
+    If storefile is given, the family based genotype matrices are read from the family genotype store (see :func:`snipar.read.store.build_store`),
+    and the summary statistics are for the SNPs in the store.
+
+    If max_memory (in GB) is given, batch_size is set to the largest number of SNPs whose projected peak memory (see :meth:`batch_plan.snp_memory`)
+    fits within max_memory.
+
+    If y is a list of phenotypes, tau, sigma2, and null_alpha are lists giving the null model of each phenotype, and each batch of SNPs is read once
+    and used for all phenotypes. One set of summary statistics is written for each phenotype, labelled by phen_labels. Phenotypes with tau within
+    a relative tolerance of tau_rtol share the transformed genotypes (see :class:`batch_plan`).
+
+    If shard=(k, n) is given, only the SNPs in the k'th of n contiguous shards of the chromosome are analysed; if snp_start and/or snp_end are
+    given, only the SNPs with indices in [snp_start, snp_end) (after removing duplicates) are analysed. The summary statistics of a shard
+    are written to files labelled by :func:`shard_label`, and the shards of a chromosome are combined by :func:`merge_shards`.
+    """
     ######## Check for bed/bgen #######
-    if bedfile is None and bgenfile is None:
-        raise(ValueError('Must supply either bed or bgen file with observed genotypes'))
+    if bedfile is None and bgenfile is None and storefile is None:
+        raise(ValueError('Must supply either bed or bgen file with observed genotypes, or a family genotype store'))
     if bedfile is not None and bgenfile is not None:
         raise(ValueError('Both --bed and --bgen specified. Please specify one only'))
-    if bedfile is not None:
-        bed = Bed(bedfile,count_A1 = True)
-        gts_id_dict = make_id_dict(bed.iid,1)
+    if resume and no_hdf5_out:
+        raise(ValueError('Resuming requires HDF5 output'))
+    label = shard_label(shard, snp_start, snp_end)
+    if label is not None and no_hdf5_out:
+        raise(ValueError('Sharding requires HDF5 output'))
+    if isinstance(y, list):
+        taus, sigma2s, null_alphas = tau, sigma2, null_alpha
+        if null_alphas is None:
+            null_alphas = [None for x in y]
+        if phen_labels is None:
+            phen_labels = ['phen'+str(i+1) for i in range(len(y))]
+    else:
+        taus, sigma2s, null_alphas, phen_labels = [tau], [sigma2], [null_alpha], [None]
+    hdf5_outfiles = [sumstats_outfile(outprefix, chrom_out, '.sumstats.hdf5', phen_label=x, shard=label) for x in phen_labels]
+    txt_outfiles = [sumstats_outfile(outprefix, chrom_out, '.sumstats.gz', phen_label=x, shard=label) for x in phen_labels]
+    if resume and all([sumstats_complete(x) for x in hdf5_outfiles]):
+        print('Output for chromosome '+str(chrom_out)+' already complete in '+', '.join(hdf5_outfiles)+'. Skipping')
+        return
+    ######## Find individuals and transforms used by all batches #######
+    plan = batch_plan(y, pedigree, tau, sigma2, bedfile=bedfile, bgenfile=bgenfile, par_gts_f=par_gts_f,
+                      fit_sib=fit_sib, verbose=True, native_bed=native_bed, storefile=storefile, tau_rtol=tau_rtol)
+    if storefile is not None:
+        snp_ids = plan.design.sid
+        pos = plan.design.pos
+        alleles = plan.design.alleles
+        chrom = plan.design.chrom
+    elif bedfile is not None:
+        bed = plan.design.gts_f
         snp_ids = bed.sid
         pos = np.array(bed.pos[:,2],dtype=int)
-        alleles = np.loadtxt(bedfile.split('.bed')[0]+'.bim',dtype=str,usecols=(4,5))
+        alleles = read.variants.read_bim(bedfile.split('.bed')[0]+'.bim').alleles
         chrom = np.array(bed.pos[:,0],dtype=int)
     elif bgenfile is not None:
-        bgen = open_bgen(bgenfile, verbose=False)
-        gts_id_dict = make_id_dict(bgen.samples)
-        snp_ids = bgen.ids
-        # If SNP IDs are broken, try rsids
-        if np.unique(snp_ids).shape[0] == 1:
-            snp_ids = bgen.rsids
-        pos = np.array(bgen.positions,dtype=int)
-        alleles = np.array([x.split(',') for x in bgen.allele_ids])
-        chrom = np.array(bgen.chromosomes,dtype='U2')
+        # SNP IDs are the rsids if the bgen IDs are broken
+        variants = read.variants.read_bgen_variants(bgenfile, plan.design.gts_f)
+        snp_ids = variants.sid
+        pos = np.array(variants.pos,dtype=int)
+        alleles = variants.alleles
+        chrom = np.array(variants.chrom,dtype='U2')
         # If chromosomse unknown, set to chromosome inferred from filename
         chrom[[len(x)==0 for x in chrom]] = chrom_out
     # Check for observed parents if not using parsum
     if not parsum:
-        par_status, gt_indices, fam_labels = find_par_gts(y.ids, pedigree, gts_id_dict)
-        parcount = np.sum(par_status==0,axis=1)
+        parcount = plan.design.parcount
         if np.sum(parcount>0)==0:
             print('No individuals with genotyped parents found. Using sum of imputed maternal and paternal genotypes to prevent collinearity.')
             parsum = True
@@ -235,67 +961,205 @@ def process_chromosome(chrom_out, y, pedigree, tau, sigma2, outprefix, bedfile=N
     ####### Compute batches #######
     print('Found '+str(snp_ids.shape[0])+' SNPs')
     # Remove duplicates
-    unique_snps, counts = np.unique(snp_ids, return_counts=True)
-    non_duplicate = set(unique_snps[counts==1])
+    unique_snps, snp_inverse, counts = np.unique(snp_ids, return_inverse=True, return_counts=True)
     if np.sum(counts>1)>0:
         print('Removing '+str(np.sum(counts>1))+' duplicate SNP ids')
-        not_duplicated = np.array([x in non_duplicate for x in snp_ids])
+        not_duplicated = counts[snp_inverse] == 1
         snp_ids = snp_ids[not_duplicated]
         pos = pos[not_duplicated]
         chrom = chrom[not_duplicated]
         alleles = alleles[not_duplicated,:]
-    snp_dict = make_id_dict(snp_ids)
-    # Compute batches
-    batch_bounds = compute_batch_boundaries(snp_ids,batch_size)
-    if batch_bounds.shape[0] == 1:
-        print('Using 1 batch')
+    if label is not None:
+        chrom_nsnp = snp_ids.shape[0]
+        start, end = shard_bounds(chrom_nsnp, shard, snp_start, snp_end)
+        snp_range = (start, end, chrom_nsnp)
+        print('Shard '+label+': SNPs '+str(start)+' to '+str(end)+' of '+str(chrom_nsnp))
+        if start == end:
+            print('No SNPs in shard '+label+'. Skipping')
+            return
+        snp_ids = snp_ids[start:end]
+        pos = pos[start:end]
+        chrom = chrom[start:end]
+        alleles = alleles[start:end,:]
     else:
-        print('Using '+str(batch_bounds.shape[0])+' batches')
+        snp_range = None
+    snp_dict = id_index(snp_ids)
     alpha_dim = 2
     if fit_sib:
         alpha_dim += 1
     if not parsum:
         alpha_dim += 1
+    # Compute batches
+    snp_memory = plan.snp_memory(alpha_dim, prefetch=prefetch)
+    fixed_memory = snp_ids.nbytes+pos.nbytes+chrom.nbytes+alleles.nbytes+plan.fixed_memory()
+    if max_memory is not None:
+        batch_size = int((max_memory*1024**3-fixed_memory)//snp_memory)
+        if batch_size < 1:
+            raise(ValueError('Not enough memory for a batch of 1 SNP: need '+format_memory(fixed_memory+snp_memory)))
+    batch_bounds = compute_batch_boundaries(snp_ids,batch_size)
+    if batch_bounds.shape[0] == 1:
+        print('Using 1 batch')
+    else:
+        print('Using '+str(batch_bounds.shape[0])+' batches of '+str(batch_size)+' SNPs')
+    max_batch = np.max(batch_bounds[:, 1]-batch_bounds[:, 0])
+    print('Projected peak memory of SNP batches: '+format_memory(fixed_memory+max_batch*snp_memory))
     # Create output files
-    alpha = np.zeros((snp_ids.shape[0],alpha_dim),dtype=np.float32)
-    alpha[:] = np.nan
-    alpha_cov = np.zeros((snp_ids.shape[0], alpha_dim, alpha_dim),dtype=np.float32)
-    alpha_cov[:] = np.nan
-    alpha_ses = np.zeros((snp_ids.shape[0],alpha_dim),dtype=np.float32)
-    alpha_ses[:] = np.nan
-    freqs = np.zeros((snp_ids.shape[0]),dtype=np.float32)
-    freqs[:] = np.nan
+    if not no_hdf5_out:
+        hdf5_writers = [hdf5_sumstats_writer(hdf5_outfiles[j], chrom, snp_ids, pos, alleles, parsum, fit_sib, sigma2s[j], taus[j],
+                                             batch_bounds, null_alpha=null_alphas[j], resume=resume, snp_range=snp_range)
+                        for j in range(len(phen_labels))]
+        completed = np.all([writer.completed for writer in hdf5_writers], axis=0)
+    else:
+        completed = np.zeros(batch_bounds.shape[0], dtype=bool)
+    if not no_txt_out:
+        txt_writers = [txt_sumstats_writer(txt_outfiles[j], parsum, fit_sib, sigma2s[j], taus[j]) for j in range(len(phen_labels))]
     ##############  Process batches of SNPs ##############
-    for i in range(0,batch_bounds.shape[0]):
-        if i==0:
-            print_sample_info = True
-            verbose = True
+    batches = prefetch_batches(snp_ids, batch_bounds[~completed], plan, parsum=parsum, max_missing=max_missing,
+                               min_maf=min_maf, prefetch=prefetch)
+    for i in range(batch_bounds.shape[0]):
+        batch = slice(batch_bounds[i, 0], batch_bounds[i, 1])
+        if completed[i]:
+            outputs = [writer.read_batch(batch) for writer in hdf5_writers]
         else:
-            print_sample_info = False
-            verbose = False
-        batch_freqs, batch_snps, batch_alpha, batch_alpha_cov, batch_alpha_ses = process_batch(y, pedigree, 
-                    tau, sigma2, snp_ids=snp_ids[batch_bounds[i, 0]:batch_bounds[i, 1]], bedfile=bedfile, bgenfile=bgenfile, 
-                    par_gts_f = par_gts_f, parsum=parsum, fit_sib=fit_sib, max_missing=max_missing, min_maf=min_maf,
-                    print_sample_info=print_sample_info, verbose=verbose)
-        # Fill in fitted SNPs
-        batch_indices = np.array([snp_dict[x] for x in batch_snps])
-        alpha[batch_indices, :] = batch_alpha
-        alpha_cov[batch_indices, :, :] = batch_alpha_cov
-        alpha_ses[batch_indices, :] = batch_alpha_ses
-        freqs[batch_indices] = batch_freqs
-        print('Done batch '+str(i+1)+' out of '+str(batch_bounds.shape[0]))
-    ######## Save output #########
-    if not no_hdf5_out:
-        if chrom_out==0:
-            hdf5_outfile = outfile_name(outprefix, '.sumstats.hdf5')
+            G = next(batches)
+            results = fit_batch(G, plan, max_missing=max_missing, min_maf=min_maf, verbose=i==np.argmin(completed))
+            del G
+            outputs = []
+            for j in range(len(results)):
+                batch_freqs, batch_snps, batch_alpha, batch_alpha_cov, batch_alpha_ses = results[j]
+                # Fill in fitted SNPs
+                batch_size = batch_bounds[i, 1]-batch_bounds[i, 0]
+                alpha = np.zeros((batch_size,alpha_dim),dtype=np.float32)
+                alpha[:] = np.nan
+                alpha_cov = np.zeros((batch_size, alpha_dim, alpha_dim),dtype=np.float32)
+                alpha_cov[:] = np.nan
+                alpha_ses = np.zeros((batch_size,alpha_dim),dtype=np.float32)
+                alpha_ses[:] = np.nan
+                freqs = np.zeros((batch_size),dtype=np.float32)
+                freqs[:] = np.nan
+                batch_indices = snp_dict.get_indexer(batch_snps)-batch_bounds[i, 0]
+                alpha[batch_indices, :] = batch_alpha
+                alpha_cov[batch_indices, :, :] = batch_alpha_cov
+                alpha_ses[batch_indices, :] = batch_alpha_ses
+                freqs[batch_indices] = batch_freqs
+                if not no_hdf5_out:
+                    hdf5_writers[j].write_batch(i, batch, alpha, alpha_ses, alpha_cov, freqs)
+                outputs.append((alpha, alpha_ses, alpha_cov, freqs))
+        if not no_txt_out:
+            for j in range(len(outputs)):
+                alpha, alpha_ses, alpha_cov, freqs = outputs[j]
+                txt_writers[j].write(chrom[batch], snp_ids[batch], pos[batch], alleles[batch], alpha, alpha_cov, freqs)
+        if completed[i]:
+            print('Batch '+str(i+1)+' out of '+str(batch_bounds.shape[0])+' already completed')
         else:
-            hdf5_outfile = outfile_name(outprefix, '.sumstats.hdf5', chrom=chrom_out)
-        write_output(chrom, snp_ids, pos, alleles, hdf5_outfile, parsum, fit_sib, alpha, alpha_ses, alpha_cov,
-                     sigma2, tau, freqs)
+            print('Done batch '+str(i+1)+' out of '+str(batch_bounds.shape[0]))
     if not no_txt_out:
-        if chrom_out==0:
-            txt_outfile = outfile_name(outprefix, '.sumstats.gz')
-        else:
-            txt_outfile = outfile_name(outprefix, '.sumstats.gz', chrom=chrom_out)
-        write_txt_output(chrom, snp_ids, pos, alleles, txt_outfile, parsum, fit_sib, alpha, alpha_cov,
-                     sigma2, tau, freqs)
+        for writer in txt_writers:
+            writer.close()
+    if not no_hdf5_out:
+        for writer in hdf5_writers:
+            writer.close(complete=True)
+
+# Phenotypes, pedigree and variance components shared with the worker processes of process_chromosomes
+_chromosome_worker_inputs = {}
+
+def _init_chromosome_worker(shared, n_phen, tau, sigma2, outprefix, kwargs, threads):
+    for key in shared:
+        _chromosome_worker_inputs[key] = attach_array(shared[key])
+    _chromosome_worker_inputs['n_phen'] = n_phen
+    _chromosome_worker_inputs['tau'] = tau
+    _chromosome_worker_inputs['sigma2'] = sigma2
+    _chromosome_worker_inputs['outprefix'] = outprefix
+    _chromosome_worker_inputs['kwargs'] = kwargs
+    if threads is not None:
+        set_num_threads(threads)
+
+def _chromosome_task(chrom_out, y, pedigree, tau, sigma2, outprefix, bedfile=None, bgenfile=None, par_gts_f=None, storefile=None, **kwargs):
+    if storefile is not None:
+        print('Family genotype store: '+storefile)
+    if bedfile is not None:
+        print('Observed genotypes file: '+bedfile)
+    if bgenfile is not None:
+        print('Observed genotypes file: '+bgenfile)
+    if par_gts_f is not None:
+        print('Imputed genotypes file: '+par_gts_f)
+    print('Estimating SNP effects for chromosome '+str(chrom_out))
+    # Each chromosome filters its own copy of the phenotypes
+    if isinstance(y, list):
+        y = [gtarray(np.array(x.gts), np.array(x.ids), fams=np.array(x.fams)) for x in y]
+    else:
+        y = gtarray(np.array(y.gts), np.array(y.ids), fams=np.array(y.fams))
+    process_chromosome(chrom_out, y, pedigree, tau, sigma2, outprefix, bedfile=bedfile, bgenfile=bgenfile,
+                       par_gts_f=par_gts_f, storefile=storefile, **kwargs)
+    return chrom_out
+
+def _run_chromosome_worker(task):
+    inputs = _chromosome_worker_inputs
+    y = [gtarray(inputs['y_gts_'+str(i)][1], inputs['y_ids_'+str(i)][1], fams=inputs['y_fams_'+str(i)][1])
+         for i in range(inputs['n_phen'])]
+    if not isinstance(inputs['tau'], list):
+        y = y[0]
+    return _chromosome_task(task['chrom_out'], y, inputs['pedigree'][1], inputs['tau'], inputs['sigma2'],
+                            inputs['outprefix'], bedfile=task['bedfile'], bgenfile=task['bgenfile'],
+                            par_gts_f=task['par_gts_f'], storefile=task['storefile'], **inputs['kwargs'])
+
+def process_chromosomes(chroms, y, pedigree, tau, sigma2, outprefix, bedfiles, bgenfiles, pargts_list, processes=1,
+                        threads=None, storefiles=None, **kwargs):
+    """Estimate SNP effects for each chromosome (see :func:`process_chromosome`), either in sequence or in a pool of worker processes.
+    
+    The worker processes read the transformed phenotypes and the pedigree from shared memory, and chromosomes are dispatched
+    in decreasing order of the size of their observed genotype files, so that the largest chromosomes are not left until last.
+
+    Args:
+        chroms : :class:`~numpy:numpy.array`
+            chromosome numbers
+        y : :class:`snipar.gtarray` or :class:`list`
+            transformed phenotype with family labels (y.fams), or list of transformed phenotypes (see :func:`process_chromosome`)
+        bedfiles, bgenfiles, pargts_list : :class:`list`
+            observed genotype and imputed parental genotype files for each chromosome (None if not used)
+        storefiles : :class:`list`
+            family genotype stores for each chromosome, used in place of the observed and imputed genotype files (None if not used)
+        processes : :class:`int`
+            number of chromosomes to process at once
+        threads : :class:`int`
+            number of threads used by each worker process. By default, the available threads are divided between the processes.
+        kwargs
+            passed to :func:`process_chromosome`
+    """
+    if storefiles is None:
+        storefiles = [None for x in range(len(chroms))]
+    tasks = [{'chrom_out': chroms[i], 'bedfile': bedfiles[i], 'bgenfile': bgenfiles[i], 'par_gts_f': pargts_list[i],
+              'storefile': storefiles[i]} for i in range(len(chroms))]
+    if processes < 2 or len(tasks) < 2:
+        for task in tasks:
+            _chromosome_task(task['chrom_out'], y, pedigree, tau, sigma2, outprefix, bedfile=task['bedfile'],
+                             bgenfile=task['bgenfile'], par_gts_f=task['par_gts_f'], storefile=task['storefile'], **kwargs)
+        return
+    # Largest chromosomes first
+    sizes = [path.getsize([x for x in (task['storefile'], task['bedfile'], task['bgenfile']) if x is not None][0]) for task in tasks]
+    tasks = [tasks[i] for i in np.argsort(sizes, kind='stable')[::-1]]
+    processes = min(processes, len(tasks))
+    if kwargs.get('max_memory') is not None:
+        # The memory budget is shared between the chromosomes processed at once
+        kwargs = dict(kwargs, max_memory=kwargs['max_memory']/processes)
+    if threads is None:
+        threads = max(1, numba_config.NUMBA_NUM_THREADS // processes)
+    print('Processing '+str(len(tasks))+' chromosomes with '+str(processes)+' processes of '+str(threads)+' threads')
+    shared, blocks = {}, []
+    try:
+        ys = y if isinstance(y, list) else [y]
+        arrays = [('pedigree', pedigree)]
+        for i in range(len(ys)):
+            arrays += [('y_gts_'+str(i), np.array(ys[i].gts)), ('y_ids_'+str(i), ys[i].ids), ('y_fams_'+str(i), ys[i].fams)]
+        for key, x in arrays:
+            shm, shared[key] = share_array(x)
+            blocks.append(shm)
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(processes, initializer=_init_chromosome_worker,
+                      initargs=(shared, len(ys), tau, sigma2, outprefix, kwargs, threads)) as pool:
+            for chrom in pool.imap_unordered(_run_chromosome_worker, tasks):
+                print('Done chromosome '+str(chrom))
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
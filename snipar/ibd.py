@@ -1,11 +1,12 @@
 import gzip
-from numba import njit, prange
+from numba import njit, prange, get_num_threads
+from numba.typed import List
 from snipar.map import *
 from snipar.ld import compute_ld_scores
 import numpy as np
 from snipar.read.bed import read_sibs_from_bed
 from snipar.read.bgen import read_sibs_from_bgen
-from snipar.utilities import make_id_dict
+from snipar.utilities import id_index
 from snipar.utilities import outfile_name
 from bgen_reader import open_bgen
 
@@ -26,6 +27,25 @@ def transition_matrix(cM):
     P += r_array*r
     return np.log(P)
 
+@njit(parallel=True)
+def transition_table(map):
+    """Compute the log-probabilities of transitioning between IBD states between each SNP and the previous SNP (see :func:`transition_matrix`).
+    These depend only on the genetic map, so are computed once per chromosome and shared by all sibling pairs of a run; they are not stored
+    between runs, since computing them takes little time compared with the Viterbi paths.
+    Args:
+        map : :class:`~numpy:numpy.array`
+            floating point vector of genetic positions in cM
+    Returns:
+        transitions : :class:`~numpy:numpy.array`
+            [L x 3 x 3] array where transitions[l, ...] is the log of the matrix of transition probabilities from SNP l-1 to SNP l.
+            transitions[0, ...] is the log of the identity matrix.
+    """
+    transitions = np.zeros((map.shape[0], 3, 3), dtype=np.float64)
+    transitions[0, ...] = transition_matrix(0.0)
+    for l in prange(1, map.shape[0]):
+        transitions[l, ...] = transition_matrix(map[l]-map[l-1])
+    return transitions
+
 #
 @njit
 def p_ibd_0(f):
@@ -104,22 +124,40 @@ def p_obs_given_IBD(g1_obs,g2_obs,f,p):
     # Return
     return np.log(P_out)
 
+@njit(parallel=True)
+def emission_table(freqs, weights, error_probs):
+    """Compute the weighted log-probabilities of the observed genotypes of a sibling pair given IBD 0,1,2 (see :func:`p_obs_given_IBD`)
+    for every SNP and pair of observed genotypes. These depend only on the SNP, so are computed once per chromosome and shared by all sibling pairs.
+    Args:
+        freqs : :class:`~numpy:numpy.array`
+            floating point vector of allele frequencies
+        weights : :class:`~numpy:numpy.array`
+            floating point vector of SNP weights (usually inverse LD-scores)
+        error_probs : :class:`~numpy:numpy.array`
+            floating point vector of genotyping error probabilities
+    Returns:
+        emissions : :class:`~numpy:numpy.array`
+            [L x 3 x 3 x 3] array where emissions[l, g1, g2, i] is the weighted log-probability of observing genotypes g1, g2 at SNP l given IBD i
+    """
+    emissions = np.zeros((freqs.shape[0], 3, 3, 3), dtype=np.float64)
+    for l in prange(freqs.shape[0]):
+        for g1 in range(3):
+            for g2 in range(3):
+                emissions[l, g1, g2, :] = weights[l]*p_obs_given_IBD(g1, g2, freqs[l], error_probs[l])
+    return emissions
+
 @njit
-def make_dynamic(g1, g2, freqs, map, weights, error_probs):
+def make_dynamic(g1, g2, emissions, transitions):
     """Make state-matrix and pointer matrix for a sibling pair by dynamic programming
     Args:
         g1 : :class:`~numpy:numpy.array`
             integer vector of first sibling's genotypes
         g2 : :class:`~numpy:numpy.array`
             integer vector of first sibling's genotypes
-        freqs : :class:`~numpy:numpy.array`
-            floating point vector of allele frequencies
-        map : :class:`~numpy:numpy.array`
-            floating point vector of genetic positions in cM
-        weights : :class:`~numpy:numpy.array`
-            floating point vector of SNP weights (usually inverse LD-scores)
-        p : :class:'float'
-            genotyping error probability
+        emissions : :class:`~numpy:numpy.array`
+            weighted log-probabilities of observed genotypes given IBD (see :func:`emission_table`)
+        transitions : :class:`~numpy:numpy.array`
+            log-probabilities of transitions between IBD states (see :func:`transition_table`)
     Returns:
         state_matrix : :class:`~numpy:numpy.array`
             matrix where each column gives the prob of max prob path to that state, where each row is IBD 0,1,2
@@ -133,14 +171,14 @@ def make_dynamic(g1, g2, freqs, map, weights, error_probs):
     # Initialise
     state_matrix[:,0] = np.log(np.array([0.25, 0.5, 0.25],dtype=np.float64))
     if not_nan[0]:
-        state_matrix[:, 0] += weights[0]*p_obs_given_IBD(np.int8(g1[0]), np.int8(g2[0]), freqs[0], error_probs[0])
+        state_matrix[:, 0] += emissions[0, np.int8(g1[0]), np.int8(g2[0]), :]
     # Compute
     for l in range(1, g1.shape[0]):
         if not_nan[l]:
-            probs = weights[l]*p_obs_given_IBD(np.int8(g1[l]), np.int8(g2[l]), freqs[l], error_probs[l])
+            probs = emissions[l, np.int8(g1[l]), np.int8(g2[l]), :]
         else:
             probs = np.zeros((3))
-        tmatrix = transition_matrix(map[l]-map[l-1])
+        tmatrix = transitions[l]
         for i in range(3):
             tprobs = tmatrix[:, i]+state_matrix[:, l-1]
             state_matrix[i, l] = np.max(tprobs)+probs[i]
@@ -165,13 +203,99 @@ def viterbi(state_matrix,pointers):
         path[path.shape[0]-(i+1)] = pointers[path[path.shape[0]-i], path.shape[0]-i]
     return path
 
+# Number of sibling pairs advanced together through the SNPs by viterbi_block
+ibd_block_size = 64
+
+@njit
+def pair_genotype_codes(pairs, gts, l, codes):
+    """Index of the observed genotypes of each sibling pair at SNP l in the flattened genotype pairs of an emission table
+    (3*g1+g2), or -1 if either genotype is missing"""
+    for k in range(pairs.shape[0]):
+        g1 = gts[pairs[k, 0], l]
+        g2 = gts[pairs[k, 1], l]
+        if np.isnan(g1) or np.isnan(g2):
+            codes[k] = -1
+        else:
+            codes[k] = 3*np.int64(g1)+np.int64(g2)
+
+@njit
+def viterbi_block(pairs, gts, emissions, transitions, ibd):
+    """Find the Viterbi paths through the IBD states of a block of sibling pairs, advancing all pairs together through the SNPs.
+    Gives the same paths as :func:`make_dynamic` and :func:`viterbi` applied to each pair, but keeps the scores of the states of all pairs
+    in a contiguous [3 x pairs] array, and packs the three pointers of a pair at a SNP into one byte (2 bits per state).
+    Args:
+        pairs : :class:`~numpy:numpy.array`
+            [P x 2] matrix of the rows of the siblings in gts
+        gts : :class:`~numpy:numpy.array`
+            floating point matrix of genotypes, with NaN for missing
+        emissions : :class:`~numpy:numpy.array`
+            weighted log-probabilities of observed genotypes given IBD (see :func:`emission_table`)
+        transitions : :class:`~numpy:numpy.array`
+            log-probabilities of transitions between IBD states (see :func:`transition_table`)
+        ibd : :class:`~numpy:numpy.array`
+            [P x L] integer matrix the Viterbi paths are written to
+    """
+    npair = pairs.shape[0]
+    nsnp = gts.shape[1]
+    pair_emissions = emissions.reshape((nsnp, 9, 3))
+    scores = np.zeros((3, npair), dtype=np.float64)
+    new_scores = np.zeros((3, npair), dtype=np.float64)
+    pointers = np.zeros((nsnp, npair), dtype=np.uint8)
+    codes = np.zeros(npair, dtype=np.int64)
+    # Initialise
+    init = np.log(np.array([0.25, 0.5, 0.25], dtype=np.float64))
+    pair_genotype_codes(pairs, gts, 0, codes)
+    for i in range(3):
+        for k in range(npair):
+            scores[i, k] = init[i]
+            if codes[k] >= 0:
+                scores[i, k] += pair_emissions[0, codes[k], i]
+    # Compute
+    for l in range(1, nsnp):
+        tmatrix = transitions[l]
+        pair_genotype_codes(pairs, gts, l, codes)
+        for k in range(npair):
+            pointers[l, k] = 0
+        for i in range(3):
+            t0, t1, t2 = tmatrix[0, i], tmatrix[1, i], tmatrix[2, i]
+            for k in range(npair):
+                # Ties go to the lowest state, as np.argmax
+                best = t0+scores[0, k]
+                pointer = 0
+                x = t1+scores[1, k]
+                if x > best:
+                    best = x
+                    pointer = 1
+                x = t2+scores[2, k]
+                if x > best:
+                    best = x
+                    pointer = 2
+                if codes[k] >= 0:
+                    best += pair_emissions[l, codes[k], i]
+                new_scores[i, k] = best
+                pointers[l, k] |= np.uint8(pointer << (2*i))
+        scores, new_scores = new_scores, scores
+    # Traceback
+    for k in range(npair):
+        state = 0
+        if scores[1, k] > scores[state, k]:
+            state = 1
+        if scores[2, k] > scores[state, k]:
+            state = 2
+        ibd[k, nsnp-1] = state
+        for l in range(nsnp-1, 0, -1):
+            state = (pointers[l, k] >> (2*state)) & 3
+            ibd[k, l-1] = state
+
 @njit(parallel=True)
-def infer_ibd(sibpairs, gts, freqs, map, weights, error_probs):
+def infer_ibd(sibpairs, gts, emissions, transitions, block_size=ibd_block_size):
+    """Find the Viterbi paths through the IBD states of sibling pairs (see :func:`viterbi_block`), processing blocks of block_size pairs in parallel"""
     ibd = np.zeros((sibpairs.shape[0], gts.shape[1]), dtype=np.int8)
-    for i in prange(sibpairs.shape[0]):
-        sibpair = sibpairs[i, :]
-        state_matrix, pointers = make_dynamic(gts[sibpair[0], :], gts[sibpair[1], :], freqs, map, weights, error_probs)
-        ibd[i, ...] = viterbi(state_matrix, pointers)
+    nblock = (sibpairs.shape[0]+block_size-1)//block_size
+    for b in prange(nblock):
+        start = b*block_size
+        end = min(start+block_size, sibpairs.shape[0])
+        viterbi_block(sibpairs[start:end], gts, emissions, transitions, ibd[start:end])
     return ibd
 
 class segment(object):
@@ -209,63 +333,337 @@ def find_segments(path,map,snps,pos):
                             map[i]-map[ibd_start_index],ibd_start))
     return segments
 
+@njit
+def run_starts(path):
+    """Indices of the first SNPs of the runs of constant IBD state in a path"""
+    nrun = 1
+    for i in range(1, path.shape[0]):
+        if path[i] != path[i-1]:
+            nrun += 1
+    starts = np.zeros(nrun, dtype=np.int64)
+    r = 1
+    for i in range(1, path.shape[0]):
+        if path[i] != path[i-1]:
+            starts[r] = i
+            r += 1
+    return starts
+
+@njit
+def smooth_path(path, map, min_length):
+    """Smooth a path through the IBD states in place: runs shorter than min_length (cM) are set to the state of the neighbouring runs
+    (the following run for the first run, the preceding run for the last run, and runs between two runs in the same state)"""
+    starts = run_starts(path)
+    nrun = starts.shape[0]
+    if nrun > 1:
+        states = path[starts]
+        for r in range(nrun):
+            start = starts[r]
+            if r < nrun-1:
+                end = starts[r+1]
+                last = end-1
+            else:
+                # The last SNP of the last run is not smoothed (as in find_segments, the end of the last run is its last SNP)
+                end = path.shape[0]-1
+                last = end
+            if map[last]-map[start] < min_length:
+                if r == 0:
+                    state = states[1]
+                elif r < nrun-1:
+                    if states[r-1] != states[r+1]:
+                        continue
+                    state = states[r+1]
+                else:
+                    state = states[r-1]
+                if start == end:
+                    path[start] = state
+                else:
+                    path[start:end] = state
+
+# Fields of the segments output by find_ibd_segments: the index of the sibling pair, the indices of the first and last SNPs of
+# the segment, the IBD state, the base pair positions of the first and last SNPs, and the length in cM
+segment_dtype = np.dtype([('pair', np.int64), ('start', np.int64), ('end', np.int64), ('state', np.int8),
+                          ('start_bp', np.int64), ('end_bp', np.int64), ('length', np.float64)])
+
+@njit(parallel=True)
+def segment_arrays(ibd, map, pos, min_length, smooth):
+    """Run-length encode (after smoothing, if smooth) the paths through the IBD states of sibling pairs in parallel.
+    Returns the fields of segment_dtype as separate arrays."""
+    npair = ibd.shape[0]
+    nruns = np.zeros(npair, dtype=np.int64)
+    for i in prange(npair):
+        if smooth:
+            smooth_path(ibd[i], map, min_length)
+        nruns[i] = run_starts(ibd[i]).shape[0]
+    offsets = np.zeros(npair+1, dtype=np.int64)
+    offsets[1:] = np.cumsum(nruns)
+    nseg = offsets[npair]
+    pair = np.zeros(nseg, dtype=np.int64)
+    start = np.zeros(nseg, dtype=np.int64)
+    end = np.zeros(nseg, dtype=np.int64)
+    state = np.zeros(nseg, dtype=np.int8)
+    start_bp = np.zeros(nseg, dtype=np.int64)
+    end_bp = np.zeros(nseg, dtype=np.int64)
+    length = np.zeros(nseg, dtype=np.float64)
+    for i in prange(npair):
+        starts = run_starts(ibd[i])
+        for r in range(starts.shape[0]):
+            j = offsets[i]+r
+            pair[j] = i
+            start[j] = starts[r]
+            end[j] = starts[r+1]-1 if r < starts.shape[0]-1 else ibd.shape[1]-1
+            state[j] = ibd[i, starts[r]]
+            start_bp[j] = pos[start[j]]
+            end_bp[j] = pos[end[j]]
+            length[j] = map[end[j]]-map[start[j]]
+    return pair, start, end, state, start_bp, end_bp, length
+
+def find_ibd_segments(ibd, map, pos, min_length=None):
+    """Find the segments of constant IBD state in the paths of sibling pairs, smoothing the paths first if min_length is given.
+    Args:
+        ibd : :class:`~numpy:numpy.array`
+            [P x L] int8 matrix of IBD states of sibling pairs, smoothed in place if min_length is given
+        map : :class:`~numpy:numpy.array`
+            floating point vector of genetic positions in cM
+        pos : :class:`~numpy:numpy.array`
+            integer vector of base pair positions
+        min_length : :class:`float`
+            smooth segments with length less than min_length (cM) (see :func:`smooth_path`)
+    Returns:
+        segs : :class:`~numpy:numpy.array`
+            structured array of segments with fields given by segment_dtype, ordered by sibling pair and position
+    """
+    fields = segment_arrays(ibd, np.asarray(map, dtype=np.float64), np.asarray(pos, dtype=np.int64),
+                            0.0 if min_length is None else min_length, min_length is not None)
+    segs = np.zeros(fields[0].shape[0], dtype=segment_dtype)
+    for name, x in zip(segment_dtype.names, fields):
+        segs[name] = x
+    return segs
+
+@njit(parallel=True)
+def segment_blocks(sibpairs, gts, emissions, transitions, map, min_length, smooth, block_size):
+    """Find the segments of constant IBD state in the Viterbi paths (smoothed, if smooth) of blocks of block_size sibling pairs in parallel.
+    Each block is decoded into a [block_size x L] matrix (see :func:`viterbi_block`) that is run-length encoded and discarded,
+    so the IBD states of all pairs are never held at once. Returns, for each block, the [S x 4] matrix of the index of the sibling pair,
+    the indices of the first and last SNPs, and the IBD state of each segment."""
+    nsnp = gts.shape[1]
+    nblock = (sibpairs.shape[0]+block_size-1)//block_size
+    blocks = List()
+    for b in range(nblock):
+        blocks.append(np.zeros((0, 4), dtype=np.int64))
+    for b in prange(nblock):
+        start = b*block_size
+        end = min(start+block_size, sibpairs.shape[0])
+        ibd = np.zeros((end-start, nsnp), dtype=np.int8)
+        viterbi_block(sibpairs[start:end], gts, emissions, transitions, ibd)
+        nseg = 0
+        for k in range(end-start):
+            if smooth:
+                smooth_path(ibd[k], map, min_length)
+            nseg += run_starts(ibd[k]).shape[0]
+        segs = np.zeros((nseg, 4), dtype=np.int64)
+        j = 0
+        for k in range(end-start):
+            starts = run_starts(ibd[k])
+            for r in range(starts.shape[0]):
+                segs[j, 0] = start+k
+                segs[j, 1] = starts[r]
+                segs[j, 2] = starts[r+1]-1 if r < starts.shape[0]-1 else nsnp-1
+                segs[j, 3] = ibd[k, starts[r]]
+                j += 1
+        blocks[b] = segs
+    return blocks
+
+def infer_ibd_segments(sibpairs, gts, emissions, transitions, map, pos, min_length=None, block_size=ibd_block_size):
+    """Find the segments of constant IBD state in the Viterbi paths of sibling pairs, smoothing the paths first if min_length is given.
+    Gives the same segments as :func:`find_ibd_segments` applied to the output of :func:`infer_ibd`, without forming the [P x L] matrix of IBD states
+    (see :func:`segment_blocks`).
+    Args:
+        sibpairs : :class:`~numpy:numpy.array`
+            [P x 2] matrix of the rows of the siblings in gts
+        gts : :class:`~numpy:numpy.array`
+            floating point matrix of genotypes, with NaN for missing
+        emissions : :class:`~numpy:numpy.array`
+            weighted log-probabilities of observed genotypes given IBD (see :func:`emission_table`)
+        transitions : :class:`~numpy:numpy.array`
+            log-probabilities of transitions between IBD states (see :func:`transition_table`)
+        map : :class:`~numpy:numpy.array`
+            floating point vector of genetic positions in cM
+        pos : :class:`~numpy:numpy.array`
+            integer vector of base pair positions
+        min_length : :class:`float`
+            smooth segments with length less than min_length (cM) (see :func:`smooth_path`)
+    Returns:
+        segs : :class:`~numpy:numpy.array`
+            structured array of segments with fields given by segment_dtype, ordered by sibling pair and position
+    """
+    map = np.asarray(map, dtype=np.float64)
+    pos = np.asarray(pos, dtype=np.int64)
+    blocks = segment_blocks(sibpairs, gts, emissions, transitions, map, 0.0 if min_length is None else min_length,
+                            min_length is not None, block_size)
+    fields = np.vstack([np.zeros((0, 4), dtype=np.int64)]+list(blocks))
+    segs = np.zeros(fields.shape[0], dtype=segment_dtype)
+    for i, name in enumerate(['pair', 'start', 'end', 'state']):
+        segs[name] = fields[:, i]
+    segs['start_bp'] = pos[segs['start']]
+    segs['end_bp'] = pos[segs['end']]
+    segs['length'] = map[segs['end']]-map[segs['start']]
+    return segs
+
 def smooth_segments(path,map,snps,pos,min_length):
     # Smooth path
-    segments = find_segments(path,map,snps,pos)
-    if len(segments)>1:
-        for i in range(len(segments)):
-            if segments[i].length < min_length:
-                if i==0:
-                    if segments[i].start == segments[i].end:
-                        path[segments[i].start] = segments[i+1].state
-                    else:
-                        path[segments[i].start:segments[i].end] = segments[i+1].state
-                elif i<(len(segments)-1):
-                    if segments[i-1].state == segments[i+1].state:
-                        if segments[i].start == segments[i].end:
-                            path[segments[i].start] = segments[i+1].state
-                        else:
-                            path[segments[i].start:segments[i].end] = segments[i+1].state
-                else:
-                    if segments[i].start == segments[i].end:
-                        path[segments[i].start] = segments[i-1].state
-                    else:
-                        path[segments[i].start:segments[i].end] = segments[i - 1].state
-        segments = find_segments(path,map,snps,pos)
-    return path, segments
+    smooth_path(path, np.asarray(map, dtype=np.float64), min_length)
+    return path, find_segments(path,map,snps,pos)
+
+def segment_lists(segs,npair,map,snps):
+    """Convert segments found by :func:`find_ibd_segments` to a list, for each sibling pair, of the :class:`segment` objects given by :func:`find_segments`"""
+    allsegs = [[] for i in range(npair)]
+    last = np.ones(segs.shape[0], dtype=bool)
+    last[:-1] = segs['pair'][1:] != segs['pair'][:-1]
+    for seg, is_last in zip(segs, last):
+        # As in find_segments, a segment ends at the start of the next segment, and the last segment at its last SNP
+        end = seg['end'] if is_last else seg['end']+1
+        allsegs[seg['pair']].append(segment(seg['start'],end,seg['start_bp'],seg['end_bp'],snps[seg['start']],snps[seg['end']],
+                                            map[seg['end']]-map[seg['start']],seg['state']))
+    return allsegs
 
 def smooth_ibd(ibd,map,snps,pos,min_length):
-    allsegs = []
-    for i in range(ibd.shape[0]):
-        ibd_path, segments = smooth_segments(ibd[i,:],map,snps,pos,min_length)
-        ibd[i,:] = ibd_path
-        allsegs.append(segments)
-    return ibd, allsegs
+    """Smooth the paths of sibling pairs in place (see :func:`smooth_path`), returning the smoothed paths and a list of the :class:`segment`
+    objects of each pair. Kept for callers of the per-pair implementation: :func:`find_ibd_segments` returns the segments as a structured array."""
+    segs = find_ibd_segments(ibd, map, pos, min_length=min_length)
+    return ibd, segment_lists(segs, ibd.shape[0], map, snps)
+
+def segment_array(allsegs):
+    """Convert lists of :class:`segment` objects of sibling pairs to a structured array of segments (see :func:`find_ibd_segments`), indexing a
+    vector of the IDs of the first and last SNP of each segment, which is also returned"""
+    nseg = sum([len(x) for x in allsegs])
+    segs = np.zeros(nseg, dtype=segment_dtype)
+    snps = []
+    j = 0
+    for i in range(len(allsegs)):
+        for seg in allsegs[i]:
+            segs[j] = (i, 2*j, 2*j+1, seg.state, seg.start_bp, seg.end_bp, seg.length)
+            snps += [seg.start_snp, seg.end_snp]
+            j += 1
+    return segs, np.array(snps)
+
+class segment_writer(object):
+    """Write IBD segments to a gzipped text file, a batch of sibling pairs at a time, so that the segments of all pairs need not be held in memory.
+    Args:
+        outfile : :class:`str`
+            path to output file
+        chr : chromosome of the segments
+        snps : :class:`~numpy:numpy.array`
+            vector of SNP IDs
+    """
+    def __init__(self,outfile,chr,snps):
+        self.chr = str(chr)
+        self.snps = np.asarray(snps).astype(str)
+        self.seg_out = gzip.open(outfile,'wb',compresslevel=6)
+        # Header
+        self.seg_out.write('ID1\tID2\tIBDType\tChr\tstart_coordinate\tstop_coordinate\tstartSNP\tstopSNP\tlength\n'.encode())
+        self.first = True
+    def write(self,sibpairs,segs):
+        """Write the segments of a batch of sibling pairs (see :func:`find_ibd_segments`), where segs['pair'] indexes the rows of sibpairs"""
+        if segs.shape[0] == 0:
+            return
+        sibpairs = np.asarray(sibpairs).astype(str)
+        columns = [sibpairs[segs['pair'], 0], sibpairs[segs['pair'], 1], segs['state'].astype(str),
+                   np.full(segs.shape[0], self.chr), segs['start_bp'].astype(str), segs['end_bp'].astype(str),
+                   self.snps[segs['start']], self.snps[segs['end']], segs['length'].astype(str)]
+        lines = '\n'.join(['\t'.join(line) for line in zip(*[x.tolist() for x in columns])])
+        # Lines are separated by newlines, with no newline after the last line of the file
+        if not self.first:
+            lines = '\n'+lines
+        self.seg_out.write(lines.encode())
+        self.first = False
+    def close(self):
+        self.seg_out.close()
 
 def write_segs(sibpairs,allsegs,chr,outfile):
-    seg_out = gzip.open(outfile,'wb')
-    # Header
-    seg_out.write('ID1\tID2\tIBDType\tChr\tstart_coordinate\tstop_coordinate\tstartSNP\tstopSNP\tlength\n'.encode())
-    # Write segment lines
-    for i in range(0,sibpairs.shape[0]):
-        nseg = len(allsegs[i])
-        for j in range(nseg):
-            if i == (sibpairs.shape[0]-1) and j == (nseg-1):
-                seg_out.write(allsegs[i][j].to_text(sibpairs[i, 0], sibpairs[i, 1], chr, end=True).encode())
-            else:
-                seg_out.write(allsegs[i][j].to_text(sibpairs[i, 0], sibpairs[i, 1], chr, end=False).encode())
-    seg_out.close()
+    """Write lists of the :class:`segment` objects of sibling pairs (as returned by :func:`smooth_ibd`) with :class:`segment_writer`"""
+    segs, snps = segment_array(allsegs)
+    writer = segment_writer(outfile,chr,snps)
+    writer.write(sibpairs,segs)
+    writer.close()
 
 def write_segs_from_matrix(ibd,sibpairs,snps,pos,map,chrom,outfile):
     # Get segments
-    allsegs = []
-    for i in range(sibpairs.shape[0]):
-        allsegs.append(find_segments(ibd[i,:],map,snps,pos))
+    segs = find_ibd_segments(np.asarray(ibd, dtype=np.int8), map, pos)
     # Write segments
-    write_segs(sibpairs,allsegs,chrom,outfile)
-    return allsegs
+    writer = segment_writer(outfile,chrom,snps)
+    writer.write(sibpairs,segs)
+    writer.close()
+    return segment_lists(segs, sibpairs.shape[0], map, snps)
+
+# Memory (bytes) allowed for the [P x L] int8 matrix of IBD states of a batch of sibling pairs, which is only formed when writing the matrix
+ibd_batch_memory = 2**28
+
+def default_pair_batch_size(nsnp, ibdmatrix=False):
+    """Number of sibling pairs to infer IBD for at a time: when writing the matrix of IBD states, as many as fit in ibd_batch_memory;
+    otherwise, enough for each thread to decode several blocks of pairs (see :func:`infer_ibd_segments`), since only the segments of a batch are held"""
+    threads = get_num_threads()
+    if ibdmatrix:
+        return max(ibd_batch_memory//max(nsnp, 1), ibd_block_size*threads)
+    return ibd_block_size*threads*16
+
+def write_ibd_batches(sibpairs, sibpair_indices, gts, emissions, transitions, map, pos, snps, chrom, min_length, outfile,
+                      matrix_outfile=None, pair_batch_size=None):
+    """Infer IBD for a batch of sibling pairs at a time, writing the segments (and, if matrix_outfile is given, IBD states) of each batch
+    before moving to the next, so that the IBD states or segments of all pairs are never held in memory at once.
+    Args:
+        sibpairs : :class:`~numpy:numpy.array`
+            [P x 2] matrix of the IDs of the sibling pairs
+        sibpair_indices : :class:`~numpy:numpy.array`
+            [P x 2] matrix of the rows of the siblings in gts
+        gts : :class:`~numpy:numpy.array`
+            floating point matrix of genotypes, with NaN for missing
+        emissions : :class:`~numpy:numpy.array`
+            weighted log-probabilities of observed genotypes given IBD (see :func:`emission_table`)
+        transitions : :class:`~numpy:numpy.array`
+            log-probabilities of transitions between IBD states (see :func:`transition_table`)
+        map : :class:`~numpy:numpy.array`
+            floating point vector of genetic positions in cM
+        pos : :class:`~numpy:numpy.array`
+            integer vector of base pair positions
+        snps : :class:`~numpy:numpy.array`
+            vector of SNP IDs
+        chrom : chromosome of the SNPs
+        min_length : :class:`float`
+            smooth segments with length less than min_length (cM)
+        outfile : :class:`str`
+            path to the segments output file
+        matrix_outfile : :class:`str`
+            path to the IBD state matrix output file
+        pair_batch_size : :class:`int`
+            number of sibling pairs to infer IBD for at a time; by default, given by :func:`default_pair_batch_size`
+    """
+    if pair_batch_size is None:
+        pair_batch_size = default_pair_batch_size(gts.shape[1], ibdmatrix=matrix_outfile is not None)
+    seg_writer = segment_writer(outfile, chrom, snps)
+    if matrix_outfile is not None:
+        matrix_out = gzip.open(matrix_outfile, 'wt')
+        np.savetxt(matrix_out, np.column_stack((np.array(['sib1', 'sib2']).reshape((1, 2)), np.asarray(snps).reshape(1, gts.shape[1]))), fmt='%s')
+    nbatch = int(np.ceil(sibpairs.shape[0]/pair_batch_size))
+    for b in range(nbatch):
+        batch = slice(b*pair_batch_size, min((b+1)*pair_batch_size, sibpairs.shape[0]))
+        if nbatch > 1:
+            print('Inferring IBD for sibling pairs '+str(batch.start+1)+' to '+str(batch.stop)+' of '+str(sibpairs.shape[0]))
+        else:
+            print('Inferring IBD')
+        if matrix_outfile is not None:
+            ibd = infer_ibd(sibpair_indices[batch], gts, emissions, transitions)
+            segs = find_ibd_segments(ibd, map, pos, min_length=min_length)
+            np.savetxt(matrix_out, np.column_stack((sibpairs[batch], ibd)), fmt='%s')
+            del ibd
+        else:
+            segs = infer_ibd_segments(sibpair_indices[batch], gts, emissions, transitions, map, pos, min_length=min_length)
+        seg_writer.write(sibpairs[batch], segs)
+        del segs
+    seg_writer.close()
+    if matrix_outfile is not None:
+        matrix_out.close()
 
-def infer_ibd_chr(sibpairs, error_prob, error_probs, outprefix, bedfile=None, bgenfile=None, chrom=None, min_length=0.01, mapfile=None, ibdmatrix=False, ld_out=False, min_maf=0.01, max_missing=5, max_error=0.01):
+def infer_ibd_chr(sibpairs, error_prob, error_probs, outprefix, bedfile=None, bgenfile=None, chrom=None, min_length=0.01, mapfile=None, ibdmatrix=False, ld_out=False, min_maf=0.01, max_missing=5, max_error=0.01, native_bed=False, pair_batch_size=None):
     if bedfile is None and bgenfile is None:
         raise(ValueError('Must provide either bed file or bgenfile'))
     if bedfile is not None and bgenfile is not None:
@@ -284,7 +682,7 @@ def infer_ibd_chr(sibpairs, error_prob, error_probs, outprefix, bedfile=None, bg
                 chrom = chrom[0]
         print('Inferring IBD for chromosome ' + str(chrom))
         # Read sibling genotypes from bed file
-        gts = read_sibs_from_bed(bedfile, sibpairs)
+        gts = read_sibs_from_bed(bedfile, sibpairs, native_bed=native_bed)
     elif bgenfile is not None:
         ## Read bed
         print('Reading genotypes from ' + bgenfile)
@@ -306,24 +704,22 @@ def infer_ibd_chr(sibpairs, error_prob, error_probs, outprefix, bedfile=None, bg
     print('Calculating allele frequencies')
     gts.compute_freqs()
     # Check which sibling pairs have genotypes
-    sibpair_indices = np.zeros((sibpairs.shape), dtype=bool)
-    sibpair_indices[:, 0] = np.array([x in gts.id_dict for x in sibpairs[:, 0]])
-    sibpair_indices[:, 1] = np.array([x in gts.id_dict for x in sibpairs[:, 1]])
-    sibpairs = sibpairs[np.sum(sibpair_indices, axis=1) == 2, :]
+    sibpair_indices = np.column_stack((gts.id_dict.get_indexer(sibpairs[:, 0]), gts.id_dict.get_indexer(sibpairs[:, 1])))
+    genotyped = np.min(sibpair_indices, axis=1) >= 0
+    sibpairs = sibpairs[genotyped, :]
     if sibpairs.shape[0] == 0:
         raise (ValueError('No genotyped sibling pairs found'))
     print(str(np.sum(sibpairs.shape[0])) + ' sibpairs have genotypes')
     # Find indices of sibpairs
-    sibpair_indices = np.zeros((sibpairs.shape), dtype=int)
-    sibpair_indices[:, 0] = np.array([gts.id_dict[x] for x in sibpairs[:, 0]])
-    sibpair_indices[:, 1] = np.array([gts.id_dict[x] for x in sibpairs[:, 1]])
+    sibpair_indices = sibpair_indices[genotyped, :]
     # Filtering on MAF, LD score, and genotyping error
     # Find error probabilities
     p_error = np.zeros((gts.sid.shape[0]))
     p_error[:] = error_prob
     if error_probs is not None:
-        in_error_probs = np.array([x in error_probs.sid_dict for x in gts.sid])
-        error_index = np.array([error_probs.sid_dict[x] for x in gts.sid[in_error_probs]])
+        error_index = error_probs.sid_dict.get_indexer(gts.sid)
+        in_error_probs = error_index >= 0
+        error_index = error_index[in_error_probs]
         p_error[in_error_probs] = error_probs.error_ests[error_index]
     gts.error_probs = p_error
     # Filter
@@ -336,7 +732,7 @@ def infer_ibd_chr(sibpairs, error_prob, error_probs, outprefix, bedfile=None, bg
     if mapfile is None and bedfile is not None:
         print('Separate genetic map not provided, so attempting to read map from ' + bimfile)
         map = np.loadtxt(bimfile, usecols=2)
-        map_snp_dict = make_id_dict(np.loadtxt(bimfile, usecols=1, dtype=str))
+        map_snp_dict = id_index(np.loadtxt(bimfile, usecols=1, dtype=str))
         # Check for NAs
         if np.var(map) == 0:
             print('Map information not found in bim file.')
@@ -359,8 +755,8 @@ def infer_ibd_chr(sibpairs, error_prob, error_probs, outprefix, bedfile=None, bg
             # Check scale
             if np.max(map) > 5000:
                 raise (ValueError('Maximum value of map too large'))
-            gts.filter(np.array([x in map_snp_dict for x in gts.sid]))
-            gts.map = map[[map_snp_dict[x] for x in gts.sid]]
+            gts.filter(map_snp_dict.contains(gts.sid))
+            gts.map = map[map_snp_dict.get_indexer(gts.sid)]
     elif mapfile is None and bgenfile is not None:
         print('Map file not provided.')
         print('Using default map (decode sex averaged map on Hg19 coordinates)')
@@ -378,23 +774,20 @@ def infer_ibd_chr(sibpairs, error_prob, error_probs, outprefix, bedfile=None, bg
     print('Computing LD weights')
     ld = compute_ld_scores(np.array(gts.gts, dtype=np.float_), gts.map, max_dist=1)
     gts.weights = np.power(ld, -1)
+    # Emission and transition probabilities shared by all sibling pairs
+    emissions = emission_table(gts.freqs, gts.weights, gts.error_probs)
+    gts.transitions = transition_table(gts.map)
     # IBD
-    print('Inferring IBD')
-    ibd = infer_ibd(sibpair_indices, np.array(gts.gts,dtype=np.float_), gts.freqs, gts.map, gts.weights, gts.error_probs)
-    ibd, allsegs = smooth_ibd(ibd, gts.map, gts.sid, gts.pos, min_length)
-    ## Write output
-    # Write segments
+    gts_float = np.array(gts.gts,dtype=np.float_)
     segs_outfile = outfile_name(outprefix,'.ibd.segments.gz', chrom)
     print('Writing segments to ' + segs_outfile)
-    write_segs(sibpairs, allsegs, chrom, segs_outfile)
-    # Write matrix
     if ibdmatrix:
-        outfile = outfile_name(outprefix,'.ibdmatrix.gz', chrom)
-        print('Writing matrix output to ' + str(outfile))
-        ibd = np.row_stack(
-            (np.column_stack((np.array(['sib1', 'sib2']).reshape((1, 2)), gts.sid.reshape(1, gts.shape[1]))),
-             np.column_stack((sibpairs, ibd))))
-        np.savetxt(outfile, ibd, fmt='%s')
+        matrix_outfile = outfile_name(outprefix,'.ibdmatrix.gz', chrom)
+        print('Writing matrix output to ' + str(matrix_outfile))
+    else:
+        matrix_outfile = None
+    write_ibd_batches(sibpairs, sibpair_indices, gts_float, emissions, gts.transitions, gts.map, gts.pos, gts.sid, chrom, min_length,
+                      segs_outfile, matrix_outfile=matrix_outfile, pair_batch_size=pair_batch_size)
     if ld_out:
         ld_outfile = outfile_name(outprefix,'.l2.ldscore.gz', chrom)
         print('Writing LD-scores to '+ld_outfile)
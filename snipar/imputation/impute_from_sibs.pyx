@@ -26,6 +26,7 @@ import h5py
 from cython.parallel import prange
 cimport openmp
 from snipar.config import nan_integer as python_integer_nan
+from snipar.read.imputed import imputed_dataset_options
 from libc.stdio cimport printf
 cdef float nan_float = np.nan
 cdef int nan_integer = python_integer_nan
@@ -933,10 +934,11 @@ def impute(sibships, iid_to_bed_index,  phased_gts, unphased_gts, ibd, pos, hdf5
             Specifies the Number of threads to be used. If None there will be only one thread.
 
         output_compression : str
-            Optional compression algorithm used in writing the output as an hdf5 file. It can be either gzip or lzf. None means no compression.
+            Optional compression algorithm used in writing the output as an hdf5 file. It can be either gzip, lzf, or blosc (requires hdf5plugin). None means no compression.
+            Compressed output is byte-shuffled, and imputed_par_gts is chunked SNP-major (see snipar.read.imputed.imputed_dataset_options).
 
         output_compression_opts : int
-            Additional settings for the optional compression algorithm. Take a look at the create_dataset function of h5py library for more information. None means no compression setting.
+            Compression level for gzip or blosc. None means the default level.
         
         half_window : int, optional
             For each location i, the IBD inference for the haplotypes is restricted to [i-half_window, i+half_window].
@@ -1216,7 +1218,7 @@ def impute(sibships, iid_to_bed_index,  phased_gts, unphased_gts, ibd, pos, hdf5
         with h5py.File(output_address+".hdf5",'w') as file:                        
             for key, val in hdf5_output_dict.items():
                 if key=='imputed_par_gts':
-                    file.create_dataset(key, val.shape, dtype = 'float16', chunks = True, compression = output_compression, compression_opts=output_compression_opts, data = val)
+                    file.create_dataset(key, val.shape, dtype = 'float16', data = val, **imputed_dataset_options(val.shape, output_compression, output_compression_opts))
                 else:
                     file[key] = val
     return sibships["FID"].values.tolist(), np.array(imputed_par_gts)
\ No newline at end of file
@@ -19,6 +19,8 @@ import logging
 import pandas as pd
 import numpy as np
 from pysnptools.snpreader import Bed
+from snipar.read.bed import bed_reader
+from snipar.read.variants import read_bim
 from bgen_reader import open_bgen, read_bgen
 from snipar.config import nan_integer
 from tqdm import tqdm
@@ -593,7 +595,7 @@ def estimate_f(unphased_gts, pc_scores, linear=True):
     return fs, data
 
 
-def prepare_gts(phased_address, unphased_address, bim, pedigree_output, ped_ids, chromosomes, start=None, end=None, pcs=None, pc_ids=None, find_optimal_pc=None):
+def prepare_gts(phased_address, unphased_address, bim, pedigree_output, ped_ids, chromosomes, start=None, end=None, pcs=None, pc_ids=None, find_optimal_pc=None, native_bed=False):
     """ Processes the gts required data for the imputation and returns it.
 
     Outputs for used for the imputation have ascii bytes instead of strings.
@@ -632,6 +634,9 @@ def prepare_gts(phased_address, unphased_address, bim, pedigree_output, ped_ids,
         find_optimal_pc : bool, optional
             It will use Akaike information criterion to find the optimal number of PCs to use for MAF estimation.
 
+        native_bed : bool, optional
+            Read the unphased genotypes with the memory-mapped snipar.read.bed.bed_reader, which decodes only the slice of SNPs into float32, rather than pysnptools.
+
     Returns:
         tuple(np.array[signed char], np.array[signed char], str->int, np.array[int], np.array[float], dict)
             phased_gts: np.array[signed char], optional
@@ -662,8 +667,11 @@ def prepare_gts(phased_address, unphased_address, bim, pedigree_output, ped_ids,
     unphased_gts = None
     unphased_pc_gts = None    
     if unphased_address:
-        bim_as_csv = pd.read_csv(unphased_address+".bim", delim_whitespace=True, header=None)
-        gts_f = Bed(unphased_address+".bed",count_A1 = True, sid=bim_as_csv[1].values.tolist())
+        bim_variants = read_bim(unphased_address+".bim")
+        if native_bed:
+            gts_f = bed_reader(unphased_address+".bed")
+        else:
+            gts_f = Bed(unphased_address+".bed",count_A1 = True, sid=bim_variants.sid.tolist())
         logging.info(f"with chromosomes {chromosomes} opened unphased file ...")
         if not pc_ids is None:
             ids_in_ped_pc = [(id in ped_ids) and (id in pc_ids) for id in gts_f.iid[:,1].astype("S")]
@@ -672,17 +680,23 @@ def prepare_gts(phased_address, unphased_address, bim, pedigree_output, ped_ids,
         logging.info(f"with chromosomes {chromosomes} loaded ids ...")
         gts_ids = gts_f.iid[ids_in_ped_pc]
         logging.info(f"with chromosomes {chromosomes} restrict to ids ...")
-        all_sids = bim_as_csv[1].values
+        all_sids = bim_variants.sid
 
         if end is not None:
-            unphased_gts = gts_f[ids_in_ped_pc , start:end].read().val
+            if native_bed:
+                unphased_gts = gts_f.read(np.array(ids_in_ped_pc, dtype=bool), slice(start, end), dtype=np.float32)
+            else:
+                unphased_gts = gts_f[ids_in_ped_pc , start:end].read().val
             logging.info(f"with chromosomes {chromosomes} loaded genotypes ...")
             pos = gts_f.pos[start:end, 2]
             logging.info(f"with chromosomes {chromosomes} loaded pos ...")
             sid = all_sids[start:end]
             logging.info(f"with chromosomes {chromosomes} loaded sid ...")
         else:
-            unphased_gts = gts_f[ids_in_ped_pc, :].read().val
+            if native_bed:
+                unphased_gts = gts_f.read(np.array(ids_in_ped_pc, dtype=bool), dtype=np.float32)
+            else:
+                unphased_gts = gts_f[ids_in_ped_pc, :].read().val
             logging.info(f"with chromosomes {chromosomes} loaded genotypes ...")
             pos = gts_f.pos[:, 2]
             logging.info(f"with chromosomes {chromosomes} loaded pos ...")
@@ -748,8 +762,8 @@ def prepare_gts(phased_address, unphased_address, bim, pedigree_output, ped_ids,
             logging.warning(f"with chromosomes {chromosomes}: phased genotypes are greater than 1 in {num_phased_gts_greater1} locations. Converted to NaN")  
             phased_gts[phased_gts_greater1] = np.nan
     
-    standard_f = np.nanmean(unphased_gts,axis=0)/2.0
-    practical_f = unphased_gts.copy()
+    standard_f = np.nanmean(unphased_gts,axis=0,dtype=np.float64)/2.0
+    practical_f = np.zeros(unphased_gts.shape, dtype=np.float64)
     practical_f[:] = standard_f
 
     #transforming genotypes into int8
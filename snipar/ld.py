@@ -1,8 +1,8 @@
 from numba import njit, prange
 import numpy as np
-from snipar.utilities import make_id_dict
+from snipar.utilities import id_index
 from snipar.map import map_from_bed
-from pysnptools.snpreader import Bed
+from snipar.read.bed import open_bed, read_bed_gts
 
 #### Compute LD-scores ####
 @njit(parallel=True)
@@ -36,23 +36,23 @@ def r2_est(g1,g2):
     r2 = np.power(np.corrcoef(g1[not_nan],g2[not_nan])[0,1],2)
     return r2-(1-r2)/(np.sum(not_nan)-2)
 
-def ldscores_from_bed(bedfile, chrom, ld_wind, ld_out = None):
+def ldscores_from_bed(bedfile, chrom, ld_wind, ld_out = None, native_bed=False):
     # Get map
     map_snps, map = map_from_bed(bedfile, chrom)
     not_na = ~np.isnan(map)
     map = map[not_na]
     map_snps = map_snps[not_na]
-    map_snp_dict = make_id_dict(map_snps)
+    map_snp_dict = id_index(map_snps)
     # Read genotypes
     print('Reading genotypes')
-    bed = Bed(bedfile, count_A1 = True)
-    bed_in_map = np.array([x in map_snp_dict for x in bed.sid])
-    gts = bed[:,bed_in_map].read().val
+    bed = open_bed(bedfile, native_bed=native_bed)
+    bed_in_map = map_snp_dict.contains(bed.sid)
+    gts = read_bed_gts(bed, cols=bed_in_map)
     sid = bed.sid[bed_in_map]
     bim = bed.pos[bed_in_map,:]
     chrom = np.array(bim[:,0],dtype=int).reshape((sid.shape[0],1))
     pos = np.array(bim[:,2],dtype=int).reshape((sid.shape[0],1))
-    map = map[np.array([map_snp_dict[x] for x in sid])]
+    map = map[map_snp_dict.get_indexer(sid)]
     print('Computing LD scores')
     ldscores = compute_ld_scores(gts,map,ld_wind)
     if ld_out is not None:
@@ -29,29 +29,24 @@ class model(object):
         if add_intercept:
             X = np.hstack((np.ones((self.n, 1), dtype=X.dtype), X))
         self.X = X
-        # Label mapping
-        self.label_counts = dict()
-        self.label_indices = dict()
-        for l in range(0, labels.shape[0]):
-            if labels[l] not in self.label_counts:
-                self.label_counts[labels[l]] = 1
-                self.label_indices[labels[l]] = [l]
-            else:
-                self.label_counts[labels[l]] += 1
-                self.label_indices[labels[l]].append(l)
-        self.y_lab = dict()
-        self.X_lab = dict()
-        for label in self.label_indices.keys():
-            self.y_lab[label] = y[self.label_indices[label]]
-            self.X_lab[label] = X[self.label_indices[label], :]
-        self.n_labels = len(self.y_lab.keys())
+        # Families, with the members of each family contiguous in label_order
+        unique_labels, self.label_index, self.label_counts = np.unique(labels, return_inverse=True, return_counts=True)
+        self.label_order = np.argsort(self.label_index, kind='stable')
+        self.label_starts = np.hstack((0, np.cumsum(self.label_counts)[:-1]))
+        self.n_labels = unique_labels.shape[0]
+        # Sums of the covariates and of the phenotype within families, and their cross products over all individuals
+        self.X_lab_sums = np.add.reduceat(X[self.label_order, :], self.label_starts, axis=0)
+        self.y_lab_sums = np.add.reduceat(y[self.label_order], self.label_starts)
+        self.X_T_X = np.dot(X.T, X)
+        self.X_T_y = np.dot(X.T, y)
         # response
         self.y = y
         self.labels = labels
 
     def alpha_mle(self, tau, sigma2, compute_cov=False, xtx_out=False):
         """
-        Compute the MLE of alpha given variance parameters
+        Compute the MLE of alpha given variance parameters. The inverse of the compound symmetric covariance matrix of a family of size n
+        is (I-J/(tau+n))/sigma2, where J is a matrix of ones, so X'Sigma^(-1)X and X'Sigma^(-1)y only need the sums of X and y within families.
 
         Args:
             sigma2 : :class:`float`
@@ -64,16 +59,9 @@ class model(object):
                 MLE of alpha
 
         """
-        X_T_X = np.zeros((self.X.shape[1], self.X.shape[1]), dtype=np.float64)
-        X_T_y = np.zeros((self.X.shape[1]), dtype=np.float64)
-
-        for label in self.y_lab.keys():
-            sigma_u = sigma2 / tau
-            Sigma_lab = sigma_u * np.ones((self.label_counts[label], self.label_counts[label]))
-            np.fill_diagonal(Sigma_lab, sigma_u + sigma2)
-            Sigma_lab_inv = np.linalg.inv(Sigma_lab)
-            X_T_X = X_T_X + np.dot(self.X_lab[label].T, Sigma_lab_inv.dot(self.X_lab[label]))
-            X_T_y = X_T_y + np.dot(self.X_lab[label].T, Sigma_lab_inv.dot(self.y_lab[label]))
+        weighted_X_sums = self.X_lab_sums / (tau + self.label_counts).reshape((self.n_labels, 1))
+        X_T_X = (self.X_T_X - np.dot(weighted_X_sums.T, self.X_lab_sums)) / sigma2
+        X_T_y = (self.X_T_y - np.dot(weighted_X_sums.T, self.y_lab_sums)) / sigma2
 
         if xtx_out:
             return [X_T_X, X_T_y.reshape((self.X.shape[1]))]
@@ -113,21 +101,15 @@ class model(object):
         ## Gradient with respect to sigma2
         grad_sigma2 = self.n / sigma2 - RSS / np.square(sigma2)
 
+        ## Sums over families
+        resid_square_sum = np.square(self.y_lab_sums - self.X_lab_sums.dot(alpha))
+        tau_n = tau + self.label_counts
+        # Add to likelihood
+        L = L - np.sum(resid_square_sum / (sigma2 * tau_n)) + np.sum(np.log(1 + self.label_counts / tau))
+        # Add to grad sigma2
+        grad_sigma2 += np.sum(resid_square_sum / tau_n) / np.square(sigma2)
         ## Gradient with respect to tau
-        grad_tau = 0
-
-        for label in self.y_lab.keys():
-            resid_label = resid[self.label_indices[label]]
-            resid_sum = np.sum(resid_label)
-            resid_square_sum = np.square(resid_sum)
-            # Add to likelihood
-            L = L - resid_square_sum / (sigma2 * (tau + self.label_counts[label])) + np.log(
-                1 + self.label_counts[label] / tau)
-            # Add to grad sigma2
-            grad_sigma2 += resid_square_sum / (np.square(sigma2) * (tau + self.label_counts[label]))
-            # Add to grad tau
-            grad_tau += (resid_square_sum / sigma2 - self.label_counts[label] * (
-                        1 + self.label_counts[label] / tau)) / np.square(tau + self.label_counts[label])
+        grad_tau = np.sum((resid_square_sum / sigma2 - self.label_counts * (1 + self.label_counts / tau)) / np.square(tau_n))
 
         # Overall gradient vector
         grad = np.hstack((grad_sigma2, grad_tau))
@@ -154,8 +136,7 @@ class model(object):
         # Paramtere boundaries
         parbounds = [(0.00001, None), (0.00001, None)]
         # Optimize
-        optimized = fmin_l_bfgs_b(func=lik_and_grad, x0=init_params,
-                                  args=(self.y, self.X, self.labels),
+        optimized = fmin_l_bfgs_b(func=lambda pars: self.likelihood_and_gradient(pars[0], pars[1]), x0=init_params,
                                   bounds=parbounds)
 
         # Get MLE
@@ -173,20 +154,38 @@ class model(object):
         return optim
 
     def sigma_inv_root(self, tau, sigma2):
-        sigma_u = sigma2 / tau
+        """
+        Inverse square roots of the covariance matrices of the family sizes in the model. The inverse square root of the compound symmetric
+        covariance matrix of a family of size n is a*I+b*J, where a=sigma2^(-1/2) and a+n*b is the inverse square root of sigma2*(1+n/tau).
+        """
         sigma2_nsqrt = dict()
-        famsizes = np.unique(list(self.label_counts.values()))
-        sigma2_nsqrt[1] = np.power(sigma_u + sigma2, -0.5)
+        famsizes = np.unique(self.label_counts)
+        sigma2_nsqrt[1] = np.power(sigma2 / tau + sigma2, -0.5)
         famsizes = famsizes[famsizes > 1]
         for famsize in famsizes:
-            Sigma_lab = sigma_u * np.ones((famsize, famsize))
-            np.fill_diagonal(Sigma_lab, sigma_u + sigma2)
-            vals, vectors = np.linalg.eigh(Sigma_lab)
-            vals = np.power(vals, 0.25)
-            vectors = vectors / vals
-            sigma2_nsqrt[famsize] = vectors.dot(vectors.T)
+            a = np.power(sigma2, -0.5)
+            b = (np.power(sigma2 * (1 + famsize / tau), -0.5) - a) / famsize
+            Sigma_nsqrt = b * np.ones((famsize, famsize))
+            np.fill_diagonal(Sigma_nsqrt, a + b)
+            sigma2_nsqrt[int(famsize)] = Sigma_nsqrt
         return sigma2_nsqrt
 
+    def change_tau(self, tau_from, tau_to):
+        """
+        Matrices, by family size, that map a vector transformed by the inverse square roots for tau_from (see sigma_inv_root) to its transform
+        by the inverse square roots for tau_to, with the same sigma2. The inverse square roots of a family of size n only differ in the eigenvalue
+        of the vector of ones, so the matrix is I+(c-1)/n*J, where c=((1+n/tau_from)/(1+n/tau_to))^(1/2).
+        """
+        change = dict()
+        famsizes = np.unique(self.label_counts)
+        for famsize in famsizes:
+            c = np.power((1 + famsize / tau_from) / (1 + famsize / tau_to), 0.5)
+            if famsize == 1:
+                change[1] = c
+            else:
+                change[int(famsize)] = np.identity(famsize) + (c - 1) / famsize * np.ones((famsize, famsize))
+        return change
+
     def predict(self, X):
         """
         Predict new observations based on model regression coefficients
@@ -2,7 +2,7 @@ from numba import njit, prange
 import numpy as np
 from os import path
 import snipar
-from snipar.utilities import make_id_dict
+from snipar.utilities import id_index
 from snipar.gtarray import gtarray
 
 @njit
@@ -21,11 +21,16 @@ def pos_to_cM(pos,boundaries, cM_pos):
                     current_seg += 1
     return cM_out
 
-def decode_map_from_pos(chrom,pos):
+def read_decode_map(chrom):
+    """Read the decode sex averaged map of a chromosome: the boundaries (in bp) of its segments and the genetic position (in cM) of each segment."""
     decode_map_path = path.join(path.dirname(snipar.__file__), f'util_data/decode_map/chr_{chrom}.gz')
     map = np.loadtxt(decode_map_path, dtype=float, skiprows=1)
     boundaries = np.hstack((np.array(map[0, 0], dtype=np.int_),np.array(map[:, 1], dtype=np.int_)))
-    return pos_to_cM(pos, boundaries, map[:, 2])
+    return boundaries, map[:, 2]
+
+def decode_map_from_pos(chrom,pos):
+    boundaries, cM_pos = read_decode_map(str(chrom))
+    return pos_to_cM(pos, boundaries, cM_pos)
 
 
 # Read header of mapfile
@@ -37,7 +42,7 @@ def get_map_positions(mapfile,gts,min_map_prop = 0.5):
     map_file.close()
     if 'pposition' in map_header and 'gposition' in map_header:
         bp_pos = np.loadtxt(mapfile,usecols = np.where(map_header=='pposition')[0][0], dtype=int, skiprows =1)
-        pos_dict = make_id_dict(bp_pos)
+        pos_dict = id_index(bp_pos)
         cm_pos = np.loadtxt(mapfile,usecols = np.where(map_header=='gposition')[0][0], dtype=float, skiprows =1)
         # Check for NAs
         if np.sum(np.isnan(cm_pos)) > 0:
@@ -58,14 +63,15 @@ def get_map_positions(mapfile,gts,min_map_prop = 0.5):
         # Find positions of SNPs in map file
         map = np.zeros((gts.shape[1]),dtype=float)
         map[:] = np.nan
-        in_map = np.array([x in pos_dict for x in gts.pos])
+        map_indices = pos_dict.get_indexer(gts.pos)
+        in_map = map_indices >= 0
         # Check if we have at least 50% of SNPs in map
         prop_in_map = np.mean(in_map)
         if prop_in_map < min_map_prop:
             raise(ValueError('Only '+str(round(100*prop_in_map))+'% of SNPs have genetic positions in '+mapfile+'. Need at least '+str(round(100*min_map_prop))+'%'))
         print('Found genetic map positions for '+str(round(100*prop_in_map))+'% of SNPs in '+mapfile)
         # Fill in map values
-        map[in_map] = cm_pos[[pos_dict[x] for x in gts.pos[in_map]]]
+        map[in_map] = cm_pos[map_indices[in_map]]
         # Linearly interpolate map
         if prop_in_map < 1:
             print('Linearly interpolating genetic map for SNPs not in input map')
@@ -1,7 +1,7 @@
 import numpy as np
 import pandas as pd
 import logging
-from snipar.utilities import make_id_dict
+from snipar.utilities import id_index
 
 def get_sibpairs_from_ped(ped):
     # Remove rows with missing parents
@@ -171,17 +171,18 @@ def find_individuals_with_sibs(ids, ped, gts_ids, return_ids_only = False):
     Used in get_gts_matrix and get_fam_means to find the individuals in ids that have genotyped siblings.
     """
     # Find genotyped sibships of size > 1
-    ped_dict = make_id_dict(ped, 1)
-    ids_in_ped = np.array([x in ped_dict for x in gts_ids])
+    ped_dict = id_index(ped, 1)
+    ped_indices = ped_dict.get_indexer(gts_ids)
+    ids_in_ped = ped_indices >= 0
     gts_fams = np.zeros((gts_ids.shape[0]),dtype=gts_ids.dtype)
-    gts_fams[ids_in_ped] = np.array([ped[ped_dict[x], 0] for x in gts_ids[ids_in_ped]])
+    gts_fams[ids_in_ped] = ped[ped_indices[ids_in_ped], 0]
     fams, counts = np.unique(gts_fams[ids_in_ped], return_counts=True)
-    sibships = set(fams[counts > 1])
     # Find individuals with genotyped siblings
-    ids_in_ped = np.array([x in ped_dict for x in ids])
+    ped_indices = ped_dict.get_indexer(ids)
+    ids_in_ped = ped_indices >= 0
     ids = ids[ids_in_ped]
-    ids_fams = np.array([ped[ped_dict[x], 0] for x in ids])
-    ids_with_sibs = np.array([x in sibships for x in ids_fams])
+    ids_fams = ped[ped_indices[ids_in_ped], 0]
+    ids_with_sibs = np.isin(ids_fams, fams[counts > 1])
     ids = ids[ids_with_sibs]
     ids_fams = ids_fams[ids_with_sibs]
     if return_ids_only:
@@ -21,7 +21,7 @@ class pgs(object):
     def __init__(self,snp_ids,weights,alleles):
         if snp_ids.shape[0] == weights.shape[0] and alleles.shape[0] == weights.shape[0] and alleles.shape[1]==2:
             self.snp_ids = snp_ids
-            self.snp_dict = make_id_dict(snp_ids)
+            self.snp_dict = id_index(snp_ids)
             self.weights = weights
             self.alleles = alleles
         else:
@@ -54,16 +54,15 @@ class pgs(object):
         if garray.alleles is None:
             raise ValueError('Alleles of genotype matrix must be provided')
         # Match SNP IDs
-        in_pgs_snps = np.array([x in self.snp_dict for x in garray.sid])
+        pgs_snp_indices = self.snp_dict.get_indexer(garray.sid)
+        in_pgs_snps = pgs_snp_indices >= 0
         nmatch = np.sum(in_pgs_snps)
         if nmatch==0:
             raise ValueError('No overlap between PGS SNPs and genotype SNPs')
         # Get weights
         matched_snps = garray.sid[in_pgs_snps]
         matched_alleles = garray.alleles[in_pgs_snps,:]
-        snp_indices = np.zeros((nmatch),dtype=int)
-        for i in range(0,nmatch):
-            snp_indices[i] = self.snp_dict[matched_snps[i]]
+        snp_indices = pgs_snp_indices[in_pgs_snps]
         weights_compute = self.weights[snp_indices]
         alleles = self.alleles[snp_indices,:]
 
@@ -87,7 +86,7 @@ class pgs(object):
 
         return gtarray(pgs_val, garray.ids, sid=cols, fams=garray.fams)
 
-def compute(pgs, bedfile=None, bgenfile=None, par_gts_f=None, ped=None, sib=False, compute_controls=False, verbose=True):
+def compute(pgs, bedfile=None, bgenfile=None, par_gts_f=None, ped=None, sib=False, compute_controls=False, verbose=True, native_bed=False, storefile=None):
     """Compute a polygenic score (PGS) for the individuals with observed genotypes and observed/imputed parental genotypes.
 
     Args:
@@ -101,6 +100,10 @@ def compute(pgs, bedfile=None, bgenfile=None, par_gts_f=None, ped=None, sib=Fals
             Compute the PGS for genotyped individuals with at least one genotyped sibling and observed/imputed parental genotypes. Default False.
         compute_controls : :class:`bool`
             Compute polygenic scores for control families (families with observed parental genotypes set to missing). Default False.
+        native_bed : :class:`bool`
+            Read the bed file with the memory-mapped :class:`snipar.read.bed.bed_reader` rather than pysnptools. Default False.
+        storefile : :class:`str`
+            path to a family genotype store (see :func:`snipar.read.store.build_store`) to read the genotypes from, in place of the genotype files
 
     Returns:
         pg : :class:`snipar.gtarray`
@@ -108,7 +111,7 @@ def compute(pgs, bedfile=None, bgenfile=None, par_gts_f=None, ped=None, sib=Fals
             observed/imputed maternal PGS
 
     """
-    G = get_gts_matrix(bedfile=bedfile, bgenfile=bgenfile, par_gts_f=par_gts_f, ped=ped, snp_ids=pgs.snp_ids, sib=sib, compute_controls=compute_controls, verbose=verbose)
+    G = get_gts_matrix(bedfile=bedfile, bgenfile=bgenfile, par_gts_f=par_gts_f, ped=ped, snp_ids=pgs.snp_ids, sib=sib, compute_controls=compute_controls, verbose=verbose, native_bed=native_bed, storefile=storefile)
     if sib:
         cols = np.array(['proband', 'sibling', 'paternal', 'maternal'])
     else:
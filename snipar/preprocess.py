@@ -1,5 +1,5 @@
 import numpy as np
-from snipar.utilities import make_id_dict
+from snipar.utilities import id_index
 from snipar.pedigree import find_individuals_with_sibs
 from snipar.gtarray import gtarray
 
@@ -9,8 +9,8 @@ def get_indices_given_ped(ped, gts_ids, imp_fams=None, ids=None, sib=False, verb
     It returns those ids along with the indices of the relevant individuals and their first degree relatives in the observed genotypes (observed indices),
     and the indices of the imputed parental genotypes for those individuals.
     """
-    # Made dictionary for observed genotypes
-    gts_id_dict = make_id_dict(gts_ids)
+    # Make index of observed genotypes
+    gts_id_dict = id_index(gts_ids)
     # If IDs not provided, use all individuals with observed genotypes
     if ids is None:
         ids = gts_ids
@@ -55,6 +55,7 @@ def find_par_gts(pheno_ids, ped, gts_id_dict, imp_fams=None):
     """
     Used in get_gts_matrix to find whether individuals have imputed or observed parental genotypes, and to
     find the indices of the observed/imputed parents in the observed/imputed genotype arrays.
+    'gts_id_dict' is an index of the IDs of the observed genotypes (see snipar.utilities.id_index).
     'par_status' codes whether an individual has parents that are observed or imputed or neither.
     'gt_indices' records the relevant index of the parent in the observed/imputed genotype arrays
     'fam_labels' records the family of the individual based on the pedigree
@@ -65,42 +66,28 @@ def find_par_gts(pheno_ids, ped, gts_id_dict, imp_fams=None):
     # Indices of obsered/imputed genotypes in relevant arrays
     gt_indices = np.zeros((pheno_ids.shape[0],3),dtype=int)
     gt_indices[:] = -1
-    ## Build dictionaries
-    # Where each individual is in the pedigree
-    ped_dict = make_id_dict(ped,1)
-    # Where the imputed data is for each family
-    if imp_fams is not None:
-        fam_dict = make_id_dict(imp_fams)
     # Store family ID of each individual
     fam_labels = np.zeros((pheno_ids.shape[0]),dtype=ped.dtype)
-    # Find status and find indices
-    for i in range(0,pheno_ids.shape[0]):
-        # Find index in genotypes
-        if pheno_ids[i] in gts_id_dict:
-            gt_indices[i,0] = gts_id_dict[pheno_ids[i]]
-        # Find index in pedigree
-        if pheno_ids[i] in ped_dict:
-            ped_i = ped[ped_dict[pheno_ids[i]], :]
-            fam_labels[i] = ped_i[0]
-            # Check for observed father
-            if ped_i[2] in gts_id_dict:
-                gt_indices[i,1] = gts_id_dict[ped_i[2]]
-                par_status[i,0] = 0
-            # Check for observed mother
-            if ped_i[3] in gts_id_dict:
-                gt_indices[i, 2] = gts_id_dict[ped_i[3]]
-                par_status[i,1] = 0
-            # If parent not observed, look for imputation
-            if imp_fams is not None:
-                if ped_i[0] in fam_dict:
-                    imp_index = fam_dict[ped_i[0]]
-                    # Check if this is imputation of father, or mother, or both
-                    if ped_i[4] == 'False' and not par_status[i,0] == 0:
-                        gt_indices[i, 1] = imp_index
-                        par_status[i, 0] = 1
-                    if ped_i[5] == 'False' and not par_status[i,1] == 0:
-                        gt_indices[i, 2] = imp_index
-                        par_status[i, 1] = 1
+    # Find index in genotypes
+    gt_indices[:, 0] = gts_id_dict.get_indexer(pheno_ids)
+    # Find index in pedigree
+    ped_indices = id_index(ped, 1).get_indexer(pheno_ids)
+    in_ped = ped_indices >= 0
+    ped_in = ped[ped_indices[in_ped], :]
+    fam_labels[in_ped] = ped_in[:, 0]
+    # Check for observed father and mother
+    par_indices = np.column_stack((gts_id_dict.get_indexer(ped_in[:, 2]), gts_id_dict.get_indexer(ped_in[:, 3])))
+    gt_indices[in_ped, 1:3] = par_indices
+    par_status[in_ped, :] = np.where(par_indices >= 0, 0, -1)
+    # If parent not observed, look for imputation
+    if imp_fams is not None:
+        imp_indices = id_index(imp_fams).get_indexer(ped_in[:, 0])
+        for j in range(2):
+            # Check if this is imputation of father, or mother, or both
+            imputed = np.logical_and(imp_indices >= 0, np.logical_and(ped_in[:, 4+j] == 'False', par_indices[:, j] < 0))
+            rows = np.flatnonzero(in_ped)[imputed]
+            gt_indices[rows, 1+j] = imp_indices[imputed]
+            par_status[rows, j] = 1
     return par_status, gt_indices, fam_labels
 
 def make_gts_matrix(gts, par_status, gt_indices, imp_gts=None, parsum = False):
@@ -145,27 +132,128 @@ def get_fam_means(ids,ped,gts,gts_ids,remove_proband = True, return_famsizes = F
     """
     ids, ids_fams, gts_fams = find_individuals_with_sibs(ids, ped, gts_ids)
     fams = np.unique(ids_fams)
-    fams_dict = make_id_dict(fams)
+    fam_indices = id_index(fams).get_indexer(ids_fams)
     # Compute sums of genotypes in each family
     fam_sums = np.zeros((fams.shape[0],gts.shape[1]),dtype=gts.dtype)
     fam_counts = np.zeros((fams.shape[0]),dtype=int)
     for i in range(0,fams.shape[0]):
-        fam_indices = np.where(gts_fams==fams[i])[0]
-        fam_sums[i,:] = np.sum(gts[fam_indices,:],axis=0)
-        fam_counts[i] = fam_indices.shape[0]
+        fam_members = np.where(gts_fams==fams[i])[0]
+        fam_sums[i,:] = np.sum(gts[fam_members,:],axis=0)
+        fam_counts[i] = fam_members.shape[0]
     # Place in vector corresponding to IDs
     if remove_proband:
-        gts_id_dict = make_id_dict(gts_ids)
+        gts_indices = id_index(gts_ids).get_indexer(ids)
     G_sib = np.zeros((ids.shape[0],gts.shape[1]),dtype = np.float32)
     for i in range(0,ids.shape[0]):
-        fam_index = fams_dict[ids_fams[i]]
+        fam_index = fam_indices[i]
         G_sib[i,:] = fam_sums[fam_index,:]
         n_i = fam_counts[fam_index]
         if remove_proband:
-            G_sib[i,:] = G_sib[i,:] - gts[gts_id_dict[ids[i]],:]
+            G_sib[i,:] = G_sib[i,:] - gts[gts_indices[i],:]
             n_i = n_i-1
         G_sib[i,:] = G_sib[i,:]/float(n_i)
     if return_famsizes:
         return [gtarray(G_sib, ids),fam_counts,fam_sums]
     else:
-        return gtarray(G_sib,ids)
\ No newline at end of file
+        return gtarray(G_sib,ids)
+
+
+class family_design(object):
+    """Define the sample side of a family based genotype matrix: which individuals are included, where their observed genotypes
+    and observed/imputed parental genotypes are found, and their families. This only depends on the pedigree and on the
+    individuals in the observed/imputed genotype files, so it can be computed once per chromosome and reused for every batch of SNPs.
+
+    Args:
+        ped : :class:`~numpy:numpy.array`
+            pedigree array with columns FID, IID, FATHER_ID, MOTHER_ID (and has_father, has_mother if imputed parental genotypes are used)
+        gts_ids : :class:`~numpy:numpy.array`
+            vector of IDs of individuals in the observed genotype file
+        imp_fams : :class:`~numpy:numpy.array`
+            vector of family IDs in the imputed parental genotype file, if using imputed parental genotypes
+        ids : :class:`~numpy:numpy.array`
+            If provided, only include these individuals (see get_indices_given_ped)
+        sib : :class:`bool`
+            Include only individuals with genotyped siblings and add the mean of their siblings' genotypes to the design. Default False.
+
+    Returns:
+        design : :class:`snipar.preprocess.family_design`
+
+    """
+    def __init__(self, ped, gts_ids, imp_fams=None, ids=None, sib=False, verbose=False):
+        ids, observed_indices, imp_indices, parcount = get_indices_given_ped(ped, gts_ids, imp_fams=imp_fams, ids=ids,
+                                                                            sib=sib, verbose=verbose)
+        self.ped = ped
+        self.sib = sib
+        # Rows of the observed/imputed genotype files to read
+        self.observed_indices = observed_indices
+        self.imp_indices = imp_indices
+        self.obs_ids = gts_ids[observed_indices]
+        if imp_fams is not None:
+            self.imp_fams = imp_fams[imp_indices]
+        else:
+            self.imp_fams = None
+        # Indices of individuals and their parents in the reduced observed/imputed genotype arrays
+        self.par_status, self.gt_indices, self.fam_labels = find_par_gts(ids, ped, id_index(self.obs_ids), imp_fams=self.imp_fams)
+        self.ids = ids
+        self.parcount = parcount
+        if sib:
+            self._find_sibships()
+
+    def _find_sibships(self):
+        """
+        Find the genotyped sibships used to compute the mean of each individual's siblings' genotypes (see get_fam_means).
+        """
+        sib_ids, ids_fams, gts_fams = find_individuals_with_sibs(self.ids, self.ped, self.obs_ids)
+        if not sib_ids.shape[0] == self.ids.shape[0]:
+            raise(ValueError('Not all individuals have genotyped siblings'))
+        fams = np.unique(ids_fams)
+        fams_index = id_index(fams)
+        # Family of each individual with observed genotypes; -1 if not in a sibship
+        self.sib_gts_fams = fams_index.get_indexer(gts_fams)
+        self.sib_fam_counts = np.bincount(self.sib_gts_fams[self.sib_gts_fams >= 0], minlength=fams.shape[0])
+        self.sib_fams = fams_index.get_indexer(ids_fams)
+        self.sib_self_indices = id_index(self.obs_ids).get_indexer(self.ids)
+
+    def filter_ids(self, keep_ids):
+        """
+        Keep only individuals with ids given by keep_ids, retaining the current ordering of individuals
+        """
+        keep = id_index(keep_ids).contains(self.ids)
+        if np.sum(keep) == 0:
+            raise(ValueError('No individuals would be left after filtering'))
+        self.ids = self.ids[keep]
+        self.par_status = self.par_status[keep, :]
+        self.gt_indices = self.gt_indices[keep, :]
+        self.fam_labels = self.fam_labels[keep]
+        self.parcount = self.parcount[keep]
+        if self.sib:
+            self.sib_fams = self.sib_fams[keep]
+            self.sib_self_indices = self.sib_self_indices[keep]
+
+    def sib_means(self, gts):
+        """
+        Mean of the genotypes of each individual's genotyped siblings, given the observed genotypes of the individuals in obs_ids
+        """
+        in_sibship = self.sib_gts_fams >= 0
+        fam_sums = np.zeros((self.sib_fam_counts.shape[0], gts.shape[1]), dtype=gts.dtype)
+        np.add.at(fam_sums, self.sib_gts_fams[in_sibship], gts[in_sibship, :])
+        G_sib = np.array(fam_sums[self.sib_fams, :] - gts[self.sib_self_indices, :], dtype=np.float32)
+        G_sib /= (self.sib_fam_counts[self.sib_fams] - 1).reshape((self.ids.shape[0], 1))
+        return G_sib
+
+    def gts_matrix(self, gts, imp_gts=None, parsum=False):
+        """
+        Construct the family based genotype matrix from the observed genotypes of the individuals in obs_ids
+        and the imputed parental genotypes of the families in imp_fams.
+        """
+        if self.sib:
+            if parsum:
+                G = np.zeros((self.ids.shape[0], 3, gts.shape[1]), dtype=np.float32)
+                G[:, np.array([0, 2]), :] = make_gts_matrix(gts, self.par_status, self.gt_indices, imp_gts=imp_gts, parsum=parsum)
+            else:
+                G = np.zeros((self.ids.shape[0], 4, gts.shape[1]), dtype=np.float32)
+                G[:, np.array([0, 2, 3]), :] = make_gts_matrix(gts, self.par_status, self.gt_indices, imp_gts=imp_gts, parsum=parsum)
+            G[:, 1, :] = self.sib_means(gts)
+        else:
+            G = make_gts_matrix(gts, self.par_status, self.gt_indices, imp_gts=imp_gts, parsum=parsum)
+        return G
@@ -1,11 +1,63 @@
 import snipar.read.bed as bed
 import snipar.read.bgen as bgen
 import snipar.read.phenotype as phenotype
+import snipar.read.variants as variants
+import snipar.read.imputed as imputed
+import snipar.read.store as store
 import h5py
 import numpy as np
 from snipar.utilities import convert_str_array
 
-def get_gts_matrix(ped=None, bedfile=None, bgenfile=None, par_gts_f=None, snp_ids = None, ids = None, parsum=False, sib = False, compute_controls = False, verbose=False, print_sample_info=False):
+def get_family_design(ped=None, bedfile=None, bgenfile=None, par_gts_f=None, ids = None, sib = False, verbose=False, native_bed=False, storefile=None):
+    """Opens the observed and imputed genotype files and finds the individuals with observed/imputed parental genotypes,
+    and if sib=True, at least one genotyped sibling. The result can be passed to get_gts_matrix to construct family based genotype matrices
+    for many batches of SNPs without repeating this work for each batch.
+
+    Args:
+        par_gts_f : :class:`str`
+            path to HDF5 file with imputed parental genotypes
+        bedfile : :class:`str`
+            path to bed file with observed genotypes
+        bgenfile : :class:`str`
+            path to bgen file with observed genotypes
+        ids : :class:`numpy.ndarray`
+            If provided, only obtains the ids with observed genotypes and imputed/observed parental genotypes (and observed sibling genotypes if sib=True)
+        sib : :class:`bool`
+            Retrieve genotypes for individuals with at least one genotyped sibling. Default False.
+        native_bed : :class:`bool`
+            Read the bed file with the memory-mapped :class:`snipar.read.bed.bed_reader` rather than pysnptools. Default False.
+        storefile : :class:`str`
+            path to a family genotype store (see :func:`snipar.read.store.build_store`). If provided, the genotype files and pedigree are not used.
+
+    Returns:
+        design : :class:`snipar.preprocess.family_design`
+            sample information for the family based genotype matrix, along with the open genotype files. A :class:`snipar.read.store.store_design`
+            if storefile is provided.
+
+    """
+    if storefile is not None:
+        return store.store_design(storefile, ids=ids, sib=sib)
+    if ped is None and par_gts_f is None:
+        raise(ValueError('Must provide one of pedigree and imputed parental genotypes file'))
+    if bedfile is None and bgenfile is None:
+        raise(ValueError('Must provide one bed file or one bgen file'))
+    if bedfile is not None and bgenfile is not None:
+        raise(ValueError('Must provide one bed file or one bgen file'))
+    if par_gts_f is not None:
+        ### Imputed parental file ###
+        par_gts_f = h5py.File(par_gts_f,'r')
+        # Get pedigree
+        ped = convert_str_array(par_gts_f['pedigree'])
+        ped = ped[1:ped.shape[0],:]
+    # Remove control families
+    controls = np.array([x[0]=='_' for x in ped[:,0]])
+    ped = ped[np.logical_not(controls),:]
+    if bedfile is not None:
+        return bed.get_family_design(ped, bedfile, par_gts_f=par_gts_f, ids=ids, sib=sib, verbose=verbose, native_bed=native_bed)
+    else:
+        return bgen.get_family_design(ped, bgenfile, par_gts_f=par_gts_f, ids=ids, sib=sib, verbose=verbose)
+
+def get_gts_matrix(ped=None, bedfile=None, bgenfile=None, par_gts_f=None, snp_ids = None, ids = None, parsum=False, sib = False, compute_controls = False, verbose=False, print_sample_info=False, design=None, native_bed=False, storefile=None):
     """Reads observed and imputed genotypes and constructs a family based genotype matrix for the individuals with
     observed/imputed parental genotypes, and if sib=True, at least one genotyped sibling.
 
@@ -24,6 +76,13 @@ def get_gts_matrix(ped=None, bedfile=None, bgenfile=None, par_gts_f=None, snp_id
             Compute polygenic scores for control families (families with observed parental genotypes set to missing). Default False.
         parsum : :class:`bool`
             Return the sum of maternal and paternal observed/imputed genotypes rather than separate maternal/paternal genotypes. Default False.
+        design : :class:`snipar.preprocess.family_design`
+            Output of get_family_design. If provided, the genotype files, pedigree, ids and sib arguments are taken from the design. Cannot be used with compute_controls.
+        native_bed : :class:`bool`
+            Read the bed file with the memory-mapped :class:`snipar.read.bed.bed_reader` rather than pysnptools. Default False.
+        storefile : :class:`str`
+            path to a family genotype store (see :func:`snipar.read.store.build_store`) to read the family based genotype matrix from,
+            rather than from the genotype files. Cannot be used with compute_controls.
 
     Returns:
         G : :class:`snipar.gtarray`
@@ -36,6 +95,19 @@ def get_gts_matrix(ped=None, bedfile=None, bgenfile=None, par_gts_f=None, snp_id
             to missing, the father has been set to missing, and both parents have been set to missing.
 
     """
+    if storefile is not None and design is None:
+        if compute_controls:
+            raise(ValueError('Cannot compute control genotype matrices from a family genotype store'))
+        design = store.store_design(storefile, ids=ids, sib=sib)
+    if design is not None:
+        if compute_controls:
+            raise(ValueError('Cannot compute control genotype matrices from a precomputed design'))
+        if isinstance(design, store.store_design):
+            return design.read(snp_ids=snp_ids, parsum=parsum, verbose=verbose)
+        if design.bedfile is not None:
+            return bed.get_gts_matrix_given_ped(design.ped, design.bedfile, snp_ids=snp_ids, parsum=parsum, verbose=verbose, design=design)
+        else:
+            return bgen.get_gts_matrix_given_ped(design.ped, design.bgenfile, snp_ids=snp_ids, parsum=parsum, verbose=verbose, design=design)
     ####### Find parental status #######
     if ped is None and par_gts_f is None:
         raise(ValueError('Must provide one of pedigree and imputed parental genotypes file'))
@@ -55,19 +127,19 @@ def get_gts_matrix(ped=None, bedfile=None, bgenfile=None, par_gts_f=None, snp_id
     if bedfile is not None:
         G = [bed.get_gts_matrix_given_ped(ped[np.logical_not(controls),:], bedfile, par_gts_f=par_gts_f,
                                       snp_ids=snp_ids, ids=ids, sib=sib, parsum=parsum, verbose=verbose,
-                                      print_sample_info = print_sample_info)]
+                                      print_sample_info = print_sample_info, native_bed=native_bed)]
         if compute_controls:
             G.append(bed.get_gts_matrix_given_ped(ped[np.array([x[0:3]=='_p_' for x in ped[:,0]]),], bedfile,
                                                 par_gts_f=par_gts_f, snp_ids=snp_ids, ids=ids, sib=sib, 
-                                                parsum=parsum, verbose=verbose, print_sample_info = print_sample_info))
+                                                parsum=parsum, verbose=verbose, print_sample_info = print_sample_info, native_bed=native_bed))
             G.append(
                 bed.get_gts_matrix_given_ped(ped[np.array([x[0:3] == '_m_' for x in ped[:, 0]]),], bedfile, 
                                             par_gts_f=par_gts_f, snp_ids=snp_ids, ids=ids, sib=sib, parsum=parsum,
-                                            verbose=verbose, print_sample_info = print_sample_info))
+                                            verbose=verbose, print_sample_info = print_sample_info, native_bed=native_bed))
             G.append(
                 bed.get_gts_matrix_given_ped(ped[np.array([x[0:3] == '_o_' for x in ped[:, 0]]),], bedfile, 
                                             par_gts_f=par_gts_f, snp_ids=snp_ids, ids=ids, sib=sib, parsum=parsum, 
-                                            verbose=verbose, print_sample_info = print_sample_info))
+                                            verbose=verbose, print_sample_info = print_sample_info, native_bed=native_bed))
             return G
         else:
             return G[0]
@@ -1,9 +1,154 @@
 import snipar.preprocess as preprocess
 import numpy as np
+import pandas as pd
+import threading
+from numba import njit, prange
 from pysnptools.snpreader import Bed
 from snipar.gtarray import gtarray
+from snipar.read.imputed import imputed_reader
+from snipar.read.variants import read_bim, read_imputed_variants
 from snipar.utilities import *
 
+bed_magic = np.array([0x6c, 0x1b, 0x01], dtype=np.uint8)
+bed_chrom_map = {'X': 23, 'Y': 24, 'XY': 25, 'MT': 26}
+
+def _decode_bed(bed_bytes, bytes_per_snp, rows, cols, lookup, out):
+    """
+    Decode the 2-bit genotypes of individuals (rows) at SNPs (cols, relative to the start of bed_bytes) into out, using lookup to map
+    from the 2-bit codes to genotypes.
+    """
+    for j in prange(cols.shape[0]):
+        offset = cols[j] * bytes_per_snp
+        for i in range(rows.shape[0]):
+            r = rows[i]
+            code = (bed_bytes[offset + (r >> 2)] >> (2 * (r & 3))) & 3
+            out[i, j] = lookup[code]
+
+# SNPs are decoded in parallel from the main thread. Numba's default threading layer does not support parallel
+# regions launched from other threads (such as the reader thread of gwas.prefetch_batches), which use the serial kernel.
+decode_bed = njit(parallel=True)(_decode_bed)
+decode_bed_serial = njit(nogil=True)(_decode_bed)
+
+class bed_reader(object):
+    """Reader for PLINK .bed files that memory-maps the genotype file and decodes only the requested individuals and SNPs.
+    Genotypes count the first (A1) allele of the .bim file, as for pysnptools Bed(bedfile, count_A1=True), and the iid, sid, and pos
+    attributes are as for pysnptools.
+
+    Args:
+        bedfile : :class:`str`
+            path to bed file, with .bim and .fam files with the same prefix
+
+    Returns:
+        bed : :class:`snipar.read.bed.bed_reader`
+
+    """
+    def __init__(self, bedfile):
+        self.bedfile = bedfile
+        prefix = bedfile[:-4] if bedfile.endswith('.bed') else bedfile
+        fam = pd.read_csv(prefix+'.fam', delim_whitespace=True, header=None, usecols=[0, 1], dtype=str)
+        self.iid = fam.values.astype(str)
+        bim = pd.read_csv(prefix+'.bim', delim_whitespace=True, header=None, usecols=[0, 1, 2, 3], dtype={0: str, 1: str})
+        self.sid = bim[1].values.astype(str)
+        chrom = bim[0].replace(bed_chrom_map)
+        # Genetic positions are stored in single precision, as in pysnptools
+        self.pos = np.column_stack((pd.to_numeric(chrom, errors='coerce').values, bim[2].values.astype(np.float32),
+                                    bim[3].values)).astype(float)
+        self.pos[self.pos == 0] = np.nan
+        self.bytes_per_snp = (self.iid.shape[0] + 3) // 4
+        with open(bedfile, 'rb') as f:
+            magic = np.frombuffer(f.read(3), dtype=np.uint8)
+            f.seek(0, 2)
+            filesize = f.tell()
+        if magic.shape[0] < 3 or np.any(magic != bed_magic):
+            raise(ValueError(bedfile+' is not a SNP-major PLINK .bed file'))
+        if filesize != 3 + self.bytes_per_snp * self.sid.shape[0]:
+            raise(ValueError('Size of '+bedfile+' does not match the number of individuals and SNPs in the .fam and .bim files'))
+
+    @property
+    def iid_count(self):
+        return self.iid.shape[0]
+
+    @property
+    def sid_count(self):
+        return self.sid.shape[0]
+
+    def read(self, rows=None, cols=None, dtype=np.float32, missing=-1):
+        """Read the genotypes of the individuals given by rows and the SNPs given by cols.
+
+        Only the part of the .bed file between the first and last SNP read is mapped into memory, so reading a
+        contiguous window of SNPs (e.g. cols=slice(start, end)) does not touch the rest of the file.
+
+        Args:
+            rows : :class:`~numpy:numpy.array`
+                indices or boolean mask of individuals. Default all.
+            cols : :class:`~numpy:numpy.array` or :class:`slice`
+                indices, boolean mask, or slice of SNPs. Default all.
+            dtype : :class:`~numpy:numpy.dtype`
+                type of the genotypes returned. Missing genotypes are NaN for floating point types and missing for integer types.
+
+        Returns:
+            gts : :class:`~numpy:numpy.array`
+                [len(rows) x len(cols)] array of genotypes in column-major order
+
+        """
+        rows = self._indices(rows, self.iid_count)
+        cols = self._indices(cols, self.sid_count)
+        dtype = np.dtype(dtype)
+        if np.issubdtype(dtype, np.floating):
+            lookup = np.array([2, np.nan, 1, 0], dtype=dtype)
+        else:
+            lookup = np.array([2, missing, 1, 0], dtype=dtype)
+        gts = np.empty((rows.shape[0], cols.shape[0]), dtype=dtype, order='F')
+        if rows.shape[0] == 0 or cols.shape[0] == 0:
+            return gts
+        start = int(np.min(cols))
+        end = int(np.max(cols)) + 1
+        bed_bytes = np.memmap(self.bedfile, dtype=np.uint8, mode='r', offset=3 + start * self.bytes_per_snp,
+                              shape=((end - start) * self.bytes_per_snp,))
+        if threading.current_thread() is threading.main_thread():
+            decode_bed(bed_bytes, self.bytes_per_snp, rows, cols - start, lookup, gts)
+        else:
+            decode_bed_serial(bed_bytes, self.bytes_per_snp, rows, cols - start, lookup, gts)
+        del bed_bytes
+        return gts
+
+    @staticmethod
+    def _indices(x, n):
+        if x is None:
+            return np.arange(n)
+        if isinstance(x, slice):
+            return np.arange(n)[x]
+        x = np.asarray(x)
+        if x.dtype == bool:
+            if x.shape[0] != n:
+                raise(ValueError('Boolean index does not match the number of individuals/SNPs'))
+            return np.flatnonzero(x)
+        x = x.astype(np.int64)
+        x[x < 0] += n
+        if np.any(x < 0) or np.any(x >= n):
+            raise(IndexError('Index out of range of the .bed file'))
+        return x
+
+def open_bed(bedfile, native_bed=False):
+    """
+    Open a .bed file with the native reader (see :class:`bed_reader`) if native_bed=True, and with pysnptools otherwise
+    """
+    if native_bed:
+        return bed_reader(bedfile)
+    return Bed(bedfile, count_A1=True)
+
+def read_bed_gts(gts_f, rows=None, cols=None, dtype=np.float32):
+    """
+    Read genotypes from a .bed file opened by open_bed. The native reader decodes directly into dtype; pysnptools reads into float64
+    """
+    if isinstance(gts_f, bed_reader):
+        return gts_f.read(rows, cols, dtype=dtype)
+    if rows is None:
+        rows = slice(None)
+    if cols is None:
+        cols = slice(None)
+    return gts_f[rows, cols].read().val
+
 def match_observed_and_imputed_snps(gts_f, par_gts_f, bim, snp_ids=None, start=0, end=None):
     """
     Used in get_gts_matrix_given_ped to match observed and imputed SNPs and return SNP information on shared SNPs.
@@ -18,51 +163,28 @@ def match_observed_and_imputed_snps(gts_f, par_gts_f, bim, snp_ids=None, start=0
             end = snp_ids.shape[0]
         snp_ids = snp_ids[start:end]
     # Get bim info
-    alleles = np.loadtxt(bim, dtype='U', usecols=(4, 5))
-    pos = np.loadtxt(bim, dtype=int, usecols=3)
-    chromosome = np.loadtxt(bim, dtype=int, usecols=0)
+    variants = read_bim(bim)
     # Remove duplicate ids
     unique_snps, snp_indices, snp_counts = np.unique(snp_ids, return_index=True, return_counts=True)
-    snp_set = set(snp_ids[snp_indices[snp_counts == 1]])
-    if len(snp_set) < snp_ids.shape[0]:
-        print(str(snp_ids.shape[0]-len(snp_set))+' SNPs with duplicate IDs removed')
+    unique_snp_ids = snp_ids[snp_indices[snp_counts == 1]]
+    if unique_snp_ids.shape[0] < snp_ids.shape[0]:
+        print(str(snp_ids.shape[0]-unique_snp_ids.shape[0])+' SNPs with duplicate IDs removed')
     # Read and match SNP ids
-    imp_bim_cols = convert_str_array(np.array(par_gts_f['bim_columns']))
-    imp_bim = convert_str_array(np.array(par_gts_f['bim_values']))
-    # Get imputed SNP ids
-    found_snp_ids = False
-    if 'rsid' in imp_bim_cols:
-        imp_sid = imp_bim[:,np.where(imp_bim_cols=='rsid')[0][0]]
-        if np.unique(imp_sid).shape[0] == 0:
-            found_snp_ids = False
-        else:
-            found_snp_ids = True
-    if not found_snp_ids:
-        if 'id' in imp_bim_cols:
-            imp_sid = imp_bim[:,np.where(imp_bim_cols=='id')[0][0]]
-        else:
-            raise(ValueError('Cannot find imputed SNP ids'))
-    # Get imputed allele ids
-    if 'allele_ids' in imp_bim_cols:
-        imp_alleles = np.array([x.split(',') for x in imp_bim[:,np.where(imp_bim_cols=='allele_ids')[0][0]]])
-    elif 'allele1' in imp_bim_cols and 'allele2' in imp_bim_cols:
-        imp_alleles = imp_bim[:,[np.where(imp_bim_cols=='allele1')[0][0],np.where(imp_bim_cols=='allele2')[0][0]]]
-    obs_sid = gts_f.sid
-    obs_sid_dict = make_id_dict(obs_sid)
-    in_obs_sid = np.zeros((imp_sid.shape[0]), dtype=bool)
-    obs_sid_index = np.zeros((imp_sid.shape[0]), dtype=int)
-    for i in range(0, imp_sid.shape[0]):
-        if imp_sid[i] in obs_sid_dict and imp_sid[i] in snp_set:
-            in_obs_sid[i] = True
-            obs_sid_index[i] = obs_sid_dict[imp_sid[i]]
+    imputed = read_imputed_variants(par_gts_f)
+    obs_sid_index = variants.match(imputed)
+    in_snp_ids = np.zeros(len(variants), dtype=bool)
+    unique_snp_index = variants.index.get_indexer(unique_snp_ids)
+    in_snp_ids[unique_snp_index[unique_snp_index >= 0]] = True
+    in_obs_sid = obs_sid_index >= 0
+    in_obs_sid[in_obs_sid] = in_snp_ids[obs_sid_index[in_obs_sid]]
     if np.sum(in_obs_sid) == 0:
         raise ValueError('No SNPs in common between imputed and observed data')
     obs_sid_index = obs_sid_index[in_obs_sid]
-    sid = imp_sid[in_obs_sid]
-    alleles = alleles[obs_sid_index, :]
-    imp_alleles = imp_alleles[in_obs_sid,:]
-    chromosome = chromosome[obs_sid_index]
-    pos = pos[obs_sid_index]
+    sid = imputed.sid[in_obs_sid]
+    alleles = variants.alleles[obs_sid_index, :]
+    imp_alleles = imputed.alleles[in_obs_sid,:]
+    chromosome = variants.chrom[obs_sid_index].astype(int)
+    pos = variants.pos[obs_sid_index]
     # Check for allele flip/mismatch
     allele_match = np.logical_and(alleles[:,0]==imp_alleles[:,0],alleles[:,1]==imp_alleles[:,1])
     if np.sum(allele_match) < alleles.shape[0]:
@@ -88,32 +210,30 @@ def get_snps(gts_f,bim,snp_ids=None):
     if snp_ids is None:
         snp_ids = gts_f.sid
     # Get bim info
-    alleles = np.loadtxt(bim, dtype='U', usecols=(4, 5))
-    pos = np.loadtxt(bim, dtype=int, usecols=3)
-    chromosome = np.loadtxt(bim, dtype=int, usecols=0)
+    variants = read_bim(bim)
     # Remove duplicate ids
     unique_snps, snp_indices, snp_counts = np.unique(snp_ids, return_index=True, return_counts=True)
     snp_ids = snp_ids[snp_indices[snp_counts == 1]]
     # Read and match SNP ids
-    obs_sid = gts_f.sid
-    obs_sid_dict = make_id_dict(obs_sid)
-    in_obs_sid = np.array([x in obs_sid_dict for x in snp_ids])
+    obs_sid_index = variants.index.get_indexer(snp_ids)
+    in_obs_sid = obs_sid_index >= 0
     if np.sum(in_obs_sid) == 0:
         raise ValueError('No SNPs found in bed file')
-    obs_sid_index = np.array([obs_sid_dict[x] for x in snp_ids[in_obs_sid]])
-    sid = obs_sid[obs_sid_index]
-    alleles = alleles[obs_sid_index, :]
-    chromosome = chromosome[obs_sid_index]
-    pos = pos[obs_sid_index]
+    obs_sid_index = obs_sid_index[in_obs_sid]
+    sid = variants.sid[obs_sid_index]
+    alleles = variants.alleles[obs_sid_index, :]
+    chromosome = variants.chrom[obs_sid_index].astype(int)
+    pos = variants.pos[obs_sid_index]
     return chromosome, sid, pos, alleles, obs_sid_index
 
-def get_gts_matrix_given_ped(ped, bedfile, par_gts_f=None, snp_ids=None, ids=None, sib=False, parsum=False, verbose=False, print_sample_info = False):
+def get_family_design(ped, bedfile, par_gts_f=None, ids=None, sib=False, verbose=False, native_bed=False):
     """
-    Used in get_gts_matrix: see get_gts_matrix for documentation
+    Used in get_gts_matrix_given_ped to open the genotype file and find the individuals with observed/imputed parental genotypes.
+    The returned design can be passed to get_gts_matrix_given_ped to read further batches of SNPs without repeating this step.
+    If native_bed=True, the genotype file is read with :class:`bed_reader` rather than pysnptools.
     """
     ### Genotype file ###
-    bim = bedfile.split('.bed')[0] + '.bim'
-    gts_f = Bed(bedfile,count_A1=True)
+    gts_f = open_bed(bedfile, native_bed=native_bed)
     # get ids of genotypes and make dict
     gts_ids = gts_f.iid[:, 1]
     if ids is None:
@@ -124,13 +244,29 @@ def get_gts_matrix_given_ped(ped, bedfile, par_gts_f=None, snp_ids=None, ids=Non
     else:
         imp_fams = None
     ### Find ids with observed/imputed parents and indices of those in observed/imputed data
-    ids, observed_indices, imp_indices, parcount = preprocess.get_indices_given_ped(ped, gts_ids, imp_fams=imp_fams, ids=ids, 
-                                                                                sib=sib, verbose=print_sample_info)
-    if np.sum(parcount>0)==0 and not parsum:
+    design = preprocess.family_design(ped, gts_ids, imp_fams=imp_fams, ids=ids, sib=sib, verbose=verbose)
+    design.gts_f = gts_f
+    design.bedfile = bedfile
+    design.bgenfile = None
+    design.bim = bedfile.split('.bed')[0] + '.bim'
+    design.par_gts_f = par_gts_f
+    design.imp_reader = imputed_reader(par_gts_f) if par_gts_f is not None else None
+    return design
+
+def get_gts_matrix_given_ped(ped, bedfile, par_gts_f=None, snp_ids=None, ids=None, sib=False, parsum=False, verbose=False, print_sample_info = False, design = None, native_bed=False):
+    """
+    Used in get_gts_matrix: see get_gts_matrix for documentation
+    """
+    if design is None:
+        design = get_family_design(ped, bedfile, par_gts_f=par_gts_f, ids=ids, sib=sib, verbose=print_sample_info, native_bed=native_bed)
+    gts_f = design.gts_f
+    bim = design.bim
+    par_gts_f = design.par_gts_f
+    if np.sum(design.parcount>0)==0 and not parsum:
         if verbose:
             print('No individuals with genotyped parents found. Using sum of imputed maternal and paternal genotypes to prevent collinearity.')
         parsum = True
-    elif 100 > np.sum(parcount>0) > 0 and not parsum:
+    elif 100 > np.sum(design.parcount>0) > 0 and not parsum:
         if verbose:
             print('Warning: low number of individuals with observed parental genotypes. Consider using the --parsum argument to prevent issues due to collinearity.')
     ### Match observed and imputed SNPs ###
@@ -141,13 +277,7 @@ def get_gts_matrix_given_ped(ped, bedfile, par_gts_f=None, snp_ids=None, ids=Non
         # Read imputed parental genotypes
         if verbose:
             print('Reading imputed parental genotypes')
-        if (imp_indices.shape[0]*in_obs_sid.shape[0]) < (np.sum(in_obs_sid)*imp_fams.shape[0]):
-            imp_gts = np.array(par_gts_f['imputed_par_gts'][imp_indices, :])
-            imp_gts = imp_gts[:,np.arange(in_obs_sid.shape[0])[in_obs_sid]]
-        else:
-            imp_gts = np.array(par_gts_f['imputed_par_gts'][:,np.arange(in_obs_sid.shape[0])[in_obs_sid]])
-            imp_gts = imp_gts[imp_indices,:]
-        imp_fams = imp_fams[imp_indices]
+        imp_gts = design.imp_reader.read(design.imp_indices, np.flatnonzero(in_obs_sid))
         # Check for allele flip
         nflip = np.sum(allele_flip)
         if nflip>0:
@@ -159,60 +289,50 @@ def get_gts_matrix_given_ped(ped, bedfile, par_gts_f=None, snp_ids=None, ids=Non
     # Read observed genotypes
     if verbose:
         print('Reading observed genotypes')
-    gts = gts_f[observed_indices, obs_sid_index].read().val
-    gts_ids = gts_f.iid[observed_indices,1]
-    gts_id_dict = make_id_dict(gts_ids)
-    # Find indices in reduced data
-    par_status, gt_indices, fam_labels = preprocess.find_par_gts(ids, ped, gts_id_dict, imp_fams=imp_fams)
+    gts = read_bed_gts(gts_f, design.observed_indices, obs_sid_index)
     if verbose:
         print('Constructing family based genotype matrix')
     ### Make genotype design matrix
-    if sib:
-        if parsum:
-            G = np.zeros((ids.shape[0], 3, gts.shape[1]), dtype=np.float32)
-            G[:, np.array([0, 2]), :] = preprocess.make_gts_matrix(gts, par_status, gt_indices, imp_gts=imp_gts, parsum=parsum)
-        else:
-            G = np.zeros((ids.shape[0],4,gts.shape[1]), dtype=np.float32)
-            G[:,np.array([0,2,3]),:] = preprocess.make_gts_matrix(gts, par_status, gt_indices, imp_gts=imp_gts, parsum=parsum)
-        G[:,1,:] = preprocess.get_fam_means(ids, ped, gts, gts_ids, remove_proband=True).gts
-    else:
-        G = preprocess.make_gts_matrix(gts, par_status, gt_indices, parsum=parsum, imp_gts=imp_gts)
+    G = design.gts_matrix(gts, imp_gts=imp_gts, parsum=parsum)
     del gts
     if imp_gts is not None:
         del imp_gts
-    return gtarray(G, ids, sid, alleles=alleles, pos=pos, chrom=chromosome, fams=fam_labels, par_status=par_status)
+    return gtarray(G, design.ids, sid, alleles=alleles, pos=pos, chrom=chromosome, fams=design.fam_labels, par_status=design.par_status)
 
-def read_sibs_from_bed(bedfile,sibpairs):
-    bed = Bed(bedfile, count_A1=True)
+def read_sibs_from_bed(bedfile,sibpairs, native_bed=False):
+    bed = open_bed(bedfile, native_bed=native_bed)
     ids = bed.iid
-    id_dict = make_id_dict(ids, 1)
+    id_dict = id_index(ids, 1)
     # Find sibpairs in bed
-    in_bed = np.vstack((np.array([x in id_dict for x in sibpairs[:,0]]),
-                        np.array([x in id_dict for x in sibpairs[:, 1]]))).T
+    in_bed = np.vstack((id_dict.contains(sibpairs[:, 0]),
+                        id_dict.contains(sibpairs[:, 1]))).T
     both_in_bed = np.sum(in_bed,axis=1)==2
     # Remove pairs without both in bedfile
     if np.sum(both_in_bed)<sibpairs.shape[0]:
         print(str(sibpairs.shape[0]-np.sum(both_in_bed))+' sibpairs do not both have genotypes')
         sibpairs = sibpairs[both_in_bed,:]
     # Find indices of sibpairs
-    sibindices = np.sort(np.array([id_dict[x] for x in sibpairs.flatten()]))
-    gts = np.zeros((sibindices.shape[0],bed.sid.shape[0]),dtype=np.float32)
-    gts[:] = bed[sibindices,:].read().val
+    sibindices = np.sort(id_dict.get_indexer(sibpairs.flatten()))
+    if native_bed:
+        gts = bed.read(sibindices, dtype=np.float32)
+    else:
+        gts = np.zeros((sibindices.shape[0],bed.sid.shape[0]),dtype=np.float32)
+        gts[:] = bed[sibindices,:].read().val
     return gtarray(garray = gts, ids = ids[sibindices, 1], sid = bed.sid, pos = np.array(bed.pos[:,2],dtype=int))    
 
-def read_PO_pairs_from_bed(ped,bedfile):
+def read_PO_pairs_from_bed(ped,bedfile, native_bed=False):
     # Read bed
-    bed = Bed(bedfile, count_A1=True)
+    bed = open_bed(bedfile, native_bed=native_bed)
     ids = bed.iid
-    id_dict = make_id_dict(ids, 1)
+    id_dict = id_index(ids, 1)
     ## Find parent-offspring pairs
     # genotyped individuals
-    genotyped = np.array([x in id_dict for x in ped[:, 1]])
+    genotyped = id_dict.contains(ped[:, 1])
     ped = ped[genotyped, :]
     # with genotyped father
-    father_genotyped = np.array([x in id_dict for x in ped[:, 2]])
+    father_genotyped = id_dict.contains(ped[:, 2])
     # with genotyped mother
-    mother_genotyped = np.array([x in id_dict for x in ped[:, 3]])
+    mother_genotyped = id_dict.contains(ped[:, 3])
     # either
     opg = np.logical_or(father_genotyped, mother_genotyped)
     opg_ped = ped[opg, :]
@@ -227,6 +347,6 @@ def read_PO_pairs_from_bed(ped,bedfile):
     all_ids = np.unique(np.hstack((opg_ped[:, 1],
                                    ped[father_genotyped, 2],
                                    ped[mother_genotyped, 3])))
-    all_ids_indices = np.sort(np.array([id_dict[x] for x in all_ids]))
-    gts = bed[all_ids_indices, :].read().val
+    all_ids_indices = np.sort(id_dict.get_indexer(all_ids))
+    gts = read_bed_gts(bed, all_ids_indices)
     return gtarray(gts,ids = ids[all_ids_indices, 1], sid=bed.sid), opg_ped, npair
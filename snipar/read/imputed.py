@@ -0,0 +1,272 @@
+import os
+import zlib
+import threading
+import h5py
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+try:
+    # Registers the blosc filter with h5py
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+# Maximum size, in bytes, of the decompressed chunks kept in memory for following reads
+imputed_cache_bytes = 2**26
+# Target size, in bytes, of the chunks of imputed parental genotypes written by snipar
+imputed_chunk_bytes = 2**20
+# Compression algorithms for writing imputed parental genotypes
+imputed_compressions = ['gzip', 'lzf', 'blosc']
+
+class imputed_reader(object):
+    """Reader for a dataset of imputed parental genotypes ([families x SNPs], e.g. imputed_par_gts) that follows its chunk layout.
+    A read decodes each chunk holding requested families and SNPs once, in worker threads, and subsets families in memory.
+    Chunks are read raw and decompressed in the worker threads when the dataset is compressed with gzip (with or without shuffle);
+    other filters are decompressed by h5py. A small LRU cache of decoded chunks serves chunks shared by consecutive batches of SNPs.
+
+    Args:
+        par_gts_f : :class:`h5py.File`
+            open HDF5 file with imputed parental genotypes
+        dataset : :class:`str`
+            name of the dataset. Default 'imputed_par_gts'.
+        threads : :class:`int`
+            number of worker threads. Default number of CPUs.
+        cache_bytes : :class:`int`
+            maximum size of the cache of decoded chunks. Default imputed_cache_bytes.
+
+    Returns:
+        reader : :class:`snipar.read.imputed.imputed_reader`
+
+    """
+    def __init__(self, par_gts_f, dataset='imputed_par_gts', threads=None, cache_bytes=None):
+        self.dataset = par_gts_f[dataset]
+        self.shape = self.dataset.shape
+        self.dtype = self.dataset.dtype
+        self.chunks = self.dataset.chunks
+        if threads is None:
+            threads = os.cpu_count()
+        self.threads = max(1, threads)
+        self.cache_bytes = imputed_cache_bytes if cache_bytes is None else cache_bytes
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        # Filters that can be undone outside of h5py, in the order applied when writing
+        self.raw_filters = None
+        if self.chunks is not None:
+            plist = self.dataset.id.get_create_plist()
+            filters = [plist.get_filter(i) for i in range(plist.get_nfilters())]
+            if all([x[0] in (h5py.h5z.FILTER_DEFLATE, h5py.h5z.FILTER_SHUFFLE) for x in filters]):
+                self.raw_filters = [x[0] for x in filters]
+
+    def fixed_bytes(self):
+        """Memory, in bytes, used by reads independently of the number of SNPs read: the cache of decoded chunks, and the decoded chunks
+        of one column block of all families, which are concatenated before families are selected (see :func:`imputed_reader.read`).
+
+        Returns:
+            fixed_bytes : :class:`int`
+
+        """
+        if self.chunks is None:
+            return 0
+        return self.cache_bytes+self.shape[0]*self.chunks[1]*self.dtype.itemsize
+
+    def _decode_chunk(self, chunk):
+        """
+        Decode the chunk with chunk index chunk=(row block, column block)
+        """
+        offset = (chunk[0]*self.chunks[0], chunk[1]*self.chunks[1])
+        if self.raw_filters is None or self.dataset.id.get_chunk_info_by_coord(offset).byte_offset is None:
+            # Read by h5py, which also fills chunks that were never written
+            return self.dataset[offset[0]:(offset[0]+self.chunks[0]), offset[1]:(offset[1]+self.chunks[1])]
+        filter_mask, data = self.dataset.id.read_direct_chunk(offset)
+        for i in reversed(range(len(self.raw_filters))):
+            if filter_mask & (1 << i):
+                continue
+            if self.raw_filters[i] == h5py.h5z.FILTER_DEFLATE:
+                data = zlib.decompress(data)
+            else:
+                # Undo the byte shuffle; copying byte planes one at a time is much faster than transposing
+                planes = np.frombuffer(data, dtype=np.uint8).reshape((self.dtype.itemsize, -1))
+                unshuffled = np.empty((planes.shape[1], self.dtype.itemsize), dtype=np.uint8)
+                for k in range(self.dtype.itemsize):
+                    unshuffled[:, k] = planes[k]
+                data = unshuffled.data
+        # Edge chunks are stored whole
+        gts = np.frombuffer(data, dtype=self.dtype).reshape(self.chunks)
+        return gts[0:min(self.chunks[0], self.shape[0]-offset[0]), 0:min(self.chunks[1], self.shape[1]-offset[1])]
+
+    def _get_chunks(self, chunks):
+        """
+        Decoded chunks, from the cache or decoded in worker threads
+        """
+        decoded = {}
+        with self.cache_lock:
+            for chunk in chunks:
+                if chunk in self.cache:
+                    self.cache.move_to_end(chunk)
+                    decoded[chunk] = self.cache[chunk]
+        to_decode = [chunk for chunk in chunks if chunk not in decoded]
+        if len(to_decode) > 1 and self.threads > 1:
+            with ThreadPoolExecutor(max_workers=min(self.threads, len(to_decode))) as pool:
+                decoded.update(zip(to_decode, pool.map(self._decode_chunk, to_decode)))
+        else:
+            for chunk in to_decode:
+                decoded[chunk] = self._decode_chunk(chunk)
+        if self.cache_bytes > 0:
+            with self.cache_lock:
+                for chunk in to_decode:
+                    self.cache[chunk] = decoded[chunk]
+                cached_bytes = sum([x.nbytes for x in self.cache.values()])
+                while cached_bytes > self.cache_bytes and len(self.cache) > 0:
+                    cached_bytes -= self.cache.popitem(last=False)[1].nbytes
+        return decoded
+
+    def read(self, rows, cols):
+        """Read the imputed parental genotypes of families (rows) at SNPs (cols).
+
+        Args:
+            rows : :class:`~numpy:numpy.array`
+                indices of families
+            cols : :class:`~numpy:numpy.array`
+                indices of SNPs
+
+        Returns:
+            gts : :class:`~numpy:numpy.array`
+                [len(rows) x len(cols)] array of imputed parental genotypes, with the type of the dataset
+
+        """
+        rows = np.asarray(rows, dtype=int)
+        cols = np.asarray(cols, dtype=int)
+        gts = np.empty((rows.shape[0], cols.shape[0]), dtype=self.dtype)
+        if rows.shape[0] == 0 or cols.shape[0] == 0:
+            return gts
+        if self.chunks is None:
+            # Contiguous dataset: read the span of the SNPs requested
+            start, end = np.min(cols), np.max(cols)+1
+            gts[:] = self.dataset[:, start:end][np.ix_(rows, cols-start)]
+            return gts
+        row_blocks = rows // self.chunks[0]
+        col_blocks = cols // self.chunks[1]
+        unique_row_blocks = np.unique(row_blocks)
+        unique_col_blocks = np.unique(col_blocks)
+        decoded = self._get_chunks([(int(i), int(j)) for j in unique_col_blocks for i in unique_row_blocks])
+        # Row of each family in the chunks of a column block stacked in order of row block (only the last can be short)
+        stacked_rows = np.searchsorted(unique_row_blocks, row_blocks)*self.chunks[0] + rows % self.chunks[0]
+        for j in unique_col_blocks:
+            out_cols = np.flatnonzero(col_blocks == j)
+            if unique_row_blocks.shape[0] == 1:
+                block = decoded[(int(unique_row_blocks[0]), int(j))]
+            else:
+                block = np.concatenate([decoded[(int(i), int(j))] for i in unique_row_blocks], axis=0)
+            # Slice runs of consecutive SNPs before selecting families, which is much faster than selecting both with fancy indexing
+            block_cols = cols[out_cols]-j*self.chunks[1]
+            if np.all(np.diff(block_cols) == 1):
+                block_cols = slice(block_cols[0], block_cols[-1]+1)
+            if np.all(np.diff(out_cols) == 1):
+                out_cols = slice(out_cols[0], out_cols[-1]+1)
+            gts[:, out_cols] = np.take(block[:, block_cols], stacked_rows, axis=0)
+        return gts
+
+def imputed_chunk_shape(shape, itemsize=2, chunk_bytes=None):
+    """SNP-major chunk shape for a [families x SNPs] dataset of imputed parental genotypes. Batches of SNPs are read for most families,
+    so a chunk holds all families (when they fit in chunk_bytes) and as many SNPs as fit in chunk_bytes.
+
+    Args:
+        shape : :class:`tuple`
+            shape of the dataset
+        itemsize : :class:`int`
+            size, in bytes, of an element of the dataset. Default 2 (float16).
+        chunk_bytes : :class:`int`
+            target size of a chunk. Default imputed_chunk_bytes.
+
+    Returns:
+        chunks : :class:`tuple`
+            shape of a chunk
+
+    """
+    if chunk_bytes is None:
+        chunk_bytes = imputed_chunk_bytes
+    chunk_rows = max(1, min(shape[0], chunk_bytes // itemsize))
+    chunk_cols = max(1, min(shape[1], chunk_bytes // (chunk_rows*itemsize)))
+    return (chunk_rows, chunk_cols)
+
+def imputed_dataset_options(shape, compression=None, compression_opts=None, shuffle=None, chunk_bytes=None, itemsize=2):
+    """Keyword arguments of :func:`h5py.Group.create_dataset` for writing imputed parental genotypes: a SNP-major chunk layout
+    (see :func:`imputed_chunk_shape`) and, optionally, compression.
+
+    Args:
+        shape : :class:`tuple`
+            shape of the dataset
+        compression : :class:`str`
+            'gzip', 'lzf', 'blosc' (lz4 within blosc; requires the hdf5plugin package), or None for no compression
+        compression_opts : :class:`int`
+            compression level for gzip (0-9, default 4) or blosc (0-9, default 5)
+        shuffle : :class:`bool`
+            whether to apply the byte shuffle filter, which groups the exponent bytes of the float16 genotypes before compression.
+            Default True when compressing. Blosc shuffles internally.
+        chunk_bytes : :class:`int`
+            target size of a chunk. Default imputed_chunk_bytes.
+        itemsize : :class:`int`
+            size, in bytes, of an element of the dataset. Default 2 (float16).
+
+    Returns:
+        options : :class:`dict`
+
+    """
+    if compression is not None and compression not in imputed_compressions:
+        raise(ValueError('Unknown compression '+str(compression)+'. Should be one of '+', '.join(imputed_compressions)))
+    if shuffle is None:
+        shuffle = compression is not None
+    options = {'chunks': imputed_chunk_shape(shape, itemsize=itemsize, chunk_bytes=chunk_bytes)}
+    if compression == 'blosc':
+        if hdf5plugin is None:
+            raise(ValueError('blosc compression requires the hdf5plugin package'))
+        clevel = 5 if compression_opts is None else compression_opts
+        blosc_shuffle = hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE
+        options.update(hdf5plugin.Blosc(cname='lz4', clevel=clevel, shuffle=blosc_shuffle))
+    elif compression is not None:
+        options['compression'] = compression
+        if compression_opts is not None:
+            options['compression_opts'] = compression_opts
+        options['shuffle'] = shuffle
+    return options
+
+def rechunk(infile, outfile, compression=None, compression_opts=None, shuffle=None, chunk_bytes=None, dataset='imputed_par_gts'):
+    """Copy an HDF5 file of imputed parental genotypes, rewriting the imputed parental genotypes with the SNP-major chunk layout
+    and compression of :func:`imputed_dataset_options`. Other datasets are copied unchanged. The genotypes are copied in blocks of
+    SNPs, so memory use is bounded by a few chunks per family.
+
+    Args:
+        infile : :class:`str`
+            path to HDF5 file of imputed parental genotypes
+        outfile : :class:`str`
+            path to write the rechunked file to
+        compression, compression_opts, shuffle, chunk_bytes :
+            see :func:`imputed_dataset_options`
+        dataset : :class:`str`
+            name of the dataset to rechunk. Default 'imputed_par_gts'.
+
+    Returns:
+        chunks : :class:`tuple`
+            chunk shape of the rechunked dataset
+
+    """
+    if os.path.abspath(infile) == os.path.abspath(outfile):
+        raise(ValueError('Output file must differ from input file'))
+    with h5py.File(infile, 'r') as f_in, h5py.File(outfile, 'w') as f_out:
+        for key, val in f_in.attrs.items():
+            f_out.attrs[key] = val
+        for key in f_in.keys():
+            if key != dataset:
+                f_in.copy(f_in[key], f_out, name=key)
+        gts = f_in[dataset]
+        options = imputed_dataset_options(gts.shape, compression=compression, compression_opts=compression_opts, shuffle=shuffle,
+                                          chunk_bytes=chunk_bytes, itemsize=gts.dtype.itemsize)
+        out_gts = f_out.create_dataset(dataset, gts.shape, dtype=gts.dtype, **options)
+        for key, val in gts.attrs.items():
+            out_gts.attrs[key] = val
+        # Copy whole chunks of the output, at least imputed_cache_bytes at a time
+        block = options['chunks'][1]*max(1, imputed_cache_bytes // max(1, gts.shape[0]*gts.dtype.itemsize*options['chunks'][1]))
+        for start in range(0, gts.shape[1], block):
+            end = min(start+block, gts.shape[1])
+            out_gts[:, start:end] = gts[:, start:end]
+    return options['chunks']
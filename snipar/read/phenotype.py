@@ -1,7 +1,7 @@
 from pysnptools.snpreader import Pheno
 import numpy as np
 from snipar.gtarray import gtarray
-from snipar.utilities import make_id_dict
+from snipar.utilities import id_index
 
 def read_phenotype(phenofile, missing_char = 'NA', phen_index = 1):
     """Read a phenotype file and remove missing values.
@@ -48,11 +48,10 @@ def match_phenotype(G,y,pheno_ids):
             vector of phenotype values matched by individual IDs to the genotype array
 
     """
-    in_G_dict = np.array([x in G.id_dict for x in pheno_ids])
+    in_G_dict = G.id_dict.contains(pheno_ids)
     y = y[in_G_dict]
     pheno_ids = pheno_ids[in_G_dict]
-    pheno_id_dict = make_id_dict(pheno_ids)
-    y = y[[pheno_id_dict[x] for x in G.ids]]
+    y = y[id_index(pheno_ids).get_indexer(G.ids)]
     return y
 
 def read_covariates(covar, pheno_ids=None, missing_char = 'NA'):
@@ -60,7 +59,7 @@ def read_covariates(covar, pheno_ids=None, missing_char = 'NA'):
     X = np.array(covar.val)
     X = gtarray(X, ids=np.array(covar.iid)[:,1])
     if pheno_ids is not None:
-        in_covar = np.array([x in X.id_dict for x in pheno_ids])
+        in_covar = X.id_dict.contains(pheno_ids)
         if np.sum((~in_covar))>0:
             raise(ValueError('Missing covariate values for some phenotyped individuals'))
     X.fill_NAs()
@@ -0,0 +1,214 @@
+import h5py
+import numpy as np
+import snipar.read as read
+from snipar.gtarray import gtarray
+from snipar.read.imputed import imputed_reader, imputed_dataset_options
+from snipar.read.variants import read_bgen_variants
+from snipar.utilities import *
+
+# Target size, in bytes, of the chunks of the family genotype store
+store_chunk_bytes = 2**22
+# Types the family genotypes can be stored as
+store_dtypes = ['float32', 'float16']
+
+class store_design(object):
+    """Family based genotype matrices read from a family genotype store (see :func:`build_store`). The store holds,
+    for each individual, the columns of the family based genotype matrix (proband, mean of siblings if built with sib=True,
+    paternal and maternal genotypes), already allele-matched, so reading a batch of SNPs only selects individuals and SNPs.
+
+    This can be used in place of :class:`snipar.preprocess.family_design` as the design argument of :func:`snipar.read.get_gts_matrix`.
+
+    Args:
+        storefile : :class:`str`
+            path to family genotype store
+        ids : :class:`~numpy:numpy.array`
+            If provided, only include these individuals
+        sib : :class:`bool`
+            Include the mean of siblings' genotypes. Must match the sib argument used to build the store. Default False.
+        threads : :class:`int`
+            number of threads used to decompress chunks (see :class:`snipar.read.imputed.imputed_reader`)
+
+    Returns:
+        design : :class:`snipar.read.store.store_design`
+
+    """
+    def __init__(self, storefile, ids=None, sib=False, threads=None):
+        self.storefile = storefile
+        self.store_f = h5py.File(storefile, 'r')
+        if not self.store_f.attrs.get('complete', False):
+            raise(ValueError(storefile+' is not a complete family genotype store'))
+        self.sib = bool(self.store_f.attrs['sib'])
+        if sib != self.sib:
+            if self.sib:
+                raise(ValueError(storefile+' was built for individuals with genotyped siblings. Build a store without --fit_sib'))
+            raise(ValueError(storefile+' does not include the mean of siblings\' genotypes. Build a store with --fit_sib'))
+        self.parsum = bool(self.store_f.attrs['parsum'])
+        self.columns = convert_str_array(self.store_f['columns'])
+        self.ped = convert_str_array(self.store_f['pedigree'])
+        # Rows of each column in the gts dataset
+        self.n_stored = self.store_f['ids'].shape[0]
+        self.rows = np.arange(self.n_stored)
+        self.ids = convert_str_array(self.store_f['ids'])
+        self.fam_labels = convert_str_array(self.store_f['fams'])
+        self.par_status = np.array(self.store_f['par_status'])
+        self.parcount = np.array(self.store_f['parcount'])
+        self.sid = convert_str_array(self.store_f['sid'])
+        self.sid_index = id_index(self.sid)
+        self.alleles = convert_str_array(self.store_f['alleles'])
+        self.pos = np.array(self.store_f['pos'])
+        self.chrom = convert_str_array(self.store_f['chrom'])
+        self.reader = imputed_reader(self.store_f, dataset='gts', threads=threads)
+        self.itemsize = self.reader.dtype.itemsize
+        # Attributes of snipar.preprocess.family_design that are not used by a store
+        self.bedfile = None
+        self.bgenfile = None
+        self.par_gts_f = None
+        if ids is not None:
+            self.filter_ids(ids)
+
+    def filter_ids(self, keep_ids):
+        """
+        Keep only individuals with ids given by keep_ids, retaining the current ordering of individuals
+        """
+        keep = id_index(keep_ids).contains(self.ids)
+        if np.sum(keep) == 0:
+            raise(ValueError('No individuals would be left after filtering'))
+        self.rows = self.rows[keep]
+        self.ids = self.ids[keep]
+        self.fam_labels = self.fam_labels[keep]
+        self.par_status = self.par_status[keep, :]
+        self.parcount = self.parcount[keep]
+
+    def snp_indices(self, snp_ids=None):
+        """
+        Indices in the store of the SNPs in snp_ids (all SNPs if None), in the order of the store. SNPs with duplicated IDs in snp_ids are removed.
+        """
+        if snp_ids is None:
+            return np.arange(self.sid.shape[0])
+        unique_snps, snp_indices, snp_counts = np.unique(snp_ids, return_index=True, return_counts=True)
+        snp_ids = snp_ids[snp_indices[snp_counts == 1]]
+        indices = self.sid_index.get_indexer(snp_ids)
+        indices = np.sort(indices[indices >= 0])
+        if indices.shape[0] == 0:
+            raise(ValueError('No SNPs found in '+self.storefile))
+        return indices
+
+    def read(self, snp_ids=None, parsum=False, verbose=False):
+        """Read the family based genotype matrix of the SNPs in snp_ids (all SNPs if None): see :func:`snipar.read.get_gts_matrix`.
+
+        Returns:
+            G : :class:`snipar.gtarray`
+        """
+        if np.sum(self.parcount>0)==0 and not parsum:
+            if verbose:
+                print('No individuals with genotyped parents found. Using sum of imputed maternal and paternal genotypes to prevent collinearity.')
+            parsum = True
+        elif 100 > np.sum(self.parcount>0) > 0 and not parsum:
+            if verbose:
+                print('Warning: low number of individuals with observed parental genotypes. Consider using the --parsum argument to prevent issues due to collinearity.')
+        if not parsum and self.parsum:
+            raise(ValueError(self.storefile+' stores the sum of paternal and maternal genotypes'))
+        cols = self.snp_indices(snp_ids)
+        if verbose:
+            print('Reading family genotypes from '+self.storefile)
+        n, k = self.rows.shape[0], self.columns.shape[0]
+        rows = ((np.arange(k)*self.n_stored).reshape((k, 1))+self.rows).flatten()
+        gts = self.reader.read(rows, cols).reshape((k, n, cols.shape[0]))
+        # Parental columns follow the proband and sibling columns
+        par = 2 if self.sib else 1
+        sum_parents = parsum and not self.parsum
+        G = np.empty((n, k-int(sum_parents), cols.shape[0]), dtype=np.float32)
+        for j in range(G.shape[1]):
+            G[:, j, :] = gts[j]
+        if sum_parents:
+            G[:, par, :] += gts[par+1]
+        del gts
+        return gtarray(G, self.ids, self.sid[cols], alleles=self.alleles[cols, :], pos=self.pos[cols], chrom=self.chrom[cols],
+                       fams=self.fam_labels, par_status=self.par_status)
+
+def build_store(outfile, ped=None, bedfile=None, bgenfile=None, par_gts_f=None, sib=False, batch_size=10000, dtype='float32',
+                compression=None, compression_opts=None, chunk_bytes=None, native_bed=False, verbose=False):
+    """Build a family genotype store for a chromosome: an HDF5 file with the family based genotype matrix of every individual
+    with observed/imputed parental genotypes (see :func:`snipar.read.get_gts_matrix`), and their families, parental status,
+    and pedigree. The SNPs are matched between observed and imputed genotypes, and alleles flipped, once when building the store,
+    so :class:`store_design` reads batches of SNPs without repeating this work.
+
+    The genotypes are stored in the dataset 'gts' as a [k*N x L] array, where the k columns of the family based genotype matrix
+    (listed in 'columns') of the N individuals are stacked, with the SNP-major chunk layout of :func:`snipar.read.imputed.imputed_dataset_options`.
+    Missing values are NaN. The genotypes are read and written in batches of batch_size SNPs.
+
+    Args:
+        outfile : :class:`str`
+            path to write the store to
+        ped, bedfile, bgenfile, par_gts_f, sib, native_bed :
+            see :func:`snipar.read.get_family_design`
+        batch_size : :class:`int`
+            number of SNPs read at a time. Default 10000.
+        dtype : :class:`str`
+            'float32' or 'float16'. float16 halves the size of the store but rounds the means of siblings' genotypes. Default 'float32'.
+        compression, compression_opts, chunk_bytes :
+            see :func:`snipar.read.imputed.imputed_dataset_options`. Default chunk_bytes is store_chunk_bytes.
+
+    Returns:
+        nsnp : :class:`int`
+            number of SNPs in the store
+
+    """
+    if dtype not in store_dtypes:
+        raise(ValueError('Unknown dtype '+str(dtype)+'. Should be one of '+', '.join(store_dtypes)))
+    if chunk_bytes is None:
+        chunk_bytes = store_chunk_bytes
+    design = read.get_family_design(ped=ped, bedfile=bedfile, bgenfile=bgenfile, par_gts_f=par_gts_f, sib=sib, verbose=verbose,
+                                    native_bed=native_bed)
+    if bedfile is not None:
+        snp_ids = design.gts_f.sid
+    else:
+        snp_ids = read_bgen_variants(bgenfile, design.gts_f).sid
+    # Remove duplicates
+    unique_snps, snp_inverse, counts = np.unique(snp_ids, return_inverse=True, return_counts=True)
+    if np.sum(counts>1)>0:
+        print('Removing '+str(np.sum(counts>1))+' duplicate SNP ids')
+        snp_ids = snp_ids[counts[snp_inverse] == 1]
+    n = design.ids.shape[0]
+    sid, alleles, pos, chrom = [], [], [], []
+    with h5py.File(outfile, 'w') as store_f:
+        gts = None
+        nsnp = 0
+        for start in range(0, snp_ids.shape[0], batch_size):
+            G = read.get_gts_matrix(snp_ids=snp_ids[start:(start+batch_size)], verbose=verbose and start==0, design=design)
+            k, L = G.gts.shape[1], G.gts.shape[2]
+            if gts is None:
+                options = imputed_dataset_options((k*n, snp_ids.shape[0]), compression=compression, compression_opts=compression_opts,
+                                                  chunk_bytes=chunk_bytes, itemsize=np.dtype(dtype).itemsize)
+                gts = store_f.create_dataset('gts', (k*n, 0), maxshape=(k*n, None), dtype=dtype, **options)
+            gts.resize(nsnp+L, axis=1)
+            gts[:, nsnp:(nsnp+L)] = np.transpose(G.gts, (1, 0, 2)).reshape((k*n, L))
+            nsnp += L
+            sid.append(G.sid)
+            alleles.append(G.alleles)
+            pos.append(np.array(G.pos, dtype=int))
+            chrom.append(np.array(G.chrom).astype(str))
+            print('Stored '+str(nsnp)+' SNPs')
+        # The columns are summed if there are no observed parents (see read.get_gts_matrix)
+        parsum = k == 2+int(sib)
+        columns = ['proband']
+        if sib:
+            columns.append('sibling')
+        columns += ['parental'] if parsum else ['paternal', 'maternal']
+        store_f['columns'] = encode_str_array(np.array(columns))
+        store_f['sid'] = encode_str_array(np.hstack(sid))
+        store_f['alleles'] = encode_str_array(np.vstack(alleles))
+        store_f['pos'] = np.hstack(pos)
+        store_f['chrom'] = encode_str_array(np.hstack(chrom))
+        store_f['ids'] = encode_str_array(design.ids)
+        store_f['fams'] = encode_str_array(design.fam_labels)
+        store_f['par_status'] = design.par_status
+        store_f['parcount'] = design.parcount
+        store_f['pedigree'] = encode_str_array(design.ped)
+        store_f.attrs['sib'] = sib
+        store_f.attrs['parsum'] = parsum
+        for key, x in [('bedfile', bedfile), ('bgenfile', bgenfile), ('par_gts_f', par_gts_f)]:
+            if x is not None:
+                store_f.attrs[key] = str(x)
+        store_f.attrs['complete'] = True
+    return nsnp
@@ -0,0 +1,172 @@
+import os
+import threading
+import weakref
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from bgen_reader import open_bgen
+from snipar.utilities import id_index, convert_str_array
+
+# Number of files whose parsed variant information is kept in memory
+variant_cache_size = 32
+_variant_cache = OrderedDict()
+_variant_cache_lock = threading.Lock()
+
+class variant_table(object):
+    """Parsed information on the variants in a genotype file: SNP ids, chromosomes, positions, and alleles, with a lookup from SNP id to
+    index. Tables are cached (see :func:`read_bim`, :func:`read_bgen_variants`, and :func:`read_imputed_variants`) and shared between
+    callers, so their arrays are read-only: index them to obtain copies.
+
+    Args:
+        sid : :class:`~numpy:numpy.array`
+            vector of SNP ids
+        chrom : :class:`~numpy:numpy.array`
+            vector of chromosomes (as strings)
+        pos : :class:`~numpy:numpy.array`
+            vector of base pair positions, or None if not recorded
+        alleles : :class:`~numpy:numpy.array`
+            [L x 2] array of alleles
+
+    Returns:
+        variants : :class:`snipar.read.variants.variant_table`
+
+    """
+    def __init__(self, sid, chrom, pos, alleles):
+        self.sid = sid
+        self.chrom = chrom
+        self.pos = pos
+        self.alleles = alleles
+        for x in (self.sid, self.chrom, self.pos, self.alleles):
+            if x is not None:
+                x.setflags(write=False)
+        self._index = None
+        # Held by weak reference, so that matches do not keep tables evicted from the cache alive
+        self._matches = weakref.WeakKeyDictionary()
+
+    def __len__(self):
+        return self.sid.shape[0]
+
+    @property
+    def index(self):
+        """
+        Lookup from SNP id to index (see :class:`snipar.utilities.id_index`)
+        """
+        if self._index is None:
+            self._index = id_index(self.sid)
+        return self._index
+
+    def match(self, other):
+        """
+        Index in this table of each SNP of another variant table, with -1 for SNPs not in this table. Cached for each other table.
+        """
+        if other not in self._matches:
+            indices = self.index.get_indexer(other.sid)
+            indices.setflags(write=False)
+            self._matches[other] = indices
+        return self._matches[other]
+
+def file_key(filename):
+    """
+    Key identifying a version of a file: its path, modification time, and size
+    """
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+def cached_variants(key, parse):
+    """
+    Return the variant table cached under key, or parse it with parse() and cache it, evicting the least recently used table
+    if more than variant_cache_size are cached
+    """
+    with _variant_cache_lock:
+        if key in _variant_cache:
+            _variant_cache.move_to_end(key)
+            return _variant_cache[key]
+    variants = parse()
+    with _variant_cache_lock:
+        _variant_cache[key] = variants
+        while len(_variant_cache) > variant_cache_size:
+            _variant_cache.popitem(last=False)
+    return variants
+
+def read_bim(bimfile):
+    """Read a .bim file, or return the cached variant table if the file has not changed since it was last read.
+
+    Args:
+        bimfile : :class:`str`
+            path to .bim file
+
+    Returns:
+        variants : :class:`snipar.read.variants.variant_table`
+
+    """
+    def parse():
+        bim = pd.read_csv(bimfile, delim_whitespace=True, header=None, dtype=str, na_filter=False)
+        return variant_table(bim[1].values.astype(str), bim[0].values.astype(str), bim[3].values.astype(int),
+                             bim[[4, 5]].values.astype(str))
+    return cached_variants(('bim',)+file_key(bimfile), parse)
+
+def read_bgen_variants(bgenfile, gts_f=None):
+    """Variant information of a .bgen file, cached while the file is unchanged. SNP ids are the variant ids,
+    or the rsids if the variant ids are not informative.
+
+    Args:
+        bgenfile : :class:`str`
+            path to .bgen file
+        gts_f : :class:`bgen_reader.open_bgen`
+            the .bgen file, if already open. Otherwise, it is opened if the variant information is not cached.
+
+    Returns:
+        variants : :class:`snipar.read.variants.variant_table`
+
+    """
+    def parse():
+        bgen = open_bgen(bgenfile, verbose=False) if gts_f is None else gts_f
+        snp_ids = np.array(bgen.ids)
+        if np.unique(snp_ids).shape[0] == 1:
+            snp_ids = np.array(bgen.rsids)
+        alleles = np.array([x.split(',') for x in bgen.allele_ids])
+        return variant_table(snp_ids, np.array(bgen.chromosomes).astype(str), np.array(bgen.positions), alleles)
+    return cached_variants(('bgen',)+file_key(bgenfile), parse)
+
+def read_imputed_variants(par_gts_f):
+    """Variant information (bim_columns and bim_values) of an open HDF5 file of imputed parental genotypes, cached while the file is unchanged.
+    Positions are not recorded.
+
+    Args:
+        par_gts_f : :class:`h5py.File`
+            open HDF5 file with imputed parental genotypes
+
+    Returns:
+        variants : :class:`snipar.read.variants.variant_table`
+
+    """
+    def parse():
+        imp_bim_cols = convert_str_array(np.array(par_gts_f['bim_columns']))
+        imp_bim = convert_str_array(np.array(par_gts_f['bim_values']))
+        # Get imputed SNP ids
+        found_snp_ids = False
+        if 'rsid' in imp_bim_cols:
+            imp_sid = imp_bim[:,np.where(imp_bim_cols=='rsid')[0][0]]
+            if np.unique(imp_sid).shape[0] == 0:
+                found_snp_ids = False
+            else:
+                found_snp_ids = True
+        if not found_snp_ids:
+            if 'id' in imp_bim_cols:
+                imp_sid = imp_bim[:,np.where(imp_bim_cols=='id')[0][0]]
+            else:
+                raise(ValueError('Cannot find imputed SNP ids'))
+        # Get imputed allele ids
+        if 'allele_ids' in imp_bim_cols:
+            imp_alleles = np.array([x.split(',') for x in imp_bim[:,np.where(imp_bim_cols=='allele_ids')[0][0]]])
+        elif 'allele1' in imp_bim_cols and 'allele2' in imp_bim_cols:
+            imp_alleles = imp_bim[:,[np.where(imp_bim_cols=='allele1')[0][0],np.where(imp_bim_cols=='allele2')[0][0]]]
+        else:
+            raise(ValueError('Cannot find imputed alleles'))
+        # Get imputed chromosomes
+        if 'Chr' in imp_bim_cols:
+            chr_col = np.where('Chr' == imp_bim_cols)[0][0]
+        else:
+            chr_col = 0
+        return variant_table(imp_sid, imp_bim[:,chr_col], None, imp_alleles)
+    return cached_variants(('imputed',)+file_key(par_gts_f.filename), parse)
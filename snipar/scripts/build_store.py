@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+import argparse
+import numpy as np
+from snipar.read.store import build_store, store_dtypes
+from snipar.read.imputed import imputed_compressions
+from snipar.utilities import *
+from snipar.pedigree import get_sibpairs_from_ped
+
+######### Command line arguments #########
+# Builds family genotype stores: the family based genotype matrices of gwas.py and pgs.py, with observed and imputed SNPs matched
+# and alleles flipped, written once so that repeated analyses of the same cohort (with --store) do not redo this work
+parser = argparse.ArgumentParser()
+parser.add_argument('out', type=str, help='Address to write the family genotype stores to (without .hdf5 suffix). If there is a @ in the address, @ is replaced by the chromosome number')
+parser.add_argument('--bgen',
+                    type=str,help='Address of the phased genotypes in .bgen format. If there is a @ in the address, @ is replaced by the chromosome numbers in the range of chr_range for each chromosome (chr_range is an optional parameters for this script).')
+parser.add_argument('--bed',
+                    type=str,help='Address of the unphased genotypes in .bed format. If there is a @ in the address, @ is replaced by the chromosome numbers in the range of chr_range for each chromosome (chr_range is an optional parameters for this script).')
+parser.add_argument('--native_bed',action='store_true',help='Read .bed files with snipar\'s memory-mapped reader, which decodes only the individuals and SNPs needed, rather than pysnptools',default=False)
+parser.add_argument('--imp', type=str, help='Address of hdf5 files with imputed parental genotypes (without .hdf5 suffix). If there is a @ in the address, @ is replaced by the chromosome numbers in the range of chr_range (chr_range is an optional parameters for this script).', default = None)
+parser.add_argument('--chr_range',
+                    type=parseNumRange,
+                    nargs='*',
+                    action=NumRangeAction,
+                    help='number of the chromosomes to be stored. Should be a series of ranges with x-y format or integers.', default=None)
+parser.add_argument('--pedigree',type=str,help='Address of pedigree file. Must be provided if not providing imputed parental genotypes.',default=None)
+parser.add_argument('--fit_sib',action='store_true',help='Store the mean of siblings\' genotypes for individuals with genotyped siblings, for use with --fit_sib in gwas.py and pgs.py',default=False)
+parser.add_argument('--batch_size',type=int,help='Number of SNPs to read at a time (default 10000)',default=10000)
+parser.add_argument('--float16',action='store_true',help='Store genotypes as float16 rather than float32, which halves the size of the store but rounds the means of siblings\' genotypes',default=False)
+parser.add_argument('--compression', type=str, choices=imputed_compressions, help='Compression algorithm: gzip, lzf, or blosc (requires hdf5plugin). Default no compression.', default=None)
+parser.add_argument('--compression_opts', type=int, help='Compression level for gzip (0-9) or blosc (0-9)', default=None)
+
+def main(args):
+    if args.bed is None and args.bgen is None:
+        raise(ValueError('Must provide one of --bed and --bgen'))
+    if args.bed is not None and args.bgen is not None:
+        raise(ValueError('Both bed files and bgen files provided. Please provide only one'))
+    if args.imp is None and args.pedigree is None:
+        raise(ValueError('Must provide pedigree if not providing imputed parental genotypes file(s)'))
+    obsfiles = args.bed if args.bed is not None else args.bgen
+    obsformat = 'bed' if args.bed is not None else 'bgen'
+    if '@' in obsfiles and '@' not in args.out:
+        raise(ValueError('Output address must contain @ when the genotype address does'))
+    # Find observed and imputed files
+    if args.imp is None:
+        obs_files, chroms = parse_obsfiles(obsfiles, obsformat, chromosomes=args.chr_range)
+        pargts_list = [None for x in range(chroms.shape[0])]
+        print('Reading pedigree from '+str(args.pedigree))
+        ped = np.loadtxt(args.pedigree,dtype=str)
+        if ped.shape[1] < 4:
+            raise(ValueError('Not enough columns in pedigree file'))
+        elif ped.shape[1] > 4:
+            print('Warning: pedigree file has more than 4 columns. The first four columns only will be used')
+        # Families are sibships, as in gwas.py
+        sibpairs, ped = get_sibpairs_from_ped(ped)
+    else:
+        obs_files, pargts_list, chroms = parse_filelist(obsfiles, args.imp, obsformat, chromosomes=args.chr_range)
+        ped = None
+    dtype = store_dtypes[1] if args.float16 else store_dtypes[0]
+    for i in range(chroms.shape[0]):
+        outfile = args.out.replace('@', str(chroms[i]))+'.hdf5'
+        print('Building family genotype store for '+obs_files[i])
+        bedfile = obs_files[i] if args.bed is not None else None
+        bgenfile = obs_files[i] if args.bgen is not None else None
+        nsnp = build_store(outfile, ped=ped, bedfile=bedfile, bgenfile=bgenfile, par_gts_f=pargts_list[i], sib=args.fit_sib,
+                           batch_size=args.batch_size, dtype=dtype, compression=args.compression,
+                           compression_opts=args.compression_opts, native_bed=args.native_bed, verbose=i==0)
+        print('Written '+str(nsnp)+' SNPs to '+outfile)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
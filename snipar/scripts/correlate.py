@@ -18,6 +18,7 @@ parser.add_argument('--ldscores',type=str,help='Address of ldscores as output by
 parser.add_argument('--bed', type=str,
                     help='Address of observed genotype files in .bed format (without .bed suffix). If there is a # in the address, # is replaced by the chromosome numbers in the range of 1-22.',
                     default=None)
+parser.add_argument('--native_bed',action='store_true',help='Read .bed files with snipar\'s memory-mapped reader, which decodes only the individuals and SNPs needed, rather than pysnptools',default=False)
 parser.add_argument('--threads',type=int,help='Number of threads to use for IBD inference. Uses all available by default.',default=None)
 parser.add_argument('--min_maf',type=float,help='Ignore SNPs with minor allele frequency below min_maf (default 0.05)', default=0.05)
 parser.add_argument('--corr_filter',type=float,help='Filter out SNPs with outlying sampling correlations more than corr_filter SDs from mean (default 6)',default=6.0)
@@ -58,7 +59,7 @@ def main(args):
         s.filter_NAs()
     elif args.bed is not None:
         bedfiles, chroms = parse_obsfiles(args.bed, obsformat='bed', chromosomes=chroms)
-        s.compute_ld_scores(bedfiles, chroms, args.ld_wind, args.ld_out)
+        s.compute_ld_scores(bedfiles, chroms, args.ld_wind, args.ld_out, native_bed=args.native_bed)
         s.filter_NAs()
 
     # Compute correlations 
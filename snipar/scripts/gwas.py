@@ -8,6 +8,7 @@ from snipar.gwas import *
 from numba import set_num_threads
 from numba import config as numba_config
 from snipar.pedigree import get_sibpairs_from_ped
+from pysnptools.snpreader import Pheno
 
 ######### Command line arguments #########
 parser=argparse.ArgumentParser()
@@ -16,6 +17,8 @@ parser.add_argument('--bgen',
                     type=str,help='Address of the phased genotypes in .bgen format. If there is a @ in the address, @ is replaced by the chromosome numbers in the range of chr_range for each chromosome (chr_range is an optional parameters for this script).')
 parser.add_argument('--bed',
                     type=str,help='Address of the unphased genotypes in .bed format. If there is a @ in the address, @ is replaced by the chromosome numbers in the range of chr_range for each chromosome (chr_range is an optional parameters for this script).')
+parser.add_argument('--native_bed',action='store_true',help='Read .bed files with snipar\'s memory-mapped reader, which decodes only the individuals and SNPs needed, rather than pysnptools',default=False)
+parser.add_argument('--store', type=str, help='Address of family genotype stores built by build_store.py (without .hdf5 suffix), read in place of the observed and imputed genotype files. If there is a @ in the address, @ is replaced by the chromosome numbers in the range of chr_range (chr_range is an optional parameters for this script).', default=None)
 parser.add_argument('--imp', type=str, help='Address of hdf5 files with imputed parental genotypes (without .hdf5 suffix). If there is a @ in the address, @ is replaced by the chromosome numbers in the range of chr_range (chr_range is an optional parameters for this script).', default = None)
 parser.add_argument('--chr_range',
                     type=parseNumRange,
@@ -29,16 +32,118 @@ parser.add_argument('--fit_sib',action='store_true',help='Fit indirect effect fr
 parser.add_argument('--covar',type=str,help='Path to file with covariates: plain text file with columns FID, IID, covar1, covar2, ..', default=None)
 parser.add_argument('--phen_index',type=int,help='If the phenotype file contains multiple phenotypes, which phenotype should be analysed (default 1, first)',
                     default=1)
+parser.add_argument('--phen_indices',
+                    type=parseNumRange,
+                    nargs='*',
+                    action=NumRangeAction,
+                    help='Analyse several phenotypes from the phenotype file in a single pass through the genotypes. Should be a series of ranges with x-y format or integers (counting from 1). Summary statistics for phenotype i are output to files with suffix .phen<i>.sumstats.gz and .phen<i>.sumstats.hdf5', default=None)
+parser.add_argument('--all_phenotypes',action='store_true',help='Analyse all phenotypes in the phenotype file in a single pass through the genotypes (see --phen_indices)',default=False)
 parser.add_argument('--min_maf',type=float,help='Ignore SNPs with minor allele frequency below min_maf (default 0.01)', default=0.01)
 parser.add_argument('--threads',type=int,help='Number of threads to use for IBD inference. Uses all available by default.',default=None)
+parser.add_argument('--processes',type=int,help='Number of chromosomes to process in parallel, each in its own process (default 1). Unless --threads is given, the available threads are divided between the processes.',default=1)
 parser.add_argument('--max_missing',type=float,help='Ignore SNPs with greater percent missing calls than max_missing (default 5)', default=5)
 parser.add_argument('--batch_size',type=int,help='Batch size of SNPs to load at a time (reduce to reduce memory requirements)',default=100000)
+parser.add_argument('--max_memory',type=float,help='Memory budget in GB. If given, the batch size is set to the largest number of SNPs whose projected peak memory fits within the budget, overriding --batch_size. With --processes, the budget is divided between the processes.',default=None)
+parser.add_argument('--prefetch',type=int,help='Number of batches of SNPs to read ahead while the current batch is fitted (default 1). Each prefetched batch adds one batch to memory requirements. Set to 0 to read and fit batches in sequence.',default=1)
+parser.add_argument('--resume',action='store_true',help='Resume an interrupted analysis: chromosomes with complete output are skipped, batches already written to the HDF5 output are not refitted, and the variance components are read from the HDF5 output rather than refitted',default=False)
+parser.add_argument('--shard',type=parseShard,help='Analyse only the k\'th of n contiguous shards of the SNPs of each chromosome, given as k/n, so that a chromosome can be split between jobs. Shard output files are labelled shard<k>of<n>, and are combined into the output of the whole chromosome by merge_shards.py',default=None)
+parser.add_argument('--snp_start',type=int,help='Analyse only the SNPs of each chromosome from this index (counting from 0, after removing duplicate SNP IDs). Output files are labelled snps<start>-<end>, and are combined by merge_shards.py',default=None)
+parser.add_argument('--snp_end',type=int,help='Analyse only the SNPs of each chromosome before this index (see --snp_start)',default=None)
+parser.add_argument('--save_null',type=str,help='Save the fitted null model (variance components, covariate effects, and the residualised and transformed phenotype) to <save_null>.null.hdf5 (or <save_null>.phen<i>.null.hdf5 for several phenotypes), keyed on checksums of the phenotype, covariate, and pedigree inputs',default=None)
+parser.add_argument('--load_null',type=str,help='Load the null model saved by --save_null with this prefix rather than fitting it. The phenotype, covariate, and pedigree inputs must match those used to fit it.',default=None)
+parser.add_argument('--tau_tolerance',type=float,help='With several phenotypes, analyse phenotypes whose null models have ratios of residual to family variance (tau) within this relative tolerance with the same transformed genotypes, using the tau of the first, which is faster. The standard errors of the other phenotypes are then approximate. Default 0: only phenotypes with equal tau share transformed genotypes.',default=0)
 parser.add_argument('--no_hdf5_out',action='store_true',help='Suppress HDF5 output of summary statistics',default=False)
 parser.add_argument('--no_txt_out',action='store_true',help='Suppress text output of summary statistics',default=False)
 parser.add_argument('--missing_char',type=str,help='Missing value string in phenotype file (default NA)', default='NA')
 parser.add_argument('--tau_init',type=float,help='Initial value for ratio between shared family environmental variance and residual variance',
                     default=1)
 
+def null_model_checksums(args, phen_index, ped):
+    """Checksums of the inputs of the null model of a phenotype, which key the null models saved by --save_null"""
+    return {'phenotype': file_checksum(args.phenofile)+':'+str(phen_index)+':'+args.missing_char,
+            'covariates': file_checksum(args.covar) if args.covar is not None else 'none',
+            'pedigree': array_checksum(ped)}
+
+def prepare_phenotype(args, phen_index, ped, chroms, phen_label=None):
+    """Read a phenotype, match it to the pedigree, fit (or read) its null model, and transform it.
+    If --load_null is given, the null model and transformed phenotype are loaded instead.
+
+    Returns:
+        y : :class:`snipar.gtarray`
+            transformed phenotype, adjusted for covariates, with family labels (y.fams)
+        tau : :class:`float`
+        sigma2 : :class:`float`
+        null_alpha : :class:`~numpy:numpy.array`
+            fixed effects of the null model (None if no covariates)
+    """
+    if args.load_null is not None:
+        null_file = null_model_file(args.load_null, phen_label)
+        print('Loading null model from '+null_file)
+        y, tau, sigma2, null_alpha = load_null_model(null_file, null_model_checksums(args, phen_index, ped))
+        print('Family variance estimate: '+str(round(sigma2/tau,4)))
+        print('Residual variance estimate: ' + str(round(sigma2,4)))
+        return y, tau, sigma2, null_alpha
+    ######### Read Phenotype ########
+    y = read.phenotype.read_phenotype(args.phenofile, missing_char=args.missing_char, phen_index=phen_index)
+    ######## Read covariates ########
+    if args.covar is not None:
+        print('Reading covariates')
+        covariates = read.phenotype.read_covariates(args.covar, pheno_ids=y.ids, missing_char=args.missing_char)
+        # Match to pheno ids
+        covariates.filter_ids(y.ids)
+    else:
+        covariates = None
+
+    ####### Fit null model ######
+    # Match to pedigree
+    ped_dict = id_index(ped,1)
+    y.filter_ids(ped[:,1])
+    print(str(y.shape[0])+' individuals with phenotype values found in pedigree')
+    ped_indices = ped_dict.get_indexer(y.ids)
+    y.fams = ped[ped_indices,0]
+
+    # Fit variance components, unless resuming from output that stores them
+    if args.covar is not None:
+        # Match covariates
+        covariates.filter_ids(y.ids)
+    label = shard_label(args.shard, args.snp_start, args.snp_end)
+    null_files = [sumstats_outfile(args.out, chrom, '.sumstats.hdf5', phen_label=phen_label, shard=label) for chrom in chroms] if args.resume else []
+    null_files = [x for x in null_files if path.exists(x)]
+    if len(null_files) > 0:
+        print('Reading variance components from '+null_files[0])
+        sigma2, tau, null_alpha = read_null_model(null_files[0])
+        if (null_alpha is None) != (args.covar is None):
+            raise(ValueError('Covariates do not match those used in '+null_files[0]))
+        null_model = lmm.model(y.gts[:,0], np.ones((y.shape[0], 1)), y.fams)
+    else:
+        print('Fitting variance components')
+        if args.covar is not None:
+            # Fit null model
+            null_model, sigma2, tau, null_alpha, null_alpha_cov = lmm.fit_model(y.gts[:,0], covariates.gts, y.fams, add_intercept=True,
+                                                                                tau_init=args.tau_init)
+        else:
+            # Fit null model
+            null_model, sigma2, tau = lmm.fit_model(y.gts[:,0], np.ones((y.shape[0], 1)), y.fams,
+                                                    tau_init = args.tau_init, return_fixed = False)
+            null_alpha = None
+    if args.covar is not None:
+        # Adjust for covariates
+        y.gts[:,0] = y.gts[:,0]-(null_alpha[0]+covariates.gts.dot(null_alpha[1:null_alpha.shape[0]]))
+    else:
+        y.gts[:,0] = y.gts[:,0]-np.mean(y.gts[:,0])
+    print('Family variance estimate: '+str(round(sigma2/tau,4)))
+    print('Residual variance estimate: ' + str(round(sigma2,4)))
+
+    # Diagonalize y
+    print('Transforming phenotype')
+    L = null_model.sigma_inv_root(tau, sigma2)
+    y.diagonalise(L)
+    if args.save_null is not None:
+        null_file = null_model_file(args.save_null, phen_label)
+        print('Saving null model to '+null_file)
+        write_null_model(null_file, y, sigma2, tau, null_alpha, null_model_checksums(args, phen_index, ped))
+    return y, tau, sigma2, null_alpha
+
 # Set number of threads
 def main(args):
     if args.threads is not None:
@@ -47,15 +152,36 @@ def main(args):
             print('Number of threads: '+str(args.threads))
 
     # Check arguments
-    if args.bed is None and args.bgen is None:
+    if args.tau_tolerance < 0:
+        raise(ValueError('tau tolerance must be non-negative'))
+    if args.store is not None:
+        if args.bed is not None or args.bgen is not None or args.imp is not None:
+            raise(ValueError('Provide either --store or the genotype files used to build it'))
+    elif args.bed is None and args.bgen is None:
         raise(ValueError('Must provide one of --bedfiles and --bgenfiles'))
     if args.bed is not None and args.bgen is not None:
         raise(ValueError('Both bed files and bgen files provided. Please provide only one'))
-    if args.imp is None and args.pedigree is None:
+    if args.imp is None and args.pedigree is None and args.store is None:
         raise(ValueError('Must provide pedigree if not providing imputed parental genotypes file(s)'))
+    if args.resume and args.no_hdf5_out:
+        raise(ValueError('--resume requires HDF5 output'))
+    if args.shard is not None and (args.snp_start is not None or args.snp_end is not None):
+        raise(ValueError('Provide either --shard or --snp_start/--snp_end'))
+    if shard_label(args.shard, args.snp_start, args.snp_end) is not None and args.no_hdf5_out:
+        raise(ValueError('Sharding requires HDF5 output, which merge_shards.py uses to check the shards'))
+    if args.save_null is not None and args.load_null is not None:
+        raise(ValueError('Provide only one of --save_null and --load_null'))
+    if args.phen_indices is not None and args.all_phenotypes:
+        raise(ValueError('Provide only one of --phen_indices and --all_phenotypes'))
 
     # Find observed and imputed files
-    if args.imp is None:
+    storefiles = None
+    if args.store is not None:
+        storefiles, chroms = parse_obsfiles(args.store, 'hdf5', chromosomes=args.chr_range)
+        bedfiles = [None for x in range(chroms.shape[0])]
+        bgenfiles = [None for x in range(chroms.shape[0])]
+        pargts_list = [None for x in range(chroms.shape[0])]
+    elif args.imp is None:
         print('Warning: no imputed parental genotypes provided. Will analyse only individuals with both parents genotyped.')
         if args.bed is not None:
             bedfiles, chroms = parse_obsfiles(args.bed, 'bed', chromosomes=args.chr_range)
@@ -74,20 +200,12 @@ def main(args):
     if chroms.shape[0]==0:
         raise(ValueError('No input genotype files found'))
 
-    # Read phenotype and covariates
-    ######### Read Phenotype ########
-    y = read.phenotype.read_phenotype(args.phenofile, missing_char=args.missing_char, phen_index=args.phen_index)
-    ######## Read covariates ########
-    if args.covar is not None:
-        print('Reading covariates')
-        covariates = read.phenotype.read_covariates(args.covar, pheno_ids=y.ids, missing_char=args.missing_char)
-        # Match to pheno ids
-        covariates.filter_ids(y.ids)
-    else:
-        covariates = None
-
     # Read pedigree
-    if args.imp is None:
+    if args.store is not None:
+        # Pedigree without control families
+        with h5py.File(storefiles[0],'r') as store_f:
+            ped = convert_str_array(store_f['pedigree'])
+    elif args.imp is None:
         print('Reading pedigree from '+str(args.pedigree))
         ped = np.loadtxt(args.pedigree,dtype=str)
         if ped.shape[1] < 4:
@@ -109,52 +227,35 @@ def main(args):
         controls = np.array([x[0]=='_' for x in ped[:,0]])
         ped = ped[~controls,:]
 
-    ####### Fit null model ######
-    # Match to pedigree
-    ped_dict = make_id_dict(ped,1)
-    y.filter_ids(ped[:,1])
-    print(str(y.shape[0])+' individuals with phenotype values found in pedigree')
-    ped_indices = np.array([ped_dict[x] for x in y.ids])
-    y.fams = ped[ped_indices,0]
-
-    # Fit variance components
-    print('Fitting variance components')
-    if args.covar is not None:
-        # Match covariates
-        covariates.filter_ids(y.ids)
-        # Fit null model
-        null_model, sigma2, tau, null_alpha, null_alpha_cov = lmm.fit_model(y.gts[:,0], covariates.gts, y.fams, add_intercept=True,
-                                                                            tau_init=args.tau_init)
-        # Adjust for covariates
-        y.gts[:,0] = y.gts[:,0]-(null_alpha[0]+covariates.gts.dot(null_alpha[1:null_alpha.shape[0]]))
+    # Phenotypes to analyse
+    if args.all_phenotypes:
+        phen_indices = np.arange(1, Pheno(args.phenofile, missing=args.missing_char).col_count+1)
+    elif args.phen_indices is not None:
+        phen_indices = np.array(args.phen_indices, dtype=int)
     else:
-        # Fit null model
-        null_model, sigma2, tau = lmm.fit_model(y.gts[:,0], np.ones((y.shape[0], 1)), y.fams,
-                                                tau_init = args.tau_init, return_fixed = False)
-        y.gts[:,0] = y.gts[:,0]-np.mean(y.gts[:,0])
-    print('Family variance estimate: '+str(round(sigma2/tau,4)))
-    print('Residual variance estimate: ' + str(round(sigma2,4)))
+        phen_indices = None
 
-    # Diagonalize y
-    print('Transforming phenotype')
-    L = null_model.sigma_inv_root(tau, sigma2)
-    y.diagonalise(L)
+    if phen_indices is None:
+        y, tau, sigma2, null_alpha = prepare_phenotype(args, args.phen_index, ped, chroms)
+        phen_labels = None
+    else:
+        phen_labels = ['phen'+str(x) for x in phen_indices]
+        y, tau, sigma2, null_alpha = [], [], [], []
+        for i in range(phen_indices.shape[0]):
+            print('Phenotype '+str(phen_indices[i]))
+            y_i, tau_i, sigma2_i, null_alpha_i = prepare_phenotype(args, phen_indices[i], ped, chroms, phen_label=phen_labels[i])
+            y.append(y_i)
+            tau.append(tau_i)
+            sigma2.append(sigma2_i)
+            null_alpha.append(null_alpha_i)
 
-    for i in range(chroms.shape[0]):
-        if args.bed is not None:
-            print('Observed genotypes file: '+bedfiles[i])
-        if args.bgen is not None:
-            print('Observed genotypes file: '+bgenfiles[i])
-        if args.imp is not None:
-            print('Imputed genotypes file: '+pargts_list[i])
-        if chroms.shape[0]>1:
-            print('Estimating SNP effects for chromosome '+str(chroms[i]))
-        else:
-            print('Estimaing SNP effects')
-        process_chromosome(chroms[i], y, ped, tau, sigma2, args.out, bedfile=bedfiles[i], bgenfile=bgenfiles[i], 
-                            par_gts_f=pargts_list[i], fit_sib=args.fit_sib, parsum=args.parsum, 
-                            max_missing=args.max_missing, min_maf=args.min_maf, batch_size=args.batch_size, 
-                            no_hdf5_out=args.no_hdf5_out, no_txt_out=args.no_txt_out)
+    process_chromosomes(chroms, y, ped, tau, sigma2, args.out, bedfiles, bgenfiles, pargts_list,
+                        processes=args.processes, threads=args.threads, fit_sib=args.fit_sib, parsum=args.parsum,
+                        max_missing=args.max_missing, min_maf=args.min_maf, batch_size=args.batch_size,
+                        no_hdf5_out=args.no_hdf5_out, no_txt_out=args.no_txt_out, prefetch=args.prefetch,
+                        resume=args.resume, null_alpha=null_alpha, phen_labels=phen_labels,
+                        max_memory=args.max_memory, native_bed=args.native_bed, storefiles=storefiles,
+                        shard=args.shard, snp_start=args.snp_start, snp_end=args.snp_end, tau_rtol=args.tau_tolerance)
 if __name__ == "__main__":
     args=parser.parse_args()
     main(args)
\ No newline at end of file
@@ -13,6 +13,7 @@ parser.add_argument('--bgen',
                     type=str,help='Address of the phased genotypes in .bgen format. If there is a @ in the address, @ is replaced by the chromosome numbers in the range of chr_range for each chromosome (chr_range is an optional parameters for this script).')
 parser.add_argument('--bed',
                     type=str,help='Address of the unphased genotypes in .bed format. If there is a @ in the address, @ is replaced by the chromosome numbers in the range of chr_range for each chromosome (chr_range is an optional parameters for this script).')
+parser.add_argument('--native_bed',action='store_true',help='Read .bed files with snipar\'s memory-mapped reader, which decodes only the individuals and SNPs needed, rather than pysnptools',default=False)
 parser.add_argument('--chr_range',
                     type=parseNumRange,
                     nargs='*',
@@ -44,6 +45,7 @@ parser.add_argument('--max_missing', type=float,
                     help='Ignore SNPs with greater percent missing calls than max_missing (default 5)', default=5)
 parser.add_argument('--max_error', type=float, help='Maximum per-SNP genotyping error probability', default=0.01)
 parser.add_argument('--ibdmatrix',action='store_true',default=False,help='Output a matrix of SNP IBD states (in addition to segments file)')
+parser.add_argument('--batch_size',type=int,help='Number of sibling pairs to infer IBD for at a time. The segments of each batch are written before the next batch is inferred, so memory use grows with batch_size rather than the number of sibling pairs. By default, derived from the number of threads and, with --ibdmatrix, the number of SNPs, so that the matrix of IBD states of a batch takes at most 256MB.',default=None)
 parser.add_argument('--ld_out',action='store_true',default=False,help='Output LD scores of SNPs (used internally for weighting).')
 parser.add_argument('--chrom',type=int,help='The chromosome of the input .bgen file. Helpful if inputting a single .bgen file without chromosome information.',default=None)
 
@@ -86,6 +88,9 @@ def main(args):
     else:
         raise(ValueError('Max missing % must be between 0 and 100'))
 
+    if args.batch_size is not None and args.batch_size < 1:
+        raise(ValueError('Batch size must be at least 1'))
+
     if 0 <= args.max_error <= 1:
         max_error = args.max_error
     else:
@@ -123,7 +128,7 @@ def main(args):
             else:
                 raise(ValueError('Must provide age and sex information (--agesex) in addition to KING kinship file, if estimating genotyping error probability'))
         if args.bed is not None:
-            error_prob, error_probs = estimate_genotyping_error_rate(ped, bedfiles=bedfiles, min_maf=min_maf)
+            error_prob, error_probs = estimate_genotyping_error_rate(ped, bedfiles=bedfiles, min_maf=min_maf, native_bed=args.native_bed)
         elif args.bgen:
             error_prob, error_probs = estimate_genotyping_error_rate(ped, bgenfiles=bgenfiles, min_maf=min_maf)
         print('Estimated mean genotyping error probability: '+str(round(error_prob, 6)))
@@ -143,7 +148,8 @@ def main(args):
                                 bedfile=bedfiles[i], bgenfile=bgenfiles[i], chrom=chroms[i],
                                 min_length=min_length, mapfile=args.map,
                                 ibdmatrix=args.ibdmatrix, ld_out=args.ld_out,
-                                min_maf=min_maf, max_missing=max_missing, max_error=max_error)
+                                min_maf=min_maf, max_missing=max_missing, max_error=max_error,
+                                native_bed=args.native_bed, pair_batch_size=args.batch_size)
 if __name__ == "__main__":
     args=parser.parse_args()
     main(args)
\ No newline at end of file
@@ -85,10 +85,10 @@ Args:
         Number of chunks load data in(each process).
 
     --output_compression: str, optional
-        Optional compression algorithm used in writing the output as an hdf5 file. It can be either gzip or lzf.
+        Optional compression algorithm used in writing the output as an hdf5 file. It can be either gzip, lzf, or blosc (requires hdf5plugin). Compressed output is byte-shuffled.
 
     --output_compression_opts': int, optional
-        Additional settings for the optional compression algorithm. Take a look at the create_dataset function of h5py library for more information.
+        Compression level for gzip (0-9) or blosc (0-9).
 
     --pedigree_nan: str, optional
         The value representing NaN in the pedigreee. Default is '0'
@@ -111,6 +111,7 @@ import os
 from multiprocessing import Pool
 from time import time
 from snipar.utilities import NumRangeAction, parseNumRange
+from snipar.read.imputed import imputed_dataset_options, imputed_compressions
 random.seed(1567924)
 
 def run_imputation(data):
@@ -172,7 +173,7 @@ def run_imputation(data):
                     Number of chunks load data in(each process).
 
                 output_compression: str, optional
-                    Optional compression algorithm used in writing the output as an hdf5 file. It can be either gzip or lzf. None means no compression.
+                    Optional compression algorithm used in writing the output as an hdf5 file. It can be either gzip, lzf, or blosc (requires hdf5plugin). None means no compression.
 
                 output_compression_opts: int, optional
                     Additional settings for the optional compression algorithm. Take a look at the create_dataset function of h5py library for more information. None means no compression setting.
@@ -185,6 +186,9 @@ def run_imputation(data):
 
                 silent_progress: bool
                     Hides the percentage of progress from logging
+
+                native_bed: bool, optional
+                    Read the bed file with the memory-mapped snipar.read.bed.bed_reader rather than pysnptools.
     Returns:
         float
             time consumed by the imputation.
@@ -211,6 +215,7 @@ def run_imputation(data):
     chromosome = data.get("chromosome")
     pedigree_nan = data.get("pedigree_nan")
     silent_progress = data.get("silent_progress")
+    native_bed = data.get("native_bed", False)
     logging.info("processing " + str(phased_address) + "," + str(unphased_address))
     sibships, ibd, bim, chromosomes, ped_ids, pedigree_output = prepare_data(pedigree, phased_address, unphased_address, ibd_address, ibd_is_king, bim, fam, control, chromosome = chromosome, pedigree_nan=pedigree_nan)
     number_of_snps = len(bim)
@@ -228,7 +233,7 @@ def run_imputation(data):
             interval = ((end-start+chunks-1)//chunks)
             chunk_start = start+i*interval
             chunk_end = min(start+(i+1)*interval, end)
-            phased_gts, unphased_gts, iid_to_bed_index, pos, freqs, hdf5_output_dict = prepare_gts(phased_address, unphased_address, bim, pedigree_output, ped_ids, chromosomes, chunk_start, chunk_end, pcs, pc_ids, find_optimal_pc)
+            phased_gts, unphased_gts, iid_to_bed_index, pos, freqs, hdf5_output_dict = prepare_gts(phased_address, unphased_address, bim, pedigree_output, ped_ids, chromosomes, chunk_start, chunk_end, pcs, pc_ids, find_optimal_pc, native_bed)
             imputed_fids, imputed_par_gts = impute(sibships, iid_to_bed_index, phased_gts, unphased_gts, ibd, pos, hdf5_output_dict, str(chromosomes), freqs, chunk_output_address, threads = threads, output_compression=output_compression, output_compression_opts=output_compression_opts, silent_progress=silent_progress, use_backup=use_backup)
             logging.info(f"imputing chunk {i}/{chunks} done")
         
@@ -266,12 +271,12 @@ def run_imputation(data):
         with h5py.File(f"{output_address}.hdf5", "w") as hf:
             for key, val in hdf5_results.items():
                 if key=='imputed_par_gts':
-                    hf.create_dataset(key, val.shape, dtype = 'float16', chunks = True, compression = output_compression, compression_opts=output_compression_opts, data = val)
+                    hf.create_dataset(key, val.shape, dtype = 'float16', data = val, **imputed_dataset_options(val.shape, output_compression, output_compression_opts))
                 else:
                     hf[key] = val
         logging.info(f"merging chunks done")
     elif chunks == 1:
-        phased_gts, unphased_gts, iid_to_bed_index, pos, freqs, hdf5_output_dict = prepare_gts(phased_address, unphased_address, bim, pedigree_output, ped_ids, chromosomes, start, end, pcs, pc_ids, find_optimal_pc)
+        phased_gts, unphased_gts, iid_to_bed_index, pos, freqs, hdf5_output_dict = prepare_gts(phased_address, unphased_address, bim, pedigree_output, ped_ids, chromosomes, start, end, pcs, pc_ids, find_optimal_pc, native_bed)
         imputed_fids, imputed_par_gts = impute(sibships, iid_to_bed_index, phased_gts, unphased_gts, ibd, pos, hdf5_output_dict, str(chromosomes), freqs, output_address, threads = threads, output_compression=output_compression, output_compression_opts=output_compression_opts, silent_progress=silent_progress, use_backup=use_backup)
     else:
         raise Exception("invalid chunks, chunks should be a positive integer")  
@@ -377,7 +382,8 @@ def main(args):
             "output_compression_opts":args.output_compression_opts,
             "chromosome":chromosome,
             "pedigree_nan":args.pedigree_nan,
-            'silent_progress':args.silent_progress
+            'silent_progress':args.silent_progress,
+            'native_bed':args.native_bed
             }
             for chromosome in chromosomes]
     #TODO output more information about the imputation inside the hdf5 filehf
@@ -458,6 +464,9 @@ parser.add_argument('--pc_num',
                     type=int,
                     default = None,
                     help='Number of PCs to consider')
+parser.add_argument('-native_bed',
+                    action='store_true',
+                    help='Read the .bed file with snipar\'s memory-mapped reader, which only decodes the SNPs being imputed, rather than pysnptools')
 parser.add_argument('-find_optimal_pc',
                     action='store_true',
                     help='It will use Akaike information criterion to find the optimal number of PCs to use for MAF estimation.')
@@ -476,11 +485,12 @@ parser.add_argument('--chunks',
 parser.add_argument('--output_compression',
                     type=str,
                     default=None,
-                    help='Optional compression algorithm used in writing the output as an hdf5 file. It can be either gzip or lzf')
+                    choices=imputed_compressions,
+                    help='Optional compression algorithm used in writing the output as an hdf5 file. It can be either gzip, lzf, or blosc (requires hdf5plugin). Compressed output is byte-shuffled.')
 parser.add_argument('--output_compression_opts',
                     type=int,
                     default=None,
-                    help='Additional settings for the optional compression algorithm. Take a look at the create_dataset function of h5py library for more information.')
+                    help='Compression level for gzip (0-9) or blosc (0-9).')
 parser.add_argument('--pedigree_nan',
                     type=str,
                     default='0',
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+import argparse
+from snipar.gwas import find_shard_phenotypes, merge_shards
+from snipar.utilities import NumRangeAction, parseNumRange
+
+######### Command line arguments #########
+# Combines the summary statistics of shards of chromosomes (written by gwas.py with --shard or --snp_start/--snp_end) into the
+# summary statistics files of the whole chromosomes, checking that the shards are complete and cover each chromosome without gaps or overlaps
+parser = argparse.ArgumentParser()
+parser.add_argument('out', type=str, help='Output address given to gwas.py with --out. If there is a @ in the address, @ is replaced by the chromosome numbers in chr_range (optional argument)')
+parser.add_argument('--chr_range',
+                    type=parseNumRange,
+                    nargs='*',
+                    action=NumRangeAction,
+                    help='number of the chromosomes to be merged. Should be a series of ranges with x-y format or integers. By default, all chromosomes (1-22) with shards are merged.', default=None)
+parser.add_argument('--remove', action='store_true', help='Remove the files of the shards after merging them', default=False)
+
+def main(args):
+    if args.chr_range is not None:
+        chroms = [int(x) for x in args.chr_range]
+    elif '@' in args.out:
+        chroms = list(range(1, 23))
+    else:
+        chroms = [0]+list(range(1, 23))
+    nmerged = 0
+    for chrom in chroms:
+        for phen_label in find_shard_phenotypes(args.out, chrom):
+            outfiles = merge_shards(args.out, chrom, phen_label=phen_label, remove=args.remove)
+            print('Merged shards of chromosome '+str(chrom)+' into '+', '.join(outfiles))
+            nmerged += 1
+    if nmerged == 0:
+        raise(ValueError('No shards found'))
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -14,6 +14,8 @@ parser.add_argument('--bgen',
                     type=str,help='Address of the phased genotypes in .bgen format. If there is a @ in the address, @ is replaced by the chromosome numbers in the range of chr_range for each chromosome (chr_range is an optional parameters for this script).')
 parser.add_argument('--bed',
                     type=str,help='Address of the unphased genotypes in .bed format. If there is a @ in the address, @ is replaced by the chromosome numbers in the range of chr_range for each chromosome (chr_range is an optional parameters for this script).')
+parser.add_argument('--native_bed',action='store_true',help='Read .bed files with snipar\'s memory-mapped reader, which decodes only the individuals and SNPs needed, rather than pysnptools',default=False)
+parser.add_argument('--store', type=str, help='Address of family genotype stores built by build_store.py (without .hdf5 suffix), read in place of the observed and imputed genotype files. If there is a @ in the address, @ is replaced by the chromosome numbers in the range of chr_range (chr_range is an optional parameters for this script).', default=None)
 parser.add_argument('--imp', type=str, help='Address of hdf5 files with imputed parental genotypes (without .hdf5 suffix). If there is a @ in the address, @ is replaced by the chromosome numbers in the range of chr_range (chr_range is an optional parameters for this script).', default = None)
 parser.add_argument('--chr_range',
                     type=parseNumRange,
@@ -41,7 +43,12 @@ parser.add_argument('--missing_char',type=str,help='Missing value string in phen
 
 def main(args):
     if args.weights is not None:
-        if args.bed is None and args.bgen is None:
+        if args.store is not None:
+            if args.bed is not None or args.bgen is not None or args.imp is not None:
+                raise ValueError('Provide either --store or the genotype files used to build it')
+            if args.compute_controls:
+                raise ValueError('Cannot compute PGS for control families from a family genotype store')
+        elif args.bed is None and args.bgen is None:
             raise ValueError('Weights provided but no observed genotypes provided')
         if args.bed is not None and args.bgen is not None:
             raise ValueError('Provide only one of --bedfiles and --bgenfiles')
@@ -62,7 +69,12 @@ def main(args):
 
         ###### Compute PGS ########
         # Find observed and imputed files
-        if args.imp is None:
+        if args.store is not None:
+            storefiles, chroms = parse_obsfiles(args.store, 'hdf5', chromosomes=args.chr_range)
+            bedfiles = [None for x in range(chroms.shape[0])]
+            bgenfiles = [None for x in range(chroms.shape[0])]
+            pargts_list = [None for x in range(chroms.shape[0])]
+        elif args.imp is None:
             print('Warning: no imputed parental genotypes provided. Will compute PGS only for individuals with both parents genotyped.')
             if args.bed is not None:
                 bedfiles, chroms = parse_obsfiles(args.bed, 'bed', chromosomes=args.chr_range)
@@ -80,8 +92,10 @@ def main(args):
                 bedfiles = [None for x in range(chroms.shape[0])]
         if chroms.shape[0]==0:
             raise(ValueError('No input genotype files found'))
+        if args.store is None:
+            storefiles = [None for x in range(chroms.shape[0])]
         # Get pedigree if no imputed parental genotypes provided
-        if args.imp is None:
+        if args.imp is None and args.store is None:
             if args.pedigree is None:
                 raise(ValueError('Must provide pedigree if not providing imputed parental genotypes'))
             print('Reading pedigree from '+str(args.pedigree))
@@ -93,13 +107,13 @@ def main(args):
         else:
             ped = None
         print('Computing PGS')
-        pg = pgs.compute(p, bedfile=bedfiles[0], bgenfile=bgenfiles[0], par_gts_f=pargts_list[0], ped=ped, sib=args.fit_sib, compute_controls=args.compute_controls)
+        pg = pgs.compute(p, bedfile=bedfiles[0], bgenfile=bgenfiles[0], par_gts_f=pargts_list[0], ped=ped, sib=args.fit_sib, compute_controls=args.compute_controls, native_bed=args.native_bed, storefile=storefiles[0])
         for i in range(1,chroms.shape[0]):
             if args.compute_controls:
-                pg_i = pgs.compute(p, bedfile=bedfiles[i], bgenfile=bgenfiles[i], par_gts_f=pargts_list[i], ped=ped, sib=args.fit_sib, compute_controls=args.compute_controls)
+                pg_i = pgs.compute(p, bedfile=bedfiles[i], bgenfile=bgenfiles[i], par_gts_f=pargts_list[i], ped=ped, sib=args.fit_sib, compute_controls=args.compute_controls, native_bed=args.native_bed, storefile=storefiles[i])
                 pg = [pg[x].add(pg_i[x]) for x in range(0, len(pg))]
             else:
-                pg = pg.add(pgs.compute(p, bedfile=bedfiles[i], bgenfile=bgenfiles[i], par_gts_f=pargts_list[i], ped=ped, sib=args.fit_sib, compute_controls=args.compute_controls))
+                pg = pg.add(pgs.compute(p, bedfile=bedfiles[i], bgenfile=bgenfiles[i], par_gts_f=pargts_list[i], ped=ped, sib=args.fit_sib, compute_controls=args.compute_controls, native_bed=args.native_bed, storefile=storefiles[i]))
         print('PGS computed')
         ####### Write PGS to file ########
         if args.compute_controls:
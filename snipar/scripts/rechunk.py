@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+import argparse
+from snipar.read.imputed import rechunk, imputed_compressions
+from snipar.utilities import parse_obsfiles, NumRangeAction, parseNumRange
+
+######### Command line arguments #########
+# Rewrites HDF5 files of imputed parental genotypes (output by impute.py) with a SNP-major chunk layout, which suits the reads of batches
+# of SNPs by gwas.py and pgs.py, and optional compression
+parser = argparse.ArgumentParser()
+parser.add_argument('imp', type=str, help='Address of imputed parental genotype files in HDF5 format (without .hdf5 suffix). If there is a @ in the address, @ is replaced by the chromosome numbers in chr_range (optional argument)')
+parser.add_argument('out', type=str, help='Address to write the rechunked files to (without .hdf5 suffix). If there is a @ in the address, @ is replaced by the chromosome number')
+parser.add_argument('--chr_range',
+                    type=parseNumRange,
+                    nargs='*',
+                    action=NumRangeAction,
+                    help='number of the chromosomes to be rechunked. Should be a series of ranges with x-y format or integers.', default=None)
+parser.add_argument('--compression', type=str, choices=imputed_compressions, help='Compression algorithm: gzip, lzf, or blosc (requires hdf5plugin). Default no compression.', default=None)
+parser.add_argument('--compression_opts', type=int, help='Compression level for gzip (0-9) or blosc (0-9)', default=None)
+parser.add_argument('--no_shuffle', action='store_true', help='Do not apply the byte shuffle filter before compression', default=False)
+parser.add_argument('--chunk_bytes', type=int, help='Target size of a chunk in bytes (default 1048576)', default=None)
+
+def main(args):
+    if '@' in args.imp and '@' not in args.out:
+        raise(ValueError('Output address must contain @ when the input address does'))
+    imp_files, chroms = parse_obsfiles(args.imp, obsformat='hdf5', chromosomes=args.chr_range)
+    out_files = [args.out.replace('@', str(x))+'.hdf5' for x in chroms]
+    shuffle = False if args.no_shuffle else None
+    for imp_file, out_file in zip(imp_files, out_files):
+        print('Rechunking '+imp_file)
+        chunks = rechunk(imp_file, out_file, compression=args.compression, compression_opts=args.compression_opts,
+                         shuffle=shuffle, chunk_bytes=args.chunk_bytes)
+        print('Written '+out_file+' with chunks of '+str(chunks[0])+' families x '+str(chunks[1])+' SNPs')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
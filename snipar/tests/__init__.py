@@ -1,6 +1,7 @@
 import os
 
 from snipar.tests.test_sibreg import *
+from snipar.tests.test_read import *
 from snipar.tests.test_impute_from_sibs import *
 from snipar.tests.test_impute import *
 from snipar.tests.test_pedigree_creation import *
@@ -0,0 +1,235 @@
+import unittest
+import glob
+import copy
+import tracemalloc
+import gzip
+import h5py
+import numpy as np
+from numpy import testing
+from pysnptools.snpreader import Bed
+from snipar import gwas, lmm
+from snipar.gtarray import gtarray
+from snipar.utilities import id_index
+from snipar.pedigree import get_sibpairs_from_ped
+from snipar.read.imputed import imputed_dataset_options
+from snipar.scripts import gwas as gwas_script
+from snipar.tests.utils import *
+
+def random_phenotype(pedfile, seed=0):
+    """Pedigree of a test population and a simulated phenotype for its individuals"""
+    ped = np.loadtxt(pedfile, dtype=str)
+    sibpairs, ped = get_sibpairs_from_ped(ped)
+    rng = np.random.default_rng(seed)
+    y = gtarray(rng.normal(size=(ped.shape[0], 1)), ped[:, 1], fams=ped[:, 0])
+    return y, ped
+
+def write_imputed(bedfile, ped, outfile, seed=0):
+    """Write simulated imputed parental genotypes of all families in a pedigree at the SNPs of a .bed file, chunked as written by snipar.
+    Returns the pedigree with the columns recording that no parent is a control (has_father, has_mother)."""
+    ped = np.column_stack((ped, np.full((ped.shape[0], 2), 'False')))
+    bim = np.loadtxt(bedfile.split('.bed')[0]+'.bim', dtype=str)
+    fams = np.unique(ped[:, 0])
+    rng = np.random.default_rng(seed)
+    gts = (rng.integers(0, 5, (fams.shape[0], bim.shape[0]))/2).astype(np.float16)
+    with h5py.File(outfile, 'w') as f:
+        f.create_dataset('imputed_par_gts', data=gts, **imputed_dataset_options(gts.shape, compression='gzip'))
+        f['families'] = fams.astype('S')
+        f['pedigree'] = ped.astype('S')
+        f['bim_columns'] = np.array(['Chr', 'id', 'cm', 'pos', 'allele1', 'allele2'], dtype='S')
+        f['bim_values'] = bim.astype('S')
+    return ped
+
+class test_batch_memory(SniparTest):
+
+    def test_snp_memory(self):
+        bedfile = os.path.join(tests_root, 'test_data', 'sample1.bed')
+        imputedfile = os.path.join(output_root, 'batch_memory.hdf5')
+        y, ped = random_phenotype(os.path.join(tests_root, 'test_data', 'sample1.ped'))
+        imputed_ped = write_imputed(bedfile, ped, imputedfile)
+        sid = Bed(bedfile, count_A1=True).sid[0:200]
+        # Observed genotypes only, and with imputed parental genotypes read through the cache and without it
+        for par_gts_f, cache_bytes in [(None, None), (imputedfile, None), (imputedfile, 0)]:
+            for fit_sib in [False, True]:
+                plan = gwas.batch_plan(copy.deepcopy(y), ped if par_gts_f is None else imputed_ped, 1.0, 1.0, bedfile=bedfile,
+                                       par_gts_f=par_gts_f, fit_sib=fit_sib)
+                if par_gts_f is None:
+                    self.assertEqual(plan.fixed_memory(), 0)
+                else:
+                    reader = plan.design.imp_reader
+                    if cache_bytes is not None:
+                        reader.cache_bytes = cache_bytes
+                    self.assertEqual(plan.fixed_memory(), reader.cache_bytes+reader.shape[0]*reader.chunks[1]*reader.dtype.itemsize)
+                projected = plan.fixed_memory()+plan.snp_memory(3+int(fit_sib), prefetch=0)*sid.shape[0]
+                tracemalloc.start()
+                G = gwas.read_batch(sid, plan)
+                _, read_peak = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                start, _ = tracemalloc.get_traced_memory()
+                gwas.fit_batch(G, plan)
+                _, fit_peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                fit_peak = fit_peak-start+G.gts.nbytes
+                if self.log:
+                    print('Batch of '+str(sid.shape[0])+' SNPs: projected '+gwas.format_memory(projected)+', read '+
+                          gwas.format_memory(read_peak)+', fit '+gwas.format_memory(fit_peak))
+                self.assertLessEqual(read_peak, projected)
+                self.assertLessEqual(fit_peak, projected)
+
+class test_phenotype_groups(SniparTest):
+
+    def transformed(self, y, tau, sigma2):
+        y = copy.deepcopy(y)
+        y.diagonalise(lmm.model(y.gts[:,0], np.ones((y.shape[0], 1)), y.fams).sigma_inv_root(tau, sigma2))
+        return y
+
+    def test_tau_tolerance(self):
+        bedfile = os.path.join(tests_root, 'test_data', 'sample1.bed')
+        y, ped = random_phenotype(os.path.join(tests_root, 'test_data', 'sample1.ped'))
+        sid = Bed(bedfile, count_A1=True).sid[0:100]
+        taus, sigma2s = [1.0, 1.0+1e-3, 2.0], [1.0, 2.0, 1.0]
+        ys = [self.transformed(y, taus[i], sigma2s[i]) for i in range(3)]
+        separate = gwas.batch_plan(ys, ped, taus, sigma2s, bedfile=bedfile)
+        self.assertEqual([x.phenotypes for x in separate.groups], [[0], [1], [2]])
+        grouped = gwas.batch_plan(ys, ped, taus, sigma2s, bedfile=bedfile, tau_rtol=0.01)
+        self.assertEqual([x.phenotypes for x in grouped.groups], [[0, 1], [2]])
+        # The second phenotype is mapped to the transform of the first
+        rows = id_index(y.ids).get_indexer(grouped.design.ids)
+        testing.assert_allclose(grouped.groups[0].Y[:,1], self.transformed(y, taus[0], sigma2s[0]).gts[rows,0], rtol=1e-5, atol=1e-5)
+        G = gwas.read_batch(sid, separate)
+        separate_results = gwas.fit_batch(copy.deepcopy(G), separate)
+        grouped_results = gwas.fit_batch(G, grouped)
+        for i in range(3):
+            testing.assert_allclose(grouped_results[i][2], separate_results[i][2], rtol=1e-2, atol=1e-3)
+            testing.assert_allclose(grouped_results[i][4], separate_results[i][4], rtol=1e-3)
+
+def write_phenotypes(pedfile, phenofile, covarfile, seed=0):
+    """Write two simulated phenotypes and two covariates of the individuals in a pedigree, with family effects, to plain text files"""
+    ped = np.loadtxt(pedfile, dtype=str)
+    ped = ped[1:ped.shape[0]]
+    rng = np.random.default_rng(seed)
+    fams, fam_index = np.unique(ped[:, 0], return_inverse=True)
+    covar = rng.normal(size=(ped.shape[0], 2))
+    y = rng.normal(size=(fams.shape[0], 2))[fam_index]+rng.normal(size=(ped.shape[0], 2))+covar.dot(np.array([[0.5, 0], [0, -0.5]]))
+    np.savetxt(phenofile, np.column_stack((ped[:, 0:2], y.astype(str))), fmt='%s')
+    np.savetxt(covarfile, np.column_stack((ped[:, 0:2], covar.astype(str))), fmt='%s')
+
+class test_null_model(SniparTest):
+
+    def setUp(self):
+        super().setUp()
+        pedfile = os.path.join(tests_root, 'test_data', 'sample1.ped')
+        self.phenofile = os.path.join(output_root, 'null_model.phen')
+        self.covarfile = os.path.join(output_root, 'null_model.covar')
+        write_phenotypes(pedfile, self.phenofile, self.covarfile)
+        sibpairs, self.ped = get_sibpairs_from_ped(np.loadtxt(pedfile, dtype=str))
+        self.prefix = os.path.join(output_root, 'null_model')
+
+    def prepare_phenotype(self, command, ped=None):
+        args = gwas_script.parser.parse_args(command)
+        return gwas_script.prepare_phenotype(args, args.phen_index, self.ped if ped is None else ped, [0])
+
+    def test_save_load(self):
+        for covar in [[], ['--covar', self.covarfile]]:
+            for phen_index in ['1', '2']:
+                command = [self.phenofile, '--phen_index', phen_index]+covar
+                saved = self.prepare_phenotype(command+['--save_null', self.prefix])
+                fitted = self.prepare_phenotype(command)
+                loaded = self.prepare_phenotype(command+['--load_null', self.prefix])
+                for y, tau, sigma2, null_alpha in [saved, loaded]:
+                    testing.assert_array_equal(y.ids, fitted[0].ids)
+                    testing.assert_array_equal(y.fams, fitted[0].fams)
+                    testing.assert_array_equal(y.gts, fitted[0].gts)
+                    self.assertEqual(tau, fitted[1])
+                    self.assertEqual(sigma2, fitted[2])
+                    if len(covar) == 0:
+                        self.assertIsNone(null_alpha)
+                    else:
+                        testing.assert_array_equal(null_alpha, fitted[3])
+
+    def test_checksum_mismatch(self):
+        command = [self.phenofile, '--covar', self.covarfile]
+        self.prepare_phenotype(command+['--save_null', self.prefix])
+        # Changed phenotype values
+        changed = os.path.join(output_root, 'null_model_changed.phen')
+        phen = np.loadtxt(self.phenofile, dtype=str)
+        phen[0, 2] = str(float(phen[0, 2])+1)
+        np.savetxt(changed, phen, fmt='%s')
+        with self.assertRaisesRegex(ValueError, 'phenotype does not match'):
+            self.prepare_phenotype([changed, '--covar', self.covarfile, '--load_null', self.prefix])
+        # Another phenotype from the same file
+        with self.assertRaisesRegex(ValueError, 'phenotype does not match'):
+            self.prepare_phenotype(command+['--phen_index', '2', '--load_null', self.prefix])
+        # Changed covariates
+        with self.assertRaisesRegex(ValueError, 'covariates does not match'):
+            self.prepare_phenotype([self.phenofile, '--load_null', self.prefix])
+        # Changed pedigree
+        ped = self.ped.copy()
+        ped[0, 0] = ped[np.flatnonzero(ped[:, 0] != ped[0, 0])[0], 0]
+        with self.assertRaisesRegex(ValueError, 'pedigree does not match'):
+            self.prepare_phenotype(command+['--load_null', self.prefix], ped=ped)
+        # Unchanged inputs load
+        self.prepare_phenotype(command+['--load_null', self.prefix])
+
+class test_shards(SniparTest):
+
+    def test_shard_bounds(self):
+        for nsnp in [0, 1, 7, 100, 1003]:
+            for n in [1, 2, 3, 7, 11]:
+                bounds = [gwas.shard_bounds(nsnp, shard=(k, n)) for k in range(1, n+1)]
+                # Contiguous shards, each starting at the end of the previous, covering every SNP once
+                self.assertEqual(bounds[0][0], 0)
+                self.assertEqual(bounds[-1][1], nsnp)
+                for k in range(1, n):
+                    self.assertEqual(bounds[k][0], bounds[k-1][1])
+                sizes = [end-start for start, end in bounds]
+                self.assertLessEqual(max(sizes)-min(sizes), 1)
+        self.assertEqual(gwas.shard_bounds(100, snp_start=20, snp_end=50), (20, 50))
+        self.assertEqual(gwas.shard_bounds(100, snp_start=90, snp_end=150), (90, 100))
+        self.assertEqual(gwas.shard_bounds(100, snp_start=150), (100, 100))
+        self.assertEqual(gwas.shard_bounds(100), (0, 100))
+        for shard in [(0, 3), (4, 3), (1, 0)]:
+            self.assertRaises(ValueError, gwas.shard_bounds, 100, shard=shard)
+        self.assertRaises(ValueError, gwas.shard_bounds, 100, snp_start=50, snp_end=20)
+        self.assertRaises(ValueError, gwas.shard_bounds, 100, snp_start=-1)
+
+    def run_gwas(self, out, command=[]):
+        phenofile = os.path.join(output_root, 'shards.phen')
+        write_phenotypes(os.path.join(tests_root, 'test_data', 'sample1.ped'), phenofile, os.path.join(output_root, 'shards.covar'))
+        args = gwas_script.parser.parse_args([phenofile, '--bed', os.path.join(tests_root, 'test_data', 'sample1'),
+                                              '--pedigree', os.path.join(tests_root, 'test_data', 'sample1.ped'),
+                                              '--out', out, '--batch_size', '150']+command)
+        gwas_script.main(args)
+
+    def test_merge_shards(self):
+        out = os.path.join(output_root, 'shards_')
+        for filename in glob.glob(out+'*'):
+            os.remove(filename)
+        self.run_gwas(out)
+        unsharded = {}
+        with h5py.File(out+'.sumstats.hdf5', 'r') as f:
+            for key in f:
+                unsharded[key] = np.array(f[key])
+        with gzip.open(out+'.sumstats.gz', 'rt') as f:
+            unsharded_txt = f.read()
+        for filename in [out+'.sumstats.hdf5', out+'.sumstats.gz']:
+            os.remove(filename)
+        # Shards of uneven size (1000 SNPs in 3 shards), with one missing
+        self.run_gwas(out, ['--shard', '1/3'])
+        self.run_gwas(out, ['--shard', '3/3'])
+        self.assertRaisesRegex(ValueError, 'Gap', gwas.merge_shards, out, 0)
+        self.run_gwas(out, ['--shard', '2/3'])
+        # Overlapping shard
+        self.run_gwas(out, ['--snp_start', '300', '--snp_end', '400'])
+        self.assertRaisesRegex(ValueError, 'Overlapping', gwas.merge_shards, out, 0)
+        os.remove(out+'.snps300-400.sumstats.hdf5')
+        os.remove(out+'.snps300-400.sumstats.gz')
+        gwas.merge_shards(out, 0, remove=True)
+        self.assertEqual(len(gwas.find_shards(out, 0)), 0)
+        with h5py.File(out+'.sumstats.hdf5', 'r') as f:
+            for key in ['bim', 'estimate', 'estimate_ses', 'estimate_covariance', 'freqs', 'estimate_cols', 'sigma2', 'tau']:
+                testing.assert_array_equal(np.array(f[key]), unsharded[key])
+        with gzip.open(out+'.sumstats.gz', 'rt') as f:
+            self.assertEqual(f.read(), unsharded_txt)
+
+if __name__ == '__main__':
+    unittest.main()
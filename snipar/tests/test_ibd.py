@@ -0,0 +1,217 @@
+import unittest
+import time
+import gzip
+import numpy as np
+from numpy import testing
+from numba import njit, prange
+from snipar import ibd
+from snipar.tests.utils import *
+
+def random_pairs(npair, nsnp, seed=0):
+    """Simulate genotypes of sibling pairs, with missing values, and SNP parameters"""
+    rng = np.random.default_rng(seed)
+    freqs = rng.uniform(0.05, 0.5, nsnp)
+    gts = rng.binomial(2, freqs, (2*npair, nsnp)).astype(np.float64)
+    # Make some pairs share genotypes over a stretch of SNPs
+    for i in range(0, npair, 2):
+        start = rng.integers(0, nsnp//2)
+        gts[2*i+1, start:(start+nsnp//3)] = gts[2*i, start:(start+nsnp//3)]
+    gts[rng.uniform(size=gts.shape) < 0.01] = np.nan
+    sibpairs = np.arange(2*npair).reshape((npair, 2))
+    map = np.cumsum(rng.uniform(0, 0.01, nsnp))
+    weights = rng.uniform(0.2, 1, nsnp)
+    error_probs = rng.uniform(0.0001, 0.01, nsnp)
+    return sibpairs, gts, freqs, map, weights, error_probs
+
+@njit(parallel=True)
+def infer_ibd_pairwise(sibpairs, gts, emissions, transitions):
+    """Viterbi paths of sibling pairs computed one pair at a time by make_dynamic and viterbi"""
+    ibd_out = np.zeros((sibpairs.shape[0], gts.shape[1]), dtype=np.int8)
+    for i in prange(sibpairs.shape[0]):
+        state_matrix, pointers = ibd.make_dynamic(gts[sibpairs[i, 0], :], gts[sibpairs[i, 1], :], emissions, transitions)
+        ibd_out[i, :] = ibd.viterbi(state_matrix, pointers)
+    return ibd_out
+
+def smooth_segments_python(path, map, snps, pos, min_length):
+    """Smoothing of a path by the loop over segment objects that ibd.smooth_segments used before it was compiled"""
+    segments = ibd.find_segments(path, map, snps, pos)
+    if len(segments) > 1:
+        for i in range(len(segments)):
+            if segments[i].length < min_length:
+                if i == 0:
+                    state = segments[i+1].state
+                elif i < (len(segments)-1):
+                    if segments[i-1].state != segments[i+1].state:
+                        continue
+                    state = segments[i+1].state
+                else:
+                    state = segments[i-1].state
+                if segments[i].start == segments[i].end:
+                    path[segments[i].start] = state
+                else:
+                    path[segments[i].start:segments[i].end] = state
+        segments = ibd.find_segments(path, map, snps, pos)
+    return path, segments
+
+class test_ibd_hmm(SniparTest):
+
+    def test_emission_table(self):
+        sibpairs, gts, freqs, map, weights, error_probs = random_pairs(1, 50)
+        emissions = ibd.emission_table(freqs, weights, error_probs)
+        for l in range(freqs.shape[0]):
+            for g1 in range(3):
+                for g2 in range(3):
+                    testing.assert_allclose(emissions[l, g1, g2, :],
+                                            weights[l]*ibd.p_obs_given_IBD(np.int8(g1), np.int8(g2), freqs[l], error_probs[l]))
+
+    def test_transition_table(self):
+        sibpairs, gts, freqs, map, weights, error_probs = random_pairs(1, 50)
+        transitions = ibd.transition_table(map)
+        with np.errstate(divide='ignore'):
+            testing.assert_array_equal(transitions[0], np.log(np.identity(3)))
+        for l in range(1, map.shape[0]):
+            testing.assert_allclose(transitions[l], ibd.transition_matrix(map[l]-map[l-1]))
+
+    def test_viterbi_block(self):
+        sibpairs, gts, freqs, map, weights, error_probs = random_pairs(150, 500)
+        emissions = ibd.emission_table(freqs, weights, error_probs)
+        transitions = ibd.transition_table(map)
+        expected = infer_ibd_pairwise(sibpairs, gts, emissions, transitions)
+        # Blocks that do and do not divide the number of pairs
+        for block_size in [1, 7, 64, 1000]:
+            testing.assert_array_equal(ibd.infer_ibd(sibpairs, gts, emissions, transitions, block_size=block_size), expected)
+
+    def test_viterbi_block_benchmark(self):
+        sibpairs, gts, freqs, map, weights, error_probs = random_pairs(1000, 10000)
+        emissions = ibd.emission_table(freqs, weights, error_probs)
+        transitions = ibd.transition_table(map)
+        # Compile
+        infer_ibd_pairwise(sibpairs[0:2], gts, emissions, transitions)
+        ibd.infer_ibd(sibpairs[0:2], gts, emissions, transitions)
+        start = time.time()
+        expected = infer_ibd_pairwise(sibpairs, gts, emissions, transitions)
+        pairwise_time = time.time()-start
+        start = time.time()
+        ibd_out = ibd.infer_ibd(sibpairs, gts, emissions, transitions)
+        block_time = time.time()-start
+        if self.log:
+            print('Viterbi for '+str(sibpairs.shape[0])+' pairs x '+str(gts.shape[1])+' SNPs: '+str(round(pairwise_time, 3))+
+                  's one pair at a time, '+str(round(block_time, 3))+'s in blocks of pairs')
+        testing.assert_array_equal(ibd_out, expected)
+
+class test_ibd_segments(SniparTest):
+
+    def test_smooth_segments(self):
+        rng = np.random.default_rng(1)
+        nsnp = 300
+        map = np.cumsum(rng.uniform(0, 0.002, nsnp))
+        pos = np.arange(nsnp)*100+1000
+        snps = np.array(['rs'+str(x) for x in range(nsnp)])
+        # Paths with runs of random lengths, many shorter than min_length
+        ibd_paths = np.zeros((50, nsnp), dtype=np.int8)
+        for i in range(ibd_paths.shape[0]):
+            run_ends = np.sort(rng.choice(np.arange(1, nsnp), rng.integers(0, 40), replace=False))
+            for run in np.split(np.arange(nsnp), run_ends):
+                ibd_paths[i, run] = rng.integers(0, 3)
+        min_length = 0.02
+        expected_paths = ibd_paths.copy()
+        expected_segs = [smooth_segments_python(expected_paths[i], map, snps, pos, min_length)[1] for i in range(ibd_paths.shape[0])]
+        ibd_out = ibd_paths.copy()
+        segs = ibd.find_ibd_segments(ibd_out, map, pos, min_length=min_length)
+        testing.assert_array_equal(ibd_out, expected_paths)
+        expected = [(i, seg.start, seg.start_snp, seg.end_snp, seg.state, seg.start_bp, seg.end_bp, seg.length)
+                    for i in range(len(expected_segs)) for seg in expected_segs[i]]
+        self.assertEqual(segs.shape[0], len(expected))
+        for seg, x in zip(segs, expected):
+            self.assertEqual((seg['pair'], seg['start'], snps[seg['start']], snps[seg['end']], seg['state'], seg['start_bp'], seg['end_bp']), x[0:7])
+            self.assertEqual(seg['length'], x[7])
+        # Segment objects of each pair, as returned by the per-pair implementation
+        ibd_out, allsegs = ibd.smooth_ibd(ibd_paths.copy(), map, snps, pos, min_length)
+        testing.assert_array_equal(ibd_out, expected_paths)
+        self.assertEqual(len(allsegs), len(expected_segs))
+        for pair_segs, pair_expected in zip(allsegs, expected_segs):
+            self.assertEqual([vars(x) for x in pair_segs], [vars(x) for x in pair_expected])
+        # Written as by segment_writer
+        outfiles = [os.path.join(output_root, 'smooth_ibd_'+x+'.segments.gz') for x in ['lists', 'writer']]
+        sibpairs = np.array([['sib'+str(2*i), 'sib'+str(2*i+1)] for i in range(ibd_paths.shape[0])])
+        ibd.write_segs(sibpairs, allsegs, 1, outfiles[0])
+        writer = ibd.segment_writer(outfiles[1], 1, snps)
+        writer.write(sibpairs, segs)
+        writer.close()
+        with gzip.open(outfiles[0], 'rt') as f1, gzip.open(outfiles[1], 'rt') as f2:
+            self.assertEqual(f1.read(), f2.read())
+        matrix_segs = ibd.write_segs_from_matrix(ibd_out, sibpairs, snps, pos, map, 1, outfiles[1])
+        for pair_segs, pair_expected in zip(matrix_segs, expected_segs):
+            self.assertEqual([vars(x) for x in pair_segs], [vars(x) for x in pair_expected])
+        with gzip.open(outfiles[0], 'rt') as f1, gzip.open(outfiles[1], 'rt') as f2:
+            self.assertEqual(f1.read(), f2.read())
+        # Single pair
+        path = ibd_paths[0].copy()
+        path[10:12] = (path[10]+1) % 3
+        testing.assert_array_equal(ibd.smooth_segments(path.copy(), map, snps, pos, min_length)[0],
+                                   smooth_segments_python(path.copy(), map, snps, pos, min_length)[0])
+
+    def test_infer_ibd_segments(self):
+        sibpairs, gts, freqs, map, weights, error_probs = random_pairs(150, 500)
+        pos = np.arange(map.shape[0])*100+1000
+        emissions = ibd.emission_table(freqs, weights, error_probs)
+        transitions = ibd.transition_table(map)
+        for min_length in [None, 0.02]:
+            expected = ibd.find_ibd_segments(ibd.infer_ibd(sibpairs, gts, emissions, transitions), map, pos, min_length=min_length)
+            for block_size in [1, 7, 64, 1000]:
+                segs = ibd.infer_ibd_segments(sibpairs, gts, emissions, transitions, map, pos, min_length=min_length, block_size=block_size)
+                testing.assert_array_equal(segs, expected)
+
+    def test_segment_writer(self):
+        snps = np.array(['rs1', 'rs2', 'rs3', 'rs4'])
+        sibpairs = np.array([['a', 'b'], ['c', 'd']])
+        segs = np.zeros(3, dtype=ibd.segment_dtype)
+        segs['pair'] = [0, 0, 1]
+        segs['start'] = [0, 2, 0]
+        segs['end'] = [1, 3, 3]
+        segs['state'] = [2, 1, 0]
+        segs['start_bp'] = [100, 300, 100]
+        segs['end_bp'] = [200, 400, 400]
+        segs['length'] = [0.5, 0.25, 1.5]
+        outfile = os.path.join(output_root, 'segment_writer.segments.gz')
+        writer = ibd.segment_writer(outfile, 1, snps)
+        # Batches written one at a time, including an empty batch
+        writer.write(sibpairs[0:1], segs[0:2])
+        writer.write(sibpairs[0:0], segs[0:0])
+        writer.write(sibpairs[1:2], np.array([(0, 0, 3, 0, 100, 400, 1.5)], dtype=ibd.segment_dtype))
+        writer.close()
+        with gzip.open(outfile, 'rt') as f:
+            lines = f.read()
+        expected = [seg.to_text(sibpairs[pair, 0], sibpairs[pair, 1], 1, end=(pair == 1))
+                    for pair, seg in [(0, ibd.segment(0, 1, 100, 200, 'rs1', 'rs2', 0.5, 2)),
+                                      (0, ibd.segment(2, 3, 300, 400, 'rs3', 'rs4', 0.25, 1)),
+                                      (1, ibd.segment(0, 3, 100, 400, 'rs1', 'rs4', 1.5, 0))]]
+        self.assertEqual(lines, 'ID1\tID2\tIBDType\tChr\tstart_coordinate\tstop_coordinate\tstartSNP\tstopSNP\tlength\n'+''.join(expected))
+
+    def test_write_ibd_batches(self):
+        sibpair_indices, gts, freqs, map, weights, error_probs = random_pairs(150, 500)
+        sibpairs = np.array([['sib'+str(x) for x in pair] for pair in sibpair_indices])
+        pos = np.arange(map.shape[0])*100+1000
+        snps = np.array(['rs'+str(x) for x in range(map.shape[0])])
+        emissions = ibd.emission_table(freqs, weights, error_probs)
+        transitions = ibd.transition_table(map)
+        outputs = {}
+        for pair_batch_size in [1, 150, 1000]:
+            for ibdmatrix in [False, True]:
+                outfile = os.path.join(output_root, 'ibd_batches.segments.gz')
+                matrix_outfile = os.path.join(output_root, 'ibd_batches.ibdmatrix.gz') if ibdmatrix else None
+                ibd.write_ibd_batches(sibpairs, sibpair_indices, gts, emissions, transitions, map, pos, snps, 1, 0.02, outfile,
+                                      matrix_outfile=matrix_outfile, pair_batch_size=pair_batch_size)
+                with gzip.open(outfile, 'rt') as f:
+                    outputs[(pair_batch_size, ibdmatrix)] = f.read()
+                if ibdmatrix:
+                    with gzip.open(matrix_outfile, 'rt') as f:
+                        outputs[(pair_batch_size, 'matrix')] = f.read()
+        for key in outputs:
+            if key[1] == 'matrix':
+                self.assertEqual(outputs[key], outputs[(1, 'matrix')])
+            else:
+                self.assertEqual(outputs[key], outputs[(1, False)])
+
+if __name__ == '__main__':
+    unittest.main()
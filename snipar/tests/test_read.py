@@ -0,0 +1,228 @@
+import unittest
+import time
+import gc
+import h5py
+import numpy as np
+from numpy import testing
+from pysnptools.snpreader import Bed, SnpData
+from bgen_reader import open_bgen
+from snipar.read.bed import bed_reader
+from snipar.read.bgen import read_bgen_dosages
+from snipar.read import variants
+from snipar.read.variants import read_bim, read_bgen_variants
+from snipar.read.imputed import imputed_reader, rechunk
+from snipar.read.store import build_store
+from snipar.read import get_gts_matrix
+from snipar.preprocess import get_fam_means
+from snipar.pedigree import find_individuals_with_sibs
+from snipar.utilities import make_id_dict
+from snipar.tests.utils import *
+
+class test_bed_reader(SniparTest):
+
+    def test_matches_pysnptools(self):
+        bedfile = os.path.join(tests_root, 'test_data', 'sample1.bed')
+        bed = Bed(bedfile, count_A1=True)
+        native = bed_reader(bedfile)
+        testing.assert_array_equal(native.iid, bed.iid)
+        testing.assert_array_equal(native.sid, bed.sid)
+        testing.assert_array_equal(native.pos, bed.pos)
+        for i in range(0, 10):
+            rows = np.sort(np.random.choice(bed.iid_count, 100, replace=False))
+            cols = np.sort(np.random.choice(bed.sid_count, 50, replace=False))
+            testing.assert_array_equal(native.read(rows, cols, dtype=np.float64), bed[rows, cols].read().val)
+        start = np.random.randint(0, bed.sid_count - 20)
+        testing.assert_array_equal(native.read(cols=slice(start, start + 20)), bed[:, start:(start + 20)].read().val)
+
+    def test_missing(self):
+        # Odd number of individuals so that the last byte of each SNP is padded
+        n, l = 101, 30
+        gts = np.random.randint(0, 3, (n, l)).astype(float)
+        gts[np.random.rand(n, l) < 0.1] = np.nan
+        iid = np.array([[str(i), str(i)] for i in range(n)])
+        sid = np.array(['rs'+str(j) for j in range(l)])
+        pos = np.column_stack((np.ones(l), np.zeros(l), np.arange(1, l + 1)))
+        bedfile = os.path.join(output_root, 'bed_reader_missing.bed')
+        Bed.write(bedfile, SnpData(iid=iid, sid=sid, val=gts, pos=pos), count_A1=True)
+        native = bed_reader(bedfile)
+        rows = np.sort(np.random.choice(n, 40, replace=False))
+        testing.assert_array_equal(native.read(rows), gts[rows, :])
+        int_gts = native.read(rows, dtype=np.int8)
+        testing.assert_array_equal(int_gts == -1, np.isnan(gts[rows, :]))
+        testing.assert_array_equal(int_gts[int_gts >= 0], gts[rows, :][int_gts >= 0])
+
+class test_bgen_dosages(SniparTest):
+
+    def test_chunks(self):
+        bgen = open_bgen(os.path.join(tests_root, 'test_data', 'sample_reduced1.bgen'), verbose=False)
+        rows = np.sort(np.random.choice(bgen.nsamples, 100, replace=False))
+        cols = np.sort(np.random.choice(bgen.nvariants, 50, replace=False))
+        probs = bgen.read((rows, cols), np.float32)
+        dosages = probs[:, :, 0] + probs[:, :, 2]
+        for chunk_size in [None, 1, 7, 50]:
+            testing.assert_array_equal(read_bgen_dosages(bgen, rows, cols, chunk_size=chunk_size), dosages)
+
+class test_variant_cache(SniparTest):
+
+    def test_read_bim(self):
+        bimfile = os.path.join(output_root, 'variant_cache.bim')
+        with open(bimfile, 'w') as f:
+            f.write('1 rs1 0 100 A G\n1 rs2 0 200 C T\n')
+        variants = read_bim(bimfile)
+        testing.assert_array_equal(variants.sid, np.array(['rs1', 'rs2']))
+        testing.assert_array_equal(variants.pos, np.array([100, 200]))
+        testing.assert_array_equal(variants.alleles, np.array([['A', 'G'], ['C', 'T']]))
+        self.assertEqual(variants.index['rs2'], 1)
+        self.assertIs(read_bim(bimfile), variants)
+        # A changed file is parsed again
+        with open(bimfile, 'w') as f:
+            f.write('1 rs1 0 100 A G\n1 rs2 0 200 C T\n2 rs3 0 300 G T\n')
+        variants = read_bim(bimfile)
+        testing.assert_array_equal(variants.sid, np.array(['rs1', 'rs2', 'rs3']))
+        testing.assert_array_equal(variants.chrom, np.array(['1', '1', '2']))
+
+    def test_read_bgen_variants(self):
+        bgenfile = os.path.join(tests_root, 'test_data', 'sample_reduced1.bgen')
+        bgen = open_bgen(bgenfile, verbose=False)
+        variants = read_bgen_variants(bgenfile, bgen)
+        testing.assert_array_equal(variants.pos, np.array(bgen.positions))
+        # Cached under the file name, whether or not the file is open
+        self.assertIs(read_bgen_variants(bgenfile), variants)
+        self.assertIs(read_bgen_variants(bgenfile, open_bgen(bgenfile, verbose=False)), variants)
+
+    def test_evicted_matches(self):
+        bimfiles = [os.path.join(output_root, 'variant_cache_'+str(i)+'.bim') for i in range(variants.variant_cache_size+2)]
+        for i, bimfile in enumerate(bimfiles):
+            with open(bimfile, 'w') as f:
+                f.write('1 rs1 0 100 A G\n1 rs'+str(i+2)+' 0 200 C T\n')
+        first = read_bim(bimfiles[0])
+        other = read_bim(bimfiles[1])
+        testing.assert_array_equal(first.match(other), np.array([0, -1]))
+        self.assertEqual(len(first._matches), 1)
+        # Evict the tables from the cache, so that only the match would keep the other table
+        for bimfile in bimfiles[2:]:
+            read_bim(bimfile)
+        del other
+        gc.collect()
+        self.assertEqual(len(first._matches), 0)
+
+class test_imputed_reader(SniparTest):
+
+    def test_matches_h5py(self):
+        n, l = 2000, 1500
+        gts = (np.random.randint(0, 5, (n, l))/2).astype(np.float16)
+        hdf5file = os.path.join(output_root, 'imputed_reader.hdf5')
+        with h5py.File(hdf5file, 'w') as f:
+            f.create_dataset('imputed_par_gts', data=gts, chunks=(125, 125), compression='gzip', shuffle=True)
+            f.create_dataset('uncompressed', data=gts, chunks=(125, 125))
+            f.create_dataset('lzf', data=gts, chunks=(125, 125), compression='lzf')
+            f.create_dataset('contiguous', data=gts)
+        with h5py.File(hdf5file, 'r') as f:
+            for dataset in ['imputed_par_gts', 'uncompressed', 'lzf', 'contiguous']:
+                reader = imputed_reader(f, dataset=dataset)
+                for i in range(0, 5):
+                    rows = np.sort(np.random.choice(n, 300, replace=False))
+                    cols = np.arange(l)[np.random.randint(0, l-200):][0:200]
+                    testing.assert_array_equal(reader.read(rows, cols), gts[np.ix_(rows, cols)])
+            # Time against reading all rows of the SNPs with h5py then subsetting families
+            rows = np.sort(np.random.choice(n, 300, replace=False))
+            cols = np.arange(500, 1000)
+            start = time.time()
+            h5py_gts = np.array(f['imputed_par_gts'][:, cols])[rows, :]
+            h5py_time = time.time()-start
+            start = time.time()
+            reader_gts = imputed_reader(f, cache_bytes=0).read(rows, cols)
+            reader_time = time.time()-start
+            testing.assert_array_equal(reader_gts, h5py_gts)
+            if self.log:
+                print('h5py: '+str(round(h5py_time, 4))+'s; imputed_reader: '+str(round(reader_time, 4))+'s')
+
+    def test_rechunk(self):
+        n, l = 300, 1000
+        gts = (np.random.randint(0, 5, (n, l))/2).astype(np.float16)
+        infile = os.path.join(output_root, 'rechunk_in.hdf5')
+        outfile = os.path.join(output_root, 'rechunk_out.hdf5')
+        with h5py.File(infile, 'w') as f:
+            f.create_dataset('imputed_par_gts', data=gts, chunks=True)
+            f['families'] = np.arange(n).astype('S')
+        chunks = rechunk(infile, outfile, compression='gzip', chunk_bytes=2**14)
+        # All families in a chunk, with as many SNPs as fit in chunk_bytes
+        self.assertEqual(chunks, (n, 27))
+        with h5py.File(outfile, 'r') as f:
+            self.assertEqual(f['imputed_par_gts'].chunks, chunks)
+            self.assertTrue(f['imputed_par_gts'].shuffle)
+            testing.assert_array_equal(np.array(f['families']), np.arange(n).astype('S'))
+            testing.assert_array_equal(np.array(f['imputed_par_gts']), gts)
+            rows = np.sort(np.random.choice(n, 100, replace=False))
+            testing.assert_array_equal(imputed_reader(f).read(rows, np.arange(100, 200)), gts[rows, 100:200])
+
+class test_family_store(SniparTest):
+
+    def test_matches_get_gts_matrix(self):
+        bedfile = os.path.join(tests_root, 'test_data', 'sample1.bed')
+        ped = np.loadtxt(os.path.join(tests_root, 'test_data', 'sample1.ped'), dtype=str)[1:, :]
+        storefile = os.path.join(output_root, 'family_store.hdf5')
+        for sib in [False, True]:
+            nsnp = build_store(storefile, ped=ped, bedfile=bedfile, sib=sib, batch_size=300, compression='gzip')
+            self.assertEqual(nsnp, 1000)
+            snp_ids = Bed(bedfile, count_A1=True).sid[np.random.choice(nsnp, 100, replace=False)]
+            for parsum in [False, True]:
+                G = get_gts_matrix(ped=ped, bedfile=bedfile, snp_ids=snp_ids, sib=sib, parsum=parsum)
+                G_store = get_gts_matrix(storefile=storefile, snp_ids=snp_ids, sib=sib, parsum=parsum)
+                testing.assert_array_equal(G_store.ids, G.ids)
+                testing.assert_array_equal(G_store.fams, G.fams)
+                testing.assert_array_equal(G_store.par_status, G.par_status)
+                snp_order = G_store.sid_dict.get_indexer(G.sid)
+                testing.assert_array_equal(G_store.alleles[snp_order], G.alleles)
+                testing.assert_array_equal(G_store.gts[:, :, snp_order], G.gts)
+            # Subset of individuals
+            ids = np.random.choice(G.ids, 500, replace=False)
+            G_store = get_gts_matrix(storefile=storefile, snp_ids=snp_ids, ids=ids, sib=sib, parsum=True)
+            G.filter_ids(G_store.ids)
+            testing.assert_array_equal(G_store.gts[:, :, G_store.sid_dict.get_indexer(G.sid)], G.gts)
+            self.assertRaises(ValueError, get_gts_matrix, storefile=storefile, sib=not sib)
+
+def get_fam_means_loop(ids, ped, gts, gts_ids, remove_proband=True):
+    """Mean genotypes of siblings by the dictionary lookups get_fam_means used before it was vectorised"""
+    ids, ids_fams, gts_fams = find_individuals_with_sibs(ids, ped, gts_ids)
+    fams = np.unique(ids_fams)
+    fams_dict = make_id_dict(fams)
+    fam_sums = np.zeros((fams.shape[0], gts.shape[1]), dtype=gts.dtype)
+    fam_counts = np.zeros((fams.shape[0]), dtype=int)
+    for i in range(0, fams.shape[0]):
+        fam_indices = np.where(gts_fams == fams[i])[0]
+        fam_sums[i, :] = np.sum(gts[fam_indices, :], axis=0)
+        fam_counts[i] = fam_indices.shape[0]
+    gts_id_dict = make_id_dict(gts_ids)
+    G_sib = np.zeros((ids.shape[0], gts.shape[1]), dtype=np.float32)
+    for i in range(0, ids.shape[0]):
+        fam_index = fams_dict[ids_fams[i]]
+        G_sib[i, :] = fam_sums[fam_index, :]
+        n_i = fam_counts[fam_index]
+        if remove_proband:
+            G_sib[i, :] = G_sib[i, :] - gts[gts_id_dict[ids[i]], :]
+            n_i = n_i-1
+        G_sib[i, :] = G_sib[i, :]/float(n_i)
+    return ids, G_sib, fam_counts
+
+class test_fam_means(SniparTest):
+
+    def test_matches_loop(self):
+        rng = np.random.default_rng(0)
+        # Families of unequal sizes, including singletons, listed out of order
+        fam_sizes = [1, 2, 5, 3, 1, 4, 2, 6]
+        ped = np.array([['fam'+str(i), 'fam'+str(i)+'_'+str(j), 'father'+str(i), 'mother'+str(i)]
+                        for i in range(len(fam_sizes)) for j in range(fam_sizes[i])])
+        ped = ped[rng.permutation(ped.shape[0]), :]
+        gts_ids = ped[rng.permutation(ped.shape[0]), 1]
+        gts = rng.binomial(2, 0.3, (gts_ids.shape[0], 20)).astype(np.float32)
+        ids = rng.choice(ped[:, 1], 20, replace=False)
+        for remove_proband in [True, False]:
+            expected_ids, expected, expected_counts = get_fam_means_loop(ids, ped, gts, gts_ids, remove_proband=remove_proband)
+            G_sib, fam_counts, fam_sums = get_fam_means(ids, ped, gts, gts_ids, remove_proband=remove_proband, return_famsizes=True)
+            testing.assert_array_equal(G_sib.ids, expected_ids)
+            testing.assert_array_equal(G_sib.gts, expected)
+            testing.assert_array_equal(fam_counts, expected_counts)
+
+if  __name__=='__main__':
+    unittest.main()
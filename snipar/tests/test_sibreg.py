@@ -2,6 +2,8 @@ import unittest
 import numpy as np
 from numpy import testing
 from snipar import lmm
+from snipar.gtarray import gtarray
+from snipar.utilities import id_index, make_id_dict
 from snipar.tests.utils import *
 
 def random_design(labels):
@@ -30,6 +32,19 @@ def safe_likelihood(y,X,Sigma):
     L = slogdet+np.dot(resid.T.dot(Sigma_inv),resid)
     return L
 
+def safe_gradient(y,X,labels,sigma2,tau):
+    # Gradient of the likelihood at the MLE of alpha with respect to sigma2 and tau, from the dense covariance matrix
+    Z = random_design(labels)
+    ZZ = Z.dot(Z.T)
+    Sigma = Sigma_make(labels,sigma2,tau)
+    Sigma_inv = np.linalg.inv(Sigma)
+    alpha = safe_alpha_mle(y,X,Sigma).reshape((X.shape[1],))
+    resid_Sigma_inv = Sigma_inv.dot(y-X.dot(alpha))
+    grad = np.zeros((2))
+    for i, dSigma in enumerate([ZZ/tau+np.identity(y.shape[0]), -sigma2*ZZ/tau**2]):
+        grad[i] = np.sum(Sigma_inv*dSigma)-resid_Sigma_inv.dot(dSigma.dot(resid_Sigma_inv))
+    return grad
+
 def safe_alpha_mle(y,X,Sigma):
     Sigma_inv = np.linalg.inv(Sigma)
     X_T_Sigma_inv = np.dot(X.T,Sigma_inv)
@@ -69,6 +84,19 @@ class test_regrnd_functions(SniparTest):
             lik, grad = m.likelihood_and_gradient(sigma2,tau)
             testing.assert_almost_equal(lik,safe_lik/float(n),decimal=5)
 
+    def test_likelihood_dense(self):
+        # Families of unequal sizes, not contiguous
+        fam_sizes = np.array([1, 2, 2, 3, 5, 1, 8, 4, 3, 1, 6])
+        labels = np.random.permutation(np.repeat(np.arange(fam_sizes.shape[0]), fam_sizes))
+        n = labels.shape[0]
+        X = np.column_stack((np.ones(n), np.random.randn(n, 2)))
+        y = X.dot(np.random.randn(3))+np.random.randn(fam_sizes.shape[0])[labels]+np.random.randn(n)
+        m = lmm.model(y, X, labels)
+        for sigma2, tau in [(1.0, 1.0), (0.5, 3.0), (2.0, 0.2), (10.0, 50.0)]:
+            lik, grad = m.likelihood_and_gradient(sigma2, tau)
+            testing.assert_almost_equal(lik, safe_likelihood(y, X, Sigma_make(labels, sigma2, tau))/float(n), decimal=8)
+            testing.assert_almost_equal(grad, safe_gradient(y, X, labels, sigma2, tau)/float(n), decimal=8)
+
     def test_grad_sigma2(self):
         n = 10 ** 3
         c = 2
@@ -107,6 +135,59 @@ class test_regrnd_functions(SniparTest):
             num_grad = (likelihood(tau + 10**(-6)) - likelihood(tau - 10**(-6))) / (2 * 10 ** (-6))
             testing.assert_almost_equal(grad[1], num_grad, decimal=5)
 
+    def test_diagonalise(self):
+        sigma2 = float(1)
+        sigmau = float(5.5)
+        tau = sigma2 / sigmau
+        n = 10 ** 2
+        for i in range(0, 10):
+            m = lmm.simulate(n, np.random.randn((2)), sigma2, tau)
+            # Shuffle individuals so that families are not contiguous
+            labels = np.random.permutation(m.labels)
+            Sigma = Sigma_make(labels, sigma2, tau)
+            vals, vectors = np.linalg.eigh(Sigma)
+            safe_inv_root = (vectors / np.sqrt(vals)).dot(vectors.T)
+            inv_root = lmm.model(m.y, m.X, labels).sigma_inv_root(tau, sigma2)
+            gts = np.random.randn(n, 3, 5)
+            G = gtarray(gts.copy(), np.arange(n).astype(str), fams=labels)
+            G.diagonalise(inv_root)
+            gts = gts - np.mean(gts, axis=0)
+            for j in range(gts.shape[1]):
+                testing.assert_almost_equal(np.array(G.gts[:, j, :]), safe_inv_root.dot(gts[:, j, :]), decimal=5)
+
+    def test_missing(self):
+        n = 10 ** 2
+        for i in range(0, 10):
+            gts = np.random.randint(0, 3, (n, 3, 20)).astype(np.float32)
+            gts[np.random.rand(n, 3, 20) < 0.05] = np.nan
+            masked = np.ma.masked_invalid(gts)
+            G = gtarray(gts.copy(), np.arange(n).astype(str), sid=np.arange(20).astype(str))
+            self.assertTrue(G.has_NAs)
+            G.compute_freqs()
+            testing.assert_almost_equal(G.freqs, np.ma.mean(masked[:, 0, :], axis=0)/2.0, decimal=5)
+            mask = G.mask
+            testing.assert_array_equal(mask, np.isnan(gts))
+            NAs = G.fill_NAs()
+            testing.assert_array_equal(NAs, np.sum(mask, axis=0))
+            testing.assert_array_equal(G.mask, mask)
+            testing.assert_almost_equal(G.gts, np.ma.filled(masked-np.ma.mean(masked, axis=0), 0), decimal=5)
+            self.assertFalse(G.has_NAs)
+            # Missingness mask follows filtering of individuals and SNPs
+            keep = np.arange(n)[::3]
+            G.filter_ids(keep.astype(str))
+            G.filter(np.arange(20) % 2 == 0)
+            testing.assert_array_equal(G.mask, mask[keep][:, :, ::2])
+
+    def test_id_index(self):
+        ids = np.random.randint(0, 50, 100).astype(str)
+        keys = np.random.randint(0, 100, 200).astype(str)
+        id_dict = make_id_dict(ids)
+        index = id_index(ids)
+        testing.assert_array_equal(index.get_indexer(keys), np.array([id_dict[x] if x in id_dict else -1 for x in keys]))
+        testing.assert_array_equal(index.contains(keys), np.array([x in id_dict for x in keys]))
+        for x in id_dict:
+            self.assertEqual(index[x], id_dict[x])
+
 
 if  __name__=='__main__':
     unittest.main()
\ No newline at end of file
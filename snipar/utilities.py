@@ -1,7 +1,10 @@
 import numpy as np
+import pandas as pd
 from os import path
+from multiprocessing import shared_memory
 import argparse
 import re
+import hashlib
 def make_id_dict(x,col=0):
     """
     Make a dictionary that maps from the values in the given column (col) to their row-index in the input array
@@ -13,6 +16,68 @@ def make_id_dict(x,col=0):
         id_dict[x[i]] = i
     return id_dict
 
+class id_index(object):
+    """Map from the values in the given column (col) of an array to their row-index in the array, like make_id_dict, but with bulk lookups
+    on a hash table (pandas.Index) rather than lookups of one value at a time. As in make_id_dict, a value that is repeated maps to its last row.
+    Single values can also be looked up as in a dictionary: x in index, index[x].
+
+    Args:
+        x : :class:`~numpy:numpy.array`
+            vector of values, or array with the values in column col
+
+    Returns:
+        index : :class:`snipar.utilities.id_index`
+
+    """
+    def __init__(self, x, col=0):
+        x = np.asarray(x)
+        if x.ndim > 1:
+            x = x[:, col]
+        index = pd.Index(x)
+        if index.is_unique:
+            self.index = index
+            self.rows = None
+        else:
+            unique = np.logical_not(index.duplicated(keep='last'))
+            self.index = index[unique]
+            self.rows = np.flatnonzero(unique)
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, key):
+        i = self.index.get_loc(key)
+        if self.rows is not None:
+            i = self.rows[i]
+        return int(i)
+
+    def keys(self):
+        return np.array(self.index)
+
+    def get_indexer(self, keys):
+        """
+        Row-index of each of keys, with -1 for keys that are not in the index
+        """
+        keys = np.asarray(keys)
+        if keys.shape[0] == 0:
+            return np.zeros(0, dtype=int)
+        indices = self.index.get_indexer(keys)
+        if self.rows is not None:
+            indices = np.where(indices >= 0, self.rows[indices], -1)
+        return indices
+
+    def contains(self, keys):
+        """
+        Boolean vector recording whether each of keys is in the index
+        """
+        return self.get_indexer(keys) >= 0
+
 def convert_str_array(x):
     """
     Convert an ascii array to unicode array (UTF-8)
@@ -33,6 +98,47 @@ def encode_str_array(x):
     x_out = np.array([y.encode('ascii') for y in x])
     return x_out.reshape(x_shape)
 
+def file_checksum(filename, block_size=2**20):
+    """
+    SHA-256 checksum of the contents of a file, read block_size bytes at a time
+    """
+    checksum = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+def array_checksum(x):
+    """
+    SHA-256 checksum of the shape and contents of an array
+    """
+    x = np.ascontiguousarray(x)
+    checksum = hashlib.sha256(str(x.shape).encode())
+    checksum.update(x.tobytes())
+    return checksum.hexdigest()
+
+def share_array(x):
+    """
+    Copy an array into a new block of shared memory. Returns the shared memory block, which must be kept open while the array is in use
+    and unlinked when no longer needed, and a description of the array that can be passed to other processes and given to attach_array
+    """
+    x = np.asarray(x)
+    if x.dtype == object:
+        x = x.astype(str)
+    shm = shared_memory.SharedMemory(create=True, size=max(x.nbytes, 1))
+    shared_x = np.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)
+    shared_x[:] = x
+    return shm, (shm.name, x.shape, x.dtype.str)
+
+def attach_array(shared_desc):
+    """
+    Attach to an array in shared memory created by share_array. Returns the shared memory block, which must be kept open while the array is in use,
+    and the array
+    """
+    name, shape, dtype = shared_desc
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
 def parse_obsfiles(obsfiles, obsformat='bed', append = True, wildcard = '@', chromosomes=None):
     obs_files = []
     chroms = []
@@ -121,6 +227,16 @@ def parseNumRange(string):
         raise Exception(f"{string} is neither a range of the form x-y nor a list of integers of the form x y z")
     return result
 
+def parseShard(string):
+    """reads a shard of the form k/n, returning (k, n)"""
+    match_shard = re.fullmatch(r' *(\d+) */ *(\d+) *', string)
+    if not match_shard:
+        raise argparse.ArgumentTypeError(f"{string} is not a shard of the form k/n")
+    k, n = int(match_shard.group(1)), int(match_shard.group(2))
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError(f"invalid shard {string}: must have 1<=k<=n")
+    return k, n
+
 class NumRangeAction(argparse.Action):
     """flattens and sorts the resulting num range. also removes duplicates"""
     def __call__(self, parser, args, values, option_string=None):